@@ -8,20 +8,13 @@ SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 MODEL_DIR="data/outputs/model_example"
 CONFIG="configs/predict.yaml"
 
+# All regions in one process so the model is loaded only once; an aggregate
+# report is written to data/outputs/prediction_example/predict_summary.json
 python -m src.pipeline.predict --config "$CONFIG" \
     --model-dir "$MODEL_DIR" \
     --input-dir "data/example_run/Sentinel-2/fukuoka" \
-    --output-dir "data/outputs/prediction_example/fukuoka"
-
-python -m src.pipeline.predict --config "$CONFIG" \
-    --model-dir "$MODEL_DIR" \
+    --output-dir "data/outputs/prediction_example/fukuoka" \
     --input-dir "data/example_run/Sentinel-2/aso" \
-    --output-dir "data/outputs/prediction_example/aso"
-
-python -m src.pipeline.predict --config "$CONFIG" \
-    --model-dir "$MODEL_DIR" \
+    --output-dir "data/outputs/prediction_example/aso" \
     --input-dir "data/example_run/Sentinel-2/hita" \
     --output-dir "data/outputs/prediction_example/hita"
-
-
-
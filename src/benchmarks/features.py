@@ -0,0 +1,68 @@
+"""Microbenchmark for the spectral index kernels.
+
+Times every registered index (plus a raw band and a band ratio) and the
+neighbourhood features over several window sizes on a synthetic Sentinel-2
+block, reports megapixels per second, milliseconds per megapixel and the
+memory allocated per call, then times all spectral indices evaluated
+together::
+
+    python -m src.benchmarks.features --size 1024
+"""
+from __future__ import annotations
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from ..preprocess.features import FEATURES, FOCAL_OPS, FeatureSet
+
+BAND_NAMES = ["B02", "B03", "B04", "B08", "B11"]
+FOCAL_SIZES = [3, 7, 15, 31]
+
+
+def _measure(feature_set: FeatureSet, stack: np.ndarray, repeat: int) -> tuple[float, int]:
+    out = np.empty((len(feature_set),) + stack.shape[1:], dtype=np.float32)
+    feature_set.compute(stack, out)  # warm up scratch buffers
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        feature_set.compute(stack, out)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    feature_set.compute(stack, out)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Benchmark spectral index kernels")
+    p.add_argument("--size", type=int, default=1024, help="Block edge length in pixels")
+    p.add_argument("--repeat", type=int, default=5, help="Timed runs per feature")
+    args = p.parse_args()
+
+    rng = np.random.default_rng(0)
+    stack = rng.uniform(0, 5000, (len(BAND_NAMES), args.size, args.size)).astype(np.float32)
+    mpx = args.size * args.size / 1e6
+    names = sorted(FEATURES) + ["B08", "B08/B04"]
+    # the cost of neighbourhood features should not grow with the window
+    focal = [f"NDVI_{op}{size}" for op in FOCAL_OPS for size in FOCAL_SIZES]
+
+    def report(name, feature_set):
+        sec, peak = _measure(feature_set, stack, args.repeat)
+        print(
+            f"{name:<16} {sec * 1e3:8.2f} {mpx / sec:8.1f} {sec * 1e3 / mpx:8.2f} "
+            f"{peak / 1024:9.1f}"
+        )
+
+    print(f"{args.size}x{args.size} px block")
+    print(f"{'feature':<16} {'ms':>8} {'Mpx/s':>8} {'ms/Mpx':>8} {'alloc KB':>9}")
+    for name in names + focal:
+        report(name, FeatureSet([name], BAND_NAMES))
+    report("all indices", FeatureSet(names, BAND_NAMES))
+
+
+if __name__ == "__main__":
+    main()
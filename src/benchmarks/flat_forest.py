@@ -0,0 +1,82 @@
+"""Pickled forest versus the flat array format.
+
+Fits a RandomForest on synthetic samples (or loads ``--model``), exports it
+with :func:`src.classification.flat_forest.save_flat_forest` and reports
+file size, load time, memory allocated while loading, prediction
+throughput and whether the predictions agree::
+
+    python -m src.benchmarks.flat_forest --trees 100 --samples 200000
+    python -m src.benchmarks.flat_forest --model data/outputs/model/model.pkl
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import joblib
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+
+from ..classification.flat_forest import FlatForest, save_flat_forest
+from .models import synthetic_samples
+
+
+def _load(fn, path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    model = fn(path)
+    sec = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return model, sec, peak
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Benchmark the flat forest format")
+    p.add_argument("--model", help="Pickled forest to convert instead of fitting one")
+    p.add_argument("--trees", type=int, default=100, help="Trees of the fitted forest")
+    p.add_argument("--samples", type=int, default=100000, help="Training samples")
+    p.add_argument("--predict-pixels", type=int, default=500000, help="Pixels per timed predict")
+    args = p.parse_args()
+
+    if args.model:
+        clf = joblib.load(args.model)
+        X = np.random.default_rng(0).normal(0, 1, (args.predict_pixels, clf.n_features_in_))
+        X = X.astype(np.float32)
+    else:
+        X, y = synthetic_samples(args.samples)
+        clf = RandomForestClassifier(n_estimators=args.trees, random_state=0, n_jobs=-1).fit(X, y)
+        X = X[np.arange(args.predict_pixels) % X.shape[0]]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pkl = os.path.join(tmp, "model.pkl")
+        flat = os.path.join(tmp, "model.flat")
+        joblib.dump(clf, pkl)
+        save_flat_forest(clf, flat)
+        loaders = {
+            "pickle": joblib.load,
+            "pickle mmap": lambda path: joblib.load(path, mmap_mode="r"),
+            "flat": FlatForest.open,
+        }
+        print(f"{len(clf.estimators_)} trees, {X.shape[0]} pixels x {X.shape[1]} features")
+        print(f"{'format':<12} {'size MB':>8} {'load ms':>8} {'load MB':>8} {'Mpx/s':>8}")
+        reference = None
+        for name, fn in loaders.items():
+            path = flat if name == "flat" else pkl
+            model, load_sec, peak = _load(fn, path)
+            start = time.perf_counter()
+            pred = model.predict(X)
+            predict_sec = time.perf_counter() - start
+            reference = pred if reference is None else reference
+            print(
+                f"{name:<12} {os.path.getsize(path) / 1e6:8.2f} {load_sec * 1e3:8.1f} "
+                f"{peak / 1e6:8.2f} {X.shape[0] / predict_sec / 1e6:8.2f}"
+            )
+        print(f"flat predictions equal the pickle: {bool(np.array_equal(pred, reference))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Comparison of the registered classifiers.
+
+Fits every model in :data:`src.classification.train_model.MODELS` on the
+same training samples and reports fit time, pickled model size, load time,
+prediction throughput and holdout accuracy::
+
+    python -m src.benchmarks.models --config configs/train.yaml
+    python -m src.benchmarks.models --samples 200000
+
+With ``--config`` the samples are prepared as in ``src.pipeline.train``
+(reusing ``sample_cache_dir`` when set); otherwise synthetic features are
+used.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+
+import joblib
+import numpy as np
+import yaml
+
+from ..classification.train_model import MODELS, TrainingBackend, train_model
+
+
+def synthetic_samples(n: int, n_features: int = 8, n_classes: int = 6, seed: int = 0):
+    """Return ``(X, y)`` with class dependent feature means and overlap."""
+    rng = np.random.default_rng(seed)
+    y = rng.integers(1, n_classes + 1, n)
+    centers = rng.normal(0, 1, (n_classes + 1, n_features))
+    X = centers[y] + rng.normal(0, 1.2, (n, n_features))
+    return X.astype(np.float32), y.astype(np.uint8)
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Benchmark classifier backends")
+    p.add_argument("--config", help="Training YAML config; samples are prepared from it")
+    p.add_argument("--samples", type=int, default=100000, help="Synthetic samples without --config")
+    p.add_argument("--models", nargs="+", default=sorted(MODELS), help="Models to compare")
+    p.add_argument("--n-estimators", type=int, default=100, help="Trees or boosting iterations")
+    p.add_argument("--holdout", type=float, default=0.2, help="Fraction of samples for scoring")
+    p.add_argument("--predict-pixels", type=int, default=1_000_000, help="Pixels per timed predict")
+    args = p.parse_args()
+
+    nodata = None
+    weight = None
+    backend = TrainingBackend()
+    if args.config:
+        from ..pipeline.train import prepare_training_data
+
+        with open(args.config) as f:
+            cfg = yaml.safe_load(f)
+        samples = prepare_training_data(cfg)
+        X, y, weight = np.asarray(samples["X"]), np.asarray(samples["y"]), samples["weight"]
+        nodata = samples["info"]["encoding"]["nodata"]
+        backend = TrainingBackend.from_config(cfg)
+    else:
+        X, y = synthetic_samples(args.samples)
+    weight = np.ones(y.size) if weight is None else np.asarray(weight)
+    test = np.random.default_rng(0).random(y.size) < args.holdout
+    X_pred = X[np.arange(args.predict_pixels) % y.size]
+
+    print(f"{int((~test).sum())} training / {int(test.sum())} holdout samples, {X.shape[1]} features")
+    print(
+        f"{'model':<24} {'fit s':>8} {'size MB':>8} {'load s':>8} {'Mpx/s':>8} {'accuracy':>9}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.models:
+            start = time.perf_counter()
+            clf = train_model(
+                X[~test].T,
+                y[~test],
+                n_estimators=args.n_estimators,
+                nodata=nodata,
+                sample_weight=weight[~test],
+                backend=backend,
+                model_type=name,
+            )
+            fit_sec = time.perf_counter() - start
+
+            path = os.path.join(tmp, f"{name}.pkl")
+            joblib.dump(clf, path)
+            size_mb = os.path.getsize(path) / 1e6
+            start = time.perf_counter()
+            clf = joblib.load(path)
+            load_sec = time.perf_counter() - start
+
+            start = time.perf_counter()
+            clf.predict(X_pred)
+            predict_sec = time.perf_counter() - start
+            correct = clf.predict(X[test]) == y[test]
+            accuracy = float(np.average(correct, weights=weight[test]))
+            print(
+                f"{name:<24} {fit_sec:8.2f} {size_mb:8.2f} {load_sec:8.3f} "
+                f"{X_pred.shape[0] / predict_sec / 1e6:8.2f} {accuracy:9.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Tiled prediction throughput per number of worker processes.
+
+Writes a synthetic memory-mapped feature store, fits a RandomForest (or
+loads ``--model``) and runs :func:`src.classification.predict.predict_model`
+with every worker count, reporting pixels per second and checking that the
+prediction equals the serial one::
+
+    python -m src.benchmarks.predict --size 2048 --workers 1 2 4 8
+"""
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from affine import Affine
+
+from ..classification.flat_forest import SUFFIX as FLAT_SUFFIX, FlatForest
+from ..classification.predict import predict_model
+from ..classification.train_model import train_model
+from ..preprocess.feature_store import FeatureStore, create_feature_store
+from .models import synthetic_samples
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Benchmark parallel tiled prediction")
+    p.add_argument("--size", type=int, default=1024, help="Raster edge length in pixels")
+    p.add_argument("--tile", type=int, default=256, help="Tile edge length in pixels")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts")
+    p.add_argument("--model", help="Pickled or .flat model instead of a fitted forest")
+    p.add_argument("--trees", type=int, default=50, help="Trees of the fitted forest")
+    args = p.parse_args()
+
+    if args.model and Path(args.model).suffix == FLAT_SUFFIX:
+        clf = FlatForest.open(args.model)
+    elif args.model:
+        import joblib
+
+        clf = joblib.load(args.model, mmap_mode="r")
+    else:
+        X, y = synthetic_samples(50000)
+        clf = train_model(X.T, y, n_estimators=args.trees)
+    n_features = clf.n_features_in_
+    meta = {"crs": "EPSG:32652", "transform": Affine(10, 0, 0, 0, -10, 0)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "features.feat"
+        shape = (n_features, args.size, args.size)
+        data = create_feature_store(path, shape, [f"f{i}" for i in range(n_features)], meta)
+        rng = np.random.default_rng(0)
+        for row in range(0, args.size, 256):
+            block = data[:, row : row + 256]
+            block[:] = rng.normal(0, 1.5, block.shape)
+        data.flush()
+        store = FeatureStore.open(path)
+
+        pixels = args.size * args.size
+        print(f"{args.size}x{args.size} px, {args.tile} px tiles, {type(clf).__name__}")
+        print(f"{'workers':>8} {'sec':>8} {'Mpx/s':>8} {'identical':>10}")
+        reference = None
+        for n in args.workers:
+            start = time.perf_counter()
+            pred = predict_model(
+                clf, store.data, store.profile, Path(tmp) / f"pred{n}.tif",
+                tile_size=args.tile, n_workers=n,
+            )
+            sec = time.perf_counter() - start
+            reference = pred if reference is None else reference
+            print(f"{n:8d} {sec:8.2f} {pixels / sec / 1e6:8.2f} {str(np.array_equal(pred, reference)):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""Spatial block cross-validation on prepared training samples.
+
+Neighbouring pixels are strongly correlated, so randomly split pixels give
+optimistic scores. Samples are therefore grouped into square blocks of
+``block_size`` pixels per region and whole blocks are assigned to folds.
+Every sample is predicted exactly once by the model that did not see its
+block, and the out-of-fold predictions are scored like ``metrics.json``.
+"""
+import os
+import time
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+
+from .metrics import classification_metrics
+from .train_model import TrainingBackend, train_model
+
+
+def spatial_folds(positions, block_size, n_folds, seed=0):
+    """Assign samples to folds by spatial block.
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        ``(n_samples, 3)`` region index, row and column of each sample.
+    block_size : int
+        Block edge length in pixels.
+    n_folds : int
+        Number of folds.
+    seed : int, optional
+        Seed for shuffling the blocks.
+
+    Returns
+    -------
+    tuple
+        ``(fold, n_blocks)`` with the fold index of every sample.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    blocks = np.stack(
+        [positions[:, 0], positions[:, 1] // block_size, positions[:, 2] // block_size], axis=1
+    )
+    _, block = np.unique(blocks, axis=0, return_inverse=True)
+    block = block.ravel()
+    n_blocks = int(block.max()) + 1 if block.size else 0
+    if n_blocks < n_folds:
+        raise ValueError(
+            f"Only {n_blocks} spatial blocks for {n_folds} folds; lower cv.block_size"
+        )
+    # shuffled blocks dealt round robin give folds of similar block counts
+    order = np.random.default_rng(seed).permutation(n_blocks)
+    fold_of_block = np.empty(n_blocks, dtype=np.int64)
+    fold_of_block[order] = np.arange(n_blocks) % n_folds
+    return fold_of_block[block], n_blocks
+
+
+def _gather_rows(X, index, chunk_rows=65536):
+    """``X[index]`` as the float32 C-contiguous array the trees are fitted on.
+
+    Filled chunk by chunk, so it is the only copy of the fold's rows (the
+    model uses it as it is).
+    """
+    out = np.empty((index.size, X.shape[1]), dtype=np.float32)
+    for start in range(0, index.size, chunk_rows):
+        out[start : start + chunk_rows] = X[index[start : start + chunk_rows]]
+    return out
+
+
+def _fold_backend(backend, n_parallel):
+    """Backend of one fold when ``n_parallel`` folds are fitted at once.
+
+    The cores are divided among the folds instead of every fold using all
+    of them.
+    """
+    backend = backend or TrainingBackend()
+    if n_parallel <= 1:
+        return backend
+    return TrainingBackend(
+        n_jobs=max((os.cpu_count() or 1) // n_parallel, 1),
+        parallelism=backend.parallelism,
+        memory_budget_mb=backend.memory_budget_mb,
+        progress_every=backend.progress_every,
+    )
+
+
+def _fit_fold(X, y, weight, train, test, fit_params):
+    start = time.perf_counter()
+    # cached samples are valid rows, so train_model does not filter them again
+    clf = train_model(
+        _gather_rows(X, train).T,
+        y[train],
+        sample_weight=None if weight is None else weight[train],
+        assume_valid=True,
+        **fit_params,
+    )
+    seconds = time.perf_counter() - start
+    return clf.predict(X[test]), seconds
+
+
+def cross_validate(X, y, weight, fold, fit_params, n_jobs=1):
+    """Fit one model per fold in parallel and score the held-out blocks.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        ``(n_samples, n_features)`` valid samples, may be memory-mapped.
+    y : np.ndarray
+        Labels.
+    weight : np.ndarray or None
+        Sample weights (dedup counts); metrics count every sample with its
+        weight so they are comparable to per-pixel ``metrics.json``.
+    fold : np.ndarray
+        Fold index of every sample, see :func:`spatial_folds`.
+    fit_params : dict
+        Keyword arguments for :func:`train_model`; rows must be valid.
+    n_jobs : int, optional
+        Folds fitted in parallel. The cores are divided among them, so the
+        ``n_jobs`` of ``fit_params["backend"]`` is lowered accordingly.
+
+    Returns
+    -------
+    dict
+        Metrics of the pooled out-of-fold predictions plus ``per_fold``
+        metrics and fit times.
+    """
+    y = np.asarray(y)
+    weight = None if weight is None else np.asarray(weight)
+    n_folds = int(fold.max()) + 1
+    # index arrays computed once; workers gather their rows from the shared X
+    splits = [(np.flatnonzero(fold != k), np.flatnonzero(fold == k)) for k in range(n_folds)]
+    n_parallel = min(effective_n_jobs(n_jobs), n_folds)
+    fit_params = {**fit_params, "backend": _fold_backend(fit_params.get("backend"), n_parallel)}
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_fold)(X, y, weight, train, test, fit_params) for train, test in splits
+    )
+    predictions = np.zeros_like(y)
+    per_fold = []
+    for k, (pred, seconds) in enumerate(results):
+        test = fold == k
+        predictions[test] = pred
+        test_weight = None if weight is None else weight[test]
+        metrics = classification_metrics(pred, y[test], test_weight) or {}
+        per_fold.append(
+            {
+                "fold": k,
+                "n_test": int(test.sum()),
+                "fit_seconds": round(seconds, 3),
+                "overall_accuracy": metrics.get("overall_accuracy"),
+                "macro_f1": metrics.get("macro_f1"),
+            }
+        )
+    report = classification_metrics(predictions, y, weight) or {}
+    accuracy = [f["overall_accuracy"] for f in per_fold if f["overall_accuracy"] is not None]
+    report["overall_accuracy_mean"] = float(np.mean(accuracy)) if accuracy else None
+    report["overall_accuracy_std"] = float(np.std(accuracy)) if accuracy else None
+    report["per_fold"] = per_fold
+    return report
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def dedup_samples(X, y, step=None, return_index=False):
+    """Collapse identical ``(features, label)`` rows into weighted unique rows.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        ``(n_samples, n_features)`` feature rows without invalid values.
+    y : np.ndarray
+        ``(n_samples,)`` labels.
+    step : float, optional
+        Rows whose features fall into the same ``step`` sized grid cell are
+        treated as identical. ``None`` merges only exact duplicates, which is
+        the natural choice for quantized int16 features.
+    return_index : bool, optional
+        Also return the row of ``X`` each unique row was taken from.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        ``(X_unique, y_unique, counts)``; each unique row keeps the values of
+        its first occurrence and ``counts`` can be passed as
+        ``sample_weight``. With ``return_index`` the first occurrences are
+        appended.
+    """
+    X = np.asarray(X)
+    y = np.asarray(y)
+    n = y.size
+    key_x = X if step is None else np.floor(X / step).astype(np.int64)
+    # compare whole rows at once by viewing them as opaque byte strings
+    raw = np.concatenate(
+        [
+            np.ascontiguousarray(key_x).view(np.uint8).reshape(n, -1),
+            np.ascontiguousarray(y).view(np.uint8).reshape(n, -1),
+        ],
+        axis=1,
+    )
+    keys = np.ascontiguousarray(raw).view(np.dtype((np.void, raw.shape[1]))).ravel()
+    _, index, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(index)
+    index, counts = index[order], counts[order]
+    if return_index:
+        return X[index], y[index], counts, index
+    return X[index], y[index], counts
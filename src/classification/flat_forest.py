@@ -0,0 +1,199 @@
+"""Compact, memory-mappable format for fitted decision forests.
+
+A pickled ``RandomForestClassifier`` stores every tree as a separate object
+with 64-byte nodes and float64 class values for internal nodes too, so
+loading it costs seconds and a multiple of the file size in RAM. The flat
+format concatenates the nodes of all trees into a few contiguous arrays with
+narrow dtypes::
+
+    b"RSFLAT01"                 8-byte magic
+    <uint32 little endian>      length of the JSON header in bytes
+    {...JSON header...}         classes, array layout and the
+                                feature encoding (space padded)
+    feature    int8/int16       split feature of each internal node
+    threshold  float32          split threshold (rounded down)
+    children   int32            (n_internal, 2) children for ``x <= threshold``
+                                and ``x > threshold``
+    value      float32          (n_leaves, n_classes) class distributions
+    roots      int32            root node of every tree
+
+Only internal nodes are stored as nodes: a negative reference ``r`` in
+``children`` or ``roots`` points to leaf ``~r`` (row of ``value``). Every
+array starts at a 64-byte aligned offset and is memory-mapped on
+:meth:`FlatForest.open`, which takes milliseconds. Prediction pushes a batch
+of samples down all trees at once and drops the ``(sample, tree)`` pairs
+that reached a leaf after every level (:meth:`FlatForest.apply`).
+"""
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"RSFLAT01"
+ALIGN = 64
+SUFFIX = ".flat"
+
+# node arrays, in file order
+ARRAYS = ("feature", "threshold", "children", "value", "roots")
+
+
+def _float32_floor(values):
+    """Largest float32 not above each float64 value.
+
+    sklearn compares float32 features with float64 thresholds; with the
+    threshold rounded down ``x <= t32`` holds exactly when ``x <= t`` does.
+    """
+    t32 = values.astype(np.float32)
+    above = t32.astype(np.float64) > values
+    t32[above] = np.nextafter(t32[above], np.float32(-np.inf))
+    return t32
+
+
+def flatten_forest(clf):
+    """Return the flat arrays and header of a fitted forest classifier.
+
+    ``clf`` must be a single-output forest of decision trees such as
+    ``RandomForestClassifier``; other models raise ``TypeError``.
+    """
+    trees = getattr(clf, "estimators_", None)
+    if trees is None or not all(hasattr(t, "tree_") for t in trees):
+        raise TypeError(f"{type(clf).__name__} is not a forest of decision trees")
+    if getattr(clf, "n_outputs_", 1) != 1:
+        raise TypeError("Only single-output forests can be flattened")
+
+    n_features = int(clf.n_features_in_)
+    feature_dtype = np.int8 if n_features <= np.iinfo(np.int8).max else np.int16
+    parts = {k: [] for k in ARRAYS}
+    n_internal = n_leaves = 0
+    for est in trees:
+        tree = est.tree_
+        is_leaf = tree.children_left < 0
+        internal = np.flatnonzero(~is_leaf)
+        leaves = np.flatnonzero(is_leaf)
+        # node id -> reference in the flat arrays
+        ref = np.empty(tree.node_count, dtype=np.int64)
+        ref[internal] = np.arange(internal.size) + n_internal
+        ref[leaves] = ~(np.arange(leaves.size) + n_leaves)
+        n_internal += internal.size
+        n_leaves += leaves.size
+
+        parts["feature"].append(tree.feature[internal].astype(feature_dtype))
+        parts["threshold"].append(_float32_floor(tree.threshold[internal]))
+        children = np.stack([tree.children_left[internal], tree.children_right[internal]], axis=1)
+        parts["children"].append(ref[children].astype(np.int32).reshape(-1, 2))
+        value = tree.value[leaves, 0, :]
+        parts["value"].append((value / value.sum(axis=1, keepdims=True)).astype(np.float32))
+        parts["roots"].append(ref[:1].astype(np.int32))
+
+    arrays = {k: np.concatenate(v) for k, v in parts.items()}
+    header = {
+        "n_features": n_features,
+        "classes": np.asarray(clf.classes_).tolist(),
+        "classes_dtype": np.asarray(clf.classes_).dtype.name,
+        "feature_encoding": getattr(clf, "feature_encoding_", None),
+    }
+    return arrays, header
+
+
+def save_flat_forest(clf, path):
+    """Write ``clf`` in the flat format and return the file size in bytes."""
+    arrays, header = flatten_forest(clf)
+    header["arrays"] = {}
+    pos = 0
+    for name in ARRAYS:
+        pos += -pos % ALIGN
+        header["arrays"][name] = {
+            "dtype": arrays[name].dtype.name,
+            "shape": list(arrays[name].shape),
+            "offset": pos,
+        }
+        pos += arrays[name].nbytes
+    blob = json.dumps(header).encode("utf-8")
+    blob += b" " * (-(len(MAGIC) + 4 + len(blob)) % ALIGN)
+    with open(path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(blob)) + blob)
+        base = f.tell()
+        for name in ARRAYS:
+            f.seek(base + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(arrays[name]).tobytes())
+    return Path(path).stat().st_size
+
+
+class FlatForest:
+    """Forest classifier backed by the flat arrays of :func:`save_flat_forest`.
+
+    Provides ``predict``/``predict_proba``, ``classes_`` and
+    ``feature_encoding_`` like the estimator it was exported from, so it can
+    be passed to :func:`src.classification.predict.predict_model`.
+    """
+
+    def __init__(self, arrays, header):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.header = header
+        self.n_features_in_ = header["n_features"]
+        self.classes_ = np.array(header["classes"], dtype=header["classes_dtype"])
+        self.feature_encoding_ = header.get("feature_encoding")
+
+    @classmethod
+    def open(cls, path):
+        """Memory-map a flat forest file."""
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a flat forest")
+            (length,) = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(length).decode("utf-8"))
+        base = len(MAGIC) + 4 + length
+        arrays = {
+            name: np.memmap(
+                path,
+                dtype=spec["dtype"],
+                mode="r",
+                offset=base + spec["offset"],
+                shape=tuple(spec["shape"]),
+            )
+            for name, spec in header["arrays"].items()
+        }
+        return cls(arrays, header)
+
+    @property
+    def n_trees(self):
+        return self.roots.size
+
+    def apply(self, X):
+        """Return the ``(n_samples, n_trees)`` leaf rows reached by ``X``."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n, n_trees = X.shape[0], self.n_trees
+        flat = X.ravel()
+        children = self.children.ravel()
+        out = np.empty(n * n_trees, dtype=np.int32)
+        # (sample, tree) pairs still inside the trees
+        node = np.tile(self.roots, n)
+        pos = np.arange(n * n_trees)
+        base = np.repeat(np.arange(n, dtype=np.int64) * X.shape[1], n_trees)
+        while True:
+            done = node < 0
+            if done.any():
+                out[pos[done]] = ~node[done]
+                keep = ~done
+                node, pos, base = node[keep], pos[keep], base[keep]
+            if node.size == 0:
+                return out.reshape(n, n_trees)
+            right = flat[base + self.feature[node]] > self.threshold[node]
+            node = children[2 * node + right]
+
+    def predict_proba(self, X, batch_size=4096):
+        """Mean class distribution of the reached leaves, as in sklearn."""
+        X = np.asarray(X)
+        proba = np.zeros((X.shape[0], self.classes_.size))
+        for start in range(0, X.shape[0], batch_size):
+            leaves = self.apply(X[start : start + batch_size])
+            out = proba[start : start + batch_size]
+            for t in range(self.n_trees):
+                out += self.value[leaves[:, t]]
+        proba /= self.n_trees
+        return proba
+
+    def predict(self, X, batch_size=4096):
+        return self.classes_.take(np.argmax(self.predict_proba(X, batch_size), axis=1))
@@ -0,0 +1,138 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+
+def _safe_divide(numerator: float, denominator: float) -> Optional[float]:
+    if denominator == 0:
+        return None
+    return float(numerator) / float(denominator)
+
+
+def confusion_matrix(labels, predictions, class_ids, sample_weight=None) -> np.ndarray:
+    """Confusion matrix (rows: label, columns: prediction) with one ``bincount``.
+
+    ``labels`` and ``predictions`` must only contain values of the sorted
+    ``class_ids``. With ``sample_weight`` every pixel counts its weight;
+    integer weights (e.g. dedup counts) keep an integer matrix.
+    """
+    class_ids = np.asarray(class_ids)
+    n = class_ids.size
+    index = np.searchsorted(class_ids, labels) * n + np.searchsorted(class_ids, predictions)
+    matrix = np.bincount(index.ravel(), weights=sample_weight, minlength=n * n).reshape(n, n)
+    if sample_weight is not None and np.asarray(sample_weight).dtype.kind in "iu":
+        matrix = np.rint(matrix).astype(np.int64)
+    return matrix
+
+
+def classification_metrics(
+    predictions: np.ndarray, labels: np.ndarray, sample_weight=None
+) -> Optional[Dict[str, object]]:
+    """Accuracy metrics of a classification, as written to ``metrics.json``.
+
+    Label value 0 is treated as background / nodata and excluded from the
+    evaluation; predictions of 0 or below count as unclassified (class 0).
+    """
+    valid_mask = labels > 0
+    if not np.any(valid_mask):
+        return None
+
+    pred_flat = predictions[valid_mask].ravel()
+    label_flat = labels[valid_mask].ravel()
+    if sample_weight is not None:
+        sample_weight = np.asarray(sample_weight)[valid_mask].ravel()
+
+    has_unclassified = bool(np.any(pred_flat <= 0))
+    if has_unclassified:
+        pred_flat = np.where(pred_flat > 0, pred_flat, 0)
+    class_ids = np.union1d(np.unique(label_flat), np.unique(pred_flat))
+    class_ids = class_ids[(class_ids > 0) | has_unclassified].astype(np.int64)
+
+    matrix = confusion_matrix(label_flat, pred_flat, class_ids, sample_weight)
+    return metrics_from_confusion(matrix, class_ids)
+
+
+class ConfusionAccumulator:
+    """Confusion counts of a classification evaluated block by block.
+
+    After :meth:`add` has seen every block, :meth:`metrics` equals
+    :func:`classification_metrics` of the whole rasters.
+    """
+
+    def __init__(self):
+        self.counts: Dict[tuple, int] = {}
+
+    def add(self, predictions: np.ndarray, labels: np.ndarray) -> None:
+        valid_mask = labels > 0
+        if not np.any(valid_mask):
+            return
+        label_ids, label_idx = np.unique(labels[valid_mask], return_inverse=True)
+        pred_ids, pred_idx = np.unique(
+            np.maximum(predictions[valid_mask], 0), return_inverse=True
+        )
+        counts = np.bincount(
+            label_idx * pred_ids.size + pred_idx, minlength=label_ids.size * pred_ids.size
+        ).reshape(label_ids.size, pred_ids.size)
+        for i, j in zip(*np.nonzero(counts)):
+            key = (int(label_ids[i]), int(pred_ids[j]))
+            self.counts[key] = self.counts.get(key, 0) + int(counts[i, j])
+
+    def metrics(self) -> Optional[Dict[str, object]]:
+        if not self.counts:
+            return None
+        # labels are > 0, so class 0 only appears for unclassified pixels
+        class_ids = np.array(sorted({c for pair in self.counts for c in pair}), dtype=np.int64)
+        matrix = np.zeros((class_ids.size, class_ids.size), dtype=np.int64)
+        for (label, pred), count in self.counts.items():
+            matrix[np.searchsorted(class_ids, label), np.searchsorted(class_ids, pred)] = count
+        return metrics_from_confusion(matrix, class_ids)
+
+
+def metrics_from_confusion(matrix, class_ids) -> Dict[str, object]:
+    """Metrics of a confusion matrix whose rows are labels greater than 0.
+
+    Used directly to pool the matrices of several regions or folds.
+    """
+    matrix = np.asarray(matrix)
+    totals = matrix.sum()
+
+    diagonal = np.diag(matrix)
+    row_sums = matrix.sum(axis=1)
+    col_sums = matrix.sum(axis=0)
+
+    producer_accuracy: Dict[str, Optional[float]] = {}
+    user_accuracy: Dict[str, Optional[float]] = {}
+    f1_per_class: Dict[str, Optional[float]] = {}
+
+    eval_indices = [i for i, cls in enumerate(class_ids) if cls > 0]
+
+    for idx in eval_indices:
+        cls = int(class_ids[idx])
+        recall = _safe_divide(diagonal[idx], row_sums[idx])
+        precision = _safe_divide(diagonal[idx], col_sums[idx])
+
+        producer_accuracy[str(cls)] = recall
+        user_accuracy[str(cls)] = precision
+
+        if recall is None or precision is None:
+            f1_per_class[str(cls)] = None
+        elif recall == 0 and precision == 0:
+            f1_per_class[str(cls)] = 0.0
+        else:
+            f1_per_class[str(cls)] = 2 * precision * recall / (precision + recall)
+
+    f1_values = [v for v in f1_per_class.values() if v is not None]
+    macro_f1 = _safe_divide(sum(f1_values), len(f1_values)) if f1_values else None
+
+    correct = diagonal[eval_indices].sum()
+    overall_accuracy = _safe_divide(correct, totals)
+
+    return {
+        "classes": [int(cls) for cls in class_ids],
+        "confusion_matrix": matrix.tolist(),
+        "overall_accuracy": overall_accuracy,
+        "producer_accuracy": producer_accuracy,
+        "user_accuracy": user_accuracy,
+        "f1_per_class": f1_per_class,
+        "macro_f1": macro_f1,
+    }
@@ -1,16 +1,217 @@
+import contextlib
+import multiprocessing
+import os
+
 import numpy as np
-from ..utils import io_raster
+import rasterio
+from rasterio.windows import Window
+
+from .train_model import valid_samples
+
+# model and features of the forked prediction workers
+_WORKER = {}
+
+
+def iter_tiles(height, width, tile_size):
+    """Yield the ``tile_size`` x ``tile_size`` windows covering a raster."""
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+
+
+def confidence_bands(proba, classes, top_k=0):
+    """Quantized confidence of ``(n, classes)`` probabilities.
 
+    Returns ``uint8`` bands ``(2 + 2 * top_k, n)``: the maximum probability,
+    the margin between the two most probable classes and, for the ``top_k``
+    most probable classes, their class value and probability. Probabilities
+    are scaled to 0-255.
+    """
+    if top_k > len(classes):
+        raise ValueError(f"top_k={top_k} exceeds the {len(classes)} classes of the model")
+    # stable order keeps the first of tied classes on top, as argmax in predict does
+    order = np.argsort(-proba, axis=1, kind="stable")[:, : max(top_k, 2)]
+    top = np.take_along_axis(proba, order, axis=1)
+    second = top[:, 1] if top.shape[1] > 1 else 0.0
+    out = np.empty((2 + 2 * top_k, proba.shape[0]), dtype=np.uint8)
+    out[0] = _quantize_probability(top[:, 0])
+    out[1] = _quantize_probability(top[:, 0] - second)
+    out[2::2] = np.asarray(classes)[order[:, :top_k]].T
+    out[3::2] = _quantize_probability(top[:, :top_k]).T
+    return out
 
-def predict_model(clf, features, meta, output_path):
-    """Generate a classification raster using a trained model."""
-    X = features.reshape(features.shape[0], -1).T
-    nodata = np.isnan(X).any(axis=1)
+
+def _quantize_probability(p):
+    return np.rint(np.asarray(p) * 255).astype(np.uint8)
+
+
+def confidence_band_names(top_k=0):
+    """Descriptions of the bands returned by :func:`confidence_bands`."""
+    names = ["max_probability", "top2_margin"]
+    for k in range(1, top_k + 1):
+        names += [f"top{k}_class", f"top{k}_probability"]
+    return names
+
+
+def predict_block(clf, block, nodata=None, confidence=False, top_k=0):
+    """Classify a ``(features, rows, cols)`` block.
+
+    Returns the ``uint8`` class raster (0 for invalid pixels), the mask of
+    pixels whose features were all valid and, with ``confidence``, the
+    ``(bands, rows, cols)`` output of :func:`confidence_bands` (else
+    ``None``). Labels and confidence then come from one ``predict_proba``
+    call, so the model is evaluated only once.
+    """
+    n_features, rows, cols = block.shape
+    X = block.reshape(n_features, -1).T
+    valid = valid_samples(X, nodata)
     preds = np.zeros(X.shape[0], dtype=np.uint8)
-    valid_idx = ~nodata
-    preds[valid_idx] = clf.predict(X[valid_idx])
-    pred_raster = preds.reshape(features.shape[1:])
+    conf = None
+    if confidence:
+        conf = np.zeros((2 + 2 * top_k, X.shape[0]), dtype=np.uint8)
+        if valid.any():
+            proba = clf.predict_proba(X[valid])
+            preds[valid] = clf.classes_.take(np.argmax(proba, axis=1))
+            conf[:, valid] = confidence_bands(proba, clf.classes_, top_k)
+        conf = conf.reshape(-1, rows, cols)
+    elif valid.any():
+        preds[valid] = clf.predict(X[valid])
+    return preds.reshape(rows, cols), valid.reshape(rows, cols), conf
+
+
+def _read_window(features, window):
+    (r0, r1), (c0, c1) = window.toranges()
+    return np.asarray(features[:, r0:r1, c0:c1])
+
+
+def _init_worker(clf, features, nodata, confidence, top_k):
+    # forked workers inherit the parent's model and memory-mapped features,
+    # so their pages are shared instead of copied
+    if "n_jobs" in getattr(clf, "get_params", dict)():
+        clf.set_params(n_jobs=1)
+    _WORKER.update(clf=clf, features=features, nodata=nodata, confidence=confidence, top_k=top_k)
+
+
+def _predict_tile(window):
+    block = _read_window(_WORKER["features"], window)
+    return (
+        window,
+        *predict_block(
+            _WORKER["clf"], block, _WORKER["nodata"], _WORKER["confidence"], _WORKER["top_k"]
+        ),
+    )
+
+
+def _tile_results(clf, read, features, nodata, windows, n_workers, confidence, top_k):
+    """Yield ``(window, preds, valid, confidence)`` serially or from worker processes."""
+    if n_workers == 1:
+        for window in windows:
+            yield (window, *predict_block(clf, read(window), nodata, confidence, top_k))
+        return
+    ctx = multiprocessing.get_context("fork")
+    initargs = (clf, features, nodata, confidence, top_k)
+    with ctx.Pool(n_workers, initializer=_init_worker, initargs=initargs) as pool:
+        # workers pull one tile at a time, so slow tiles do not stall others
+        yield from pool.imap_unordered(_predict_tile, windows, chunksize=1)
+
+
+def predict_model(
+    clf,
+    features,
+    meta,
+    output_path,
+    nodata=None,
+    tile_size=512,
+    valid_out=None,
+    n_workers=1,
+    confidence_path=None,
+    top_k=0,
+    return_raster=True,
+):
+    """Generate a classification raster using a trained model.
+
+    The raster is processed tile by tile: only the valid pixels of a tile are
+    predicted and the tile is written straight into ``output_path``. With
+    ``return_raster=False`` and no ``valid_out`` the peak memory depends on
+    ``tile_size`` rather than the scene size; otherwise the ``uint8``
+    prediction (and the ``valid_out`` mask) of the whole scene is kept too.
+
+    Parameters
+    ----------
+    clf : classifier
+        Fitted model with ``predict``.
+    features : np.ndarray or callable
+        ``(features, height, width)`` array, typically memory-mapped, or a
+        function ``read(window)`` returning the features of a window.
+    meta : dict
+        Rasterio profile of the feature grid (``height`` and ``width`` are
+        required with a callable ``features``).
+    output_path : Path
+        Output GeoTIFF.
+    nodata : int or float, optional
+        Value marking invalid feature values (NaN when ``None``); those
+        pixels are written as 0.
+    tile_size : int, optional
+        Tile edge length in pixels.
+    valid_out : np.ndarray, optional
+        ``(height, width)`` boolean array receiving the valid feature mask.
+    n_workers : int, optional
+        Worker processes predicting tiles in parallel (``-1`` for all
+        cores). Workers are forked, so they share the loaded model and the
+        memory-mapped features read-only; the parent writes the tiles. The
+        output is identical to serial prediction. Requires an array
+        ``features`` and the ``fork`` start method.
+    confidence_path : Path, optional
+        GeoTIFF receiving the ``uint8`` bands of :func:`confidence_bands`
+        (maximum probability and top-2 margin scaled to 0-255, then class
+        and probability of the ``top_k`` most probable classes), written
+        tile by tile in the same pass as the labels. Invalid pixels are 0;
+        valid pixels always have a maximum probability above 0. Requires
+        ``predict_proba`` and ``classes_`` on ``clf``.
+    top_k : int, optional
+        Number of most probable classes written to ``confidence_path``.
+    return_raster : bool, optional
+        Also return the prediction as an array.
+
+    Returns
+    -------
+    np.ndarray or None
+        The ``(height, width)`` ``uint8`` prediction, or ``None`` with
+        ``return_raster=False``.
+    """
+    if n_workers == -1:
+        n_workers = os.cpu_count() or 1
+    if callable(features):
+        if n_workers != 1:
+            raise ValueError("Parallel prediction needs a feature array, not a reader function")
+        read = features
+        height, width = meta["height"], meta["width"]
+    else:
+        height, width = features.shape[1:]
+
+        def read(window):
+            return _read_window(features, window)
+
+    pred_raster = np.zeros((height, width), dtype=np.uint8) if return_raster else None
     meta = meta.copy()
-    meta.update(count=1, dtype='uint8', nodata=0)
-    io_raster.write_raster(output_path, pred_raster[np.newaxis, ...], meta)
+    meta.update(count=1, dtype='uint8', nodata=0, height=height, width=width)
+    windows = iter_tiles(height, width, tile_size)
+    confidence = confidence_path is not None
+    tiles = _tile_results(clf, read, features, nodata, windows, n_workers, confidence, top_k)
+    with contextlib.ExitStack() as stack:
+        dst = stack.enter_context(rasterio.open(output_path, 'w', **meta))
+        if confidence:
+            names = confidence_band_names(top_k)
+            conf_meta = dict(meta, count=len(names), nodata=None)
+            conf_dst = stack.enter_context(rasterio.open(confidence_path, 'w', **conf_meta))
+            conf_dst.descriptions = tuple(names)
+        for window, preds, valid, conf in tiles:
+            (r0, r1), (c0, c1) = window.toranges()
+            if return_raster:
+                pred_raster[r0:r1, c0:c1] = preds
+            if valid_out is not None:
+                valid_out[r0:r1, c0:c1] = valid
+            dst.write(preds, 1, window=window)
+            if confidence:
+                conf_dst.write(conf, window=window)
     return pred_raster
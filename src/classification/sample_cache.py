@@ -0,0 +1,147 @@
+"""On-disk cache of prepared training samples.
+
+Preparing ``(X, y)`` (reading features and labels, sampling, removing
+invalid rows and deduplicating) usually costs more than fitting a model
+during hyperparameter sweeps. The prepared arrays are therefore stored as
+``.npy`` files under ``<cache_dir>/<key>/`` and memory-mapped on reuse::
+
+    X.npy       (n_samples, n_features) C-contiguous features
+    y.npy       (n_samples,) labels
+    weight.npy  (n_samples,) sample weights (only with dedup)
+    pos.npy     (n_samples, 3) region index, row and column of each sample
+                (of its first occurrence with dedup)
+    order.npy   (n_samples,) row indexes sorted by label, so the rows of one
+                class can be looked up without scanning ``y``
+    info.json   feature encoding and preparation report
+
+:func:`holdout_split` adds ``holdout_<fraction>_<seed>/{train,test}/``
+with the same files for the rows of a train/test split, so parallel fits
+memory-map their rows instead of each indexing a private copy.
+
+The key hashes the input file fingerprints, the preparation settings and
+the code version, so any change produces a new entry.
+"""
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from ..utils.manifest import code_version, config_hash, file_fingerprint
+
+# train.yaml keys that change the prepared samples
+SAMPLE_KEYS = (
+    "input_dirs",
+    "features",
+    "labels",
+    "samples",
+    "sample_fraction",
+    "dedup",
+    "dedup_step",
+)
+
+
+def sample_cache_key(cfg, inputs):
+    """Cache key for the samples prepared from ``inputs`` with ``cfg``."""
+    return config_hash(
+        {k: cfg.get(k) for k in SAMPLE_KEYS},
+        {str(p): file_fingerprint(p) for p in inputs},
+        code_version(),
+    )[:16]
+
+
+def load_cached_samples(cache_dir, key):
+    """Return the memory-mapped samples stored under ``key`` or ``None``."""
+    entry = Path(cache_dir) / key
+    if not (entry / "info.json").exists():
+        return None
+    weight = entry / "weight.npy"
+    positions = entry / "pos.npy"
+    order = entry / "order.npy"
+    return {
+        "X": np.load(entry / "X.npy", mmap_mode="r"),
+        "y": np.load(entry / "y.npy", mmap_mode="r"),
+        "weight": np.load(weight, mmap_mode="r") if weight.exists() else None,
+        "positions": np.load(positions, mmap_mode="r") if positions.exists() else None,
+        "order": np.load(order, mmap_mode="r") if order.exists() else None,
+        "info": json.loads((entry / "info.json").read_text()),
+        "path": entry,
+    }
+
+
+def save_cached_samples(cache_dir, key, X, y, weight=None, info=None, positions=None):
+    """Store prepared samples under ``key`` and return them memory-mapped."""
+    entry = Path(cache_dir) / key
+    tmp = Path(cache_dir) / f".{key}.tmp{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    np.save(tmp / "X.npy", np.ascontiguousarray(X))
+    np.save(tmp / "y.npy", np.asarray(y))
+    np.save(tmp / "order.npy", np.argsort(y, kind="stable"))
+    if weight is not None:
+        np.save(tmp / "weight.npy", np.asarray(weight))
+    if positions is not None:
+        np.save(tmp / "pos.npy", np.asarray(positions))
+    # info.json last: its presence marks a complete entry
+    (tmp / "info.json").write_text(json.dumps(info or {}, indent=2))
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp, entry)
+    return load_cached_samples(cache_dir, key)
+
+
+def _write_rows(path, arrays, keep, chunk_rows=65536):
+    """Write the ``keep`` rows of each array to ``path/<name>.npy`` chunk by chunk."""
+    path.mkdir(parents=True)
+    n = int(keep.sum())
+    for name, array in arrays.items():
+        out = np.lib.format.open_memmap(
+            path / f"{name}.npy", mode="w+", dtype=array.dtype, shape=(n,) + array.shape[1:]
+        )
+        pos = 0
+        for start in range(0, keep.size, chunk_rows):
+            rows = array[start : start + chunk_rows][keep[start : start + chunk_rows]]
+            out[pos : pos + len(rows)] = rows
+            pos += len(rows)
+        out.flush()
+        del out
+
+
+def holdout_split(samples, holdout, seed=0):
+    """Split cached samples into memory-mapped train and test rows.
+
+    Rows are assigned to the test set with probability ``holdout``. The
+    split is written once into the cache entry and reused afterwards.
+
+    Returns
+    -------
+    dict
+        ``{"train": path, "test": path}`` directories holding ``X.npy``,
+        ``y.npy`` and, with dedup, ``weight.npy``; see :func:`load_rows`.
+    """
+    entry = Path(samples["path"])
+    split = entry / f"holdout_{holdout:g}_{seed}"
+    if not (split / "done").exists():
+        test = np.random.default_rng(seed).random(samples["y"].size) < holdout
+        arrays = {"X": samples["X"], "y": samples["y"]}
+        if samples["weight"] is not None:
+            arrays["weight"] = samples["weight"]
+        tmp = entry / f".{split.name}.tmp{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        _write_rows(tmp / "train", arrays, ~test)
+        _write_rows(tmp / "test", arrays, test)
+        (tmp / "done").touch()
+        shutil.rmtree(split, ignore_errors=True)
+        os.replace(tmp, split)
+    return {"train": split / "train", "test": split / "test"}
+
+
+def load_rows(path):
+    """Memory-map ``(X, y, weight)`` written by :func:`holdout_split`."""
+    path = Path(path)
+    weight = path / "weight.npy"
+    return (
+        np.load(path / "X.npy", mmap_mode="r"),
+        np.load(path / "y.npy", mmap_mode="r"),
+        np.load(weight, mmap_mode="r") if weight.exists() else None,
+    )
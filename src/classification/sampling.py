@@ -0,0 +1,300 @@
+"""Training sample tables.
+
+Instead of computing and loading the features of every pixel, training data
+can be prepared from a sample of pixel coordinates: the coordinates are
+drawn from the label raster first (optionally stratified by class) and only
+the band windows around the sampled pixels are read to compute their
+features, or read straight from a time-series datacube with
+:func:`read_cube_sample_features`. Alternatively :class:`ClassReservoir` streams existing feature
+stores block by block and keeps a capped, uniform sample of every class.
+The result is a compact sample table saved as ``.npz`` with
+
+``X``
+    ``(n_samples, n_features)`` feature values.
+``y``
+    ``(n_samples,)`` labels.
+``region``, ``rows``, ``cols``
+    Index of the input directory and pixel position of each sample.
+``info``
+    JSON with the feature names, input directories and the feature encoding
+    (see :func:`src.preprocess.feature_store.feature_encoding`).
+"""
+import json
+from functools import partial
+
+import numpy as np
+from rasterio.windows import Window
+
+from ..preprocess.feature_store import quantize
+
+
+def draw_sample_coords(
+    labels, n_samples, rng, stratify=False, nodata=None, block_rows=1024
+):
+    """Draw pixel coordinates from a label raster.
+
+    The raster is scanned twice in blocks of ``block_rows`` rows (once to
+    count the classes, once to locate the drawn pixels), so no index array
+    of the full raster is created.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        ``(height, width)`` raster of non-negative integer labels.
+    n_samples : int
+        Number of pixels to draw. With ``stratify`` each class receives
+        ``n_samples // n_classes`` pixels (or all of its pixels if fewer).
+    rng : np.random.Generator
+        Random generator.
+    stratify : bool, optional
+        Draw the same number of pixels from every class.
+    nodata : int, optional
+        Label value excluded from sampling.
+    block_rows : int, optional
+        Rows scanned at a time.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        ``(rows, cols)`` in raster order.
+    """
+    height, width = labels.shape
+    n_classes = int(labels.max()) + 1 if labels.size else 0
+    starts = range(0, height, block_rows)
+    counts = np.array(
+        [np.bincount(labels[r : r + block_rows].ravel(), minlength=n_classes) for r in starts]
+    ).reshape(len(starts), n_classes)
+    if nodata is not None and 0 <= nodata < n_classes:
+        counts[:, nodata] = 0
+
+    if stratify:
+        groups = [[c] for c in np.flatnonzero(counts.sum(axis=0))]
+        n_per_group = n_samples // max(len(groups), 1)
+    else:
+        groups = [list(np.flatnonzero(counts.sum(axis=0)))]
+        n_per_group = n_samples
+
+    found = []
+    for group in groups:
+        cum = np.concatenate([[0], np.cumsum(counts[:, group].sum(axis=1))])
+        size = min(n_per_group, int(cum[-1]))
+        if size == 0:
+            continue
+        ranks = np.sort(rng.choice(int(cum[-1]), size=size, replace=False))
+        split = np.searchsorted(ranks, cum)
+        for b, row in enumerate(starts):
+            block_ranks = ranks[split[b] : split[b + 1]]
+            if block_ranks.size == 0:
+                continue
+            block = labels[row : row + block_rows]
+            pos = np.flatnonzero(np.isin(block, group))[block_ranks - cum[b]]
+            found.append(pos + row * width)
+    flat = np.sort(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+    return np.divmod(flat, width)
+
+
+def read_sample_features(
+    read_block, feature_set, height, width, rows, cols, tile=256, quantization=None
+):
+    """Compute features for individual pixels from windowed band reads.
+
+    The samples are grouped by ``tile`` x ``tile`` tiles and for every tile
+    holding samples only the window spanning its samples (plus the halo
+    needed by neighbourhood features) is read, so the values equal those of
+    a full-scene feature file.
+
+    Parameters
+    ----------
+    read_block : callable
+        ``read_block(window)`` returning the masked ``(bands, rows, cols)``
+        block, e.g. :meth:`src.preprocess.blockwise.BandBlockReader.read`.
+    feature_set : FeatureSet
+        Features to compute.
+    height, width : int
+        Raster size.
+    rows, cols : np.ndarray
+        Pixel coordinates.
+    tile : int, optional
+        Tile edge length used to group the reads.
+    quantization : tuple, optional
+        ``(scale, offset)`` to return int16 codes as in a quantized store.
+
+    Returns
+    -------
+    np.ndarray
+        ``(n_samples, n_features)`` array.
+    """
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    dtype = np.int16 if quantization is not None else np.float32
+    X = np.empty((rows.size, len(feature_set)), dtype=dtype)
+    if rows.size == 0:
+        return X
+    halo = feature_set.halo
+    key = (rows // tile) * (-(-width // tile)) + cols // tile
+    order = np.argsort(key, kind="stable")
+    bounds = np.flatnonzero(np.diff(key[order])) + 1
+    for group in np.split(order, bounds):
+        r, c = rows[group], cols[group]
+        r0, r1 = max(int(r.min()) - halo, 0), min(int(r.max()) + 1 + halo, height)
+        c0, c1 = max(int(c.min()) - halo, 0), min(int(c.max()) + 1 + halo, width)
+        features = feature_set.compute(read_block(Window(c0, r0, c1 - c0, r1 - r0)))
+        values = features[:, r - r0, c - c0]
+        if quantization is not None:
+            values = quantize(values, *quantization)
+        X[group] = values.T
+    return X
+
+
+def read_cube_sample_features(cube, date, feature_set, rows, cols, tile=256, quantization=None):
+    """Compute features for individual pixels of one date of a datacube.
+
+    Per-pixel features are computed from the values of the sampled pixels
+    only (:meth:`src.utils.datacube.DataCube.masked_pixels`), so just the
+    chunks holding samples are touched. Neighbourhood features need their
+    surroundings and fall back to the windowed reads of
+    :func:`read_sample_features`. Parameters and result as there, with
+    ``cube`` a :class:`~src.utils.datacube.DataCube` and ``date`` one of its
+    dates.
+    """
+    if feature_set.halo:
+        read_block = partial(cube.masked_window, date)
+        return read_sample_features(
+            read_block, feature_set, cube.height, cube.width, rows, cols, tile, quantization
+        )
+    values = feature_set.compute(cube.masked_pixels(date, rows, cols))
+    if quantization is not None:
+        values = quantize(values, *quantization)
+    return np.ascontiguousarray(values.T)
+
+
+def save_sample_table(path, X, y, region, rows, cols, info):
+    """Write a sample table, see the module docstring for the layout."""
+    np.savez(
+        path,
+        X=X,
+        y=y,
+        region=np.asarray(region, dtype=np.int16),
+        rows=np.asarray(rows, dtype=np.int32),
+        cols=np.asarray(cols, dtype=np.int32),
+        info=np.array(json.dumps(info)),
+    )
+
+
+def load_sample_table(path):
+    """Load a sample table into a dict with its ``info`` decoded."""
+    with np.load(path) as data:
+        table = {k: data[k] for k in data.files}
+    table["info"] = json.loads(str(table["info"]))
+    return table
+
+
+class ClassReservoir:
+    """Uniform per-class samples from a stream of labelled pixels.
+
+    Every pixel gets a random key and each class keeps the pixels with the
+    smallest keys up to its cap, which is a uniform sample without
+    replacement of all pixels of that class seen so far. Only the kept
+    samples are held in memory, so regions and blocks can be streamed.
+
+    Parameters
+    ----------
+    caps : dict or callable
+        Maximum number of samples per class, as a ``{class: cap}`` dict or a
+        function ``cap(class)``. A cap of 0 skips the class.
+    n_features : int
+        Number of feature columns.
+    dtype : dtype
+        Feature dtype.
+    rng : np.random.Generator
+        Random generator.
+    """
+
+    def __init__(self, caps, n_features, dtype, rng):
+        self._cap = caps if callable(caps) else (lambda c: caps.get(c, 0))
+        self.n_features = n_features
+        self.dtype = np.dtype(dtype)
+        self.rng = rng
+        self.seen = {}
+        self._kept = {}
+
+    def add(self, X, y, region, rows, cols):
+        """Offer ``(n, n_features)`` samples with their labels and positions."""
+        keys = self.rng.random(y.size)
+        for cls in np.unique(y):
+            cls = int(cls)
+            self.seen[cls] = self.seen.get(cls, 0) + int(np.count_nonzero(y == cls))
+            cap = self._cap(cls)
+            if cap <= 0:
+                continue
+            pick = np.flatnonzero(y == cls)
+            kept = self._kept.get(cls)
+            if kept is not None and kept["key"].size >= cap:
+                # only keys below the current cap-th smallest can enter
+                pick = pick[keys[pick] < kept["key"].max()]
+                if pick.size == 0:
+                    continue
+            new = {
+                "key": keys[pick],
+                "X": X[pick],
+                "region": np.full(pick.size, region, dtype=np.int16),
+                "rows": rows[pick],
+                "cols": cols[pick],
+            }
+            if kept is not None:
+                new = {k: np.concatenate([kept[k], new[k]]) for k in new}
+            if new["key"].size > cap:
+                keep = np.argpartition(new["key"], cap - 1)[:cap]
+                new = {k: v[keep] for k, v in new.items()}
+            self._kept[cls] = new
+
+    @property
+    def kept(self):
+        """Number of samples currently held per class."""
+        return {cls: int(v["key"].size) for cls, v in self._kept.items()}
+
+    def table(self):
+        """Return ``(X, y, region, rows, cols)`` sorted by position."""
+        classes = sorted(self._kept)
+        parts = [self._kept[c] for c in classes]
+        if not parts:
+            empty = np.empty(0, dtype=np.int32)
+            return np.empty((0, self.n_features), self.dtype), empty, empty, empty, empty
+        y = np.concatenate([np.full(p["key"].size, c) for c, p in zip(classes, parts)])
+        region, rows, cols = (np.concatenate([p[k] for p in parts]) for k in ("region", "rows", "cols"))
+        order = np.lexsort((cols, rows, region))
+        X = np.concatenate([p["X"] for p in parts])
+        return X[order], y[order], region[order], rows[order], cols[order]
+
+
+def reservoir_sample_stores(stores, label_readers, reservoir, block_rows=512):
+    """Stream feature stores and label rasters into a :class:`ClassReservoir`.
+
+    Parameters
+    ----------
+    stores : list of FeatureStore
+        Feature store of each region.
+    label_readers : list of rasterio dataset
+        Label raster of each region; pixels equal to its ``nodata`` are
+        skipped, as are pixels with invalid features.
+    reservoir : ClassReservoir
+        Receives the valid pixels of every block.
+    block_rows : int, optional
+        Rows read at a time.
+    """
+    for r, (store, labels_src) in enumerate(zip(stores, label_readers)):
+        _, height, width = store.shape
+        if (labels_src.height, labels_src.width) != (height, width):
+            raise ValueError(
+                f"Labels of region {r} have shape {(labels_src.height, labels_src.width)}, "
+                f"features {(height, width)}"
+            )
+        for row in range(0, height, block_rows):
+            window = Window(0, row, width, min(block_rows, height - row))
+            block = store.read_window(window)
+            labels = labels_src.read(1, window=window)
+            valid = store.valid_mask(block)
+            if labels_src.nodata is not None:
+                valid &= labels != labels_src.nodata
+            rr, cc = np.nonzero(valid)
+            reservoir.add(block[:, rr, cc].T, labels[rr, cc], r, rr + row, cc)
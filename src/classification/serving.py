@@ -0,0 +1,159 @@
+"""Request batching and latency statistics for a resident prediction service.
+
+:class:`PredictionBatcher` runs one model in a background thread. Request
+threads submit ``(n, features)`` rows and wait for their labels; the worker
+collects everything queued within ``max_wait_ms`` (up to
+``max_batch_rows`` rows) and classifies it with a single ``predict`` call,
+so many small requests share the per-call overhead of the forest.
+:class:`BatchedModel` wraps a batcher in the ``predict`` interface, so the
+tiled :func:`src.classification.predict.predict_model` and
+:func:`src.classification.predict.predict_block` can be used unchanged.
+"""
+import bisect
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+# upper bucket bounds of the latency histograms in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf"))
+
+
+class Histogram:
+    """Thread-safe histogram (latencies by default) with recent percentiles."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS, unit="ms", keep=10000):
+        self.buckets = tuple(buckets)
+        self.unit = unit
+        self.counts = [0] * len(self.buckets)
+        self.recent = deque(maxlen=keep)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.recent.append(value)
+            self.total += value
+
+    def summary(self):
+        """Counts per bucket (``le_<bound>``) and mean/p50/p90/p99."""
+        with self._lock:
+            n = sum(self.counts)
+            recent = np.array(self.recent)
+            counts = list(self.counts)
+            total = self.total
+        out = {"count": n, f"mean_{self.unit}": total / n if n else None}
+        for q in (50, 90, 99):
+            out[f"p{q}_{self.unit}"] = float(np.percentile(recent, q)) if recent.size else None
+        out["buckets"] = {f"le_{b:g}": c for b, c in zip(self.buckets, counts)}
+        return out
+
+
+class PredictionBatcher:
+    """Classify rows from many threads in shared ``predict`` calls.
+
+    Parameters
+    ----------
+    clf : classifier
+        Fitted model with ``predict``.
+    max_batch_rows : int, optional
+        Rows classified per call at most; larger submissions are split.
+    max_wait_ms : float, optional
+        How long the worker waits for more requests after the first one.
+    """
+
+    def __init__(self, clf, max_batch_rows=262144, max_wait_ms=5.0):
+        self.clf = clf
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait_ms / 1000
+        self.batch_rows = Histogram((1, 1024, 16384, 65536, 262144, float("inf")), unit="rows")
+        self.batch_ms = Histogram()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, X):
+        """Queue ``(n, features)`` rows; the returned future yields their labels."""
+        futures = []
+        for start in range(0, max(len(X), 1), self.max_batch_rows):
+            future = Future()
+            self._queue.put((X[start : start + self.max_batch_rows], future))
+            futures.append(future)
+        if len(futures) == 1:
+            return futures[0]
+        combined = Future()
+
+        def done(_):
+            if all(f.done() for f in futures) and not combined.done():
+                try:
+                    combined.set_result(np.concatenate([f.result() for f in futures]))
+                except Exception as exc:  # propagate to the waiting request
+                    combined.set_exception(exc)
+
+        for f in futures:
+            f.add_done_callback(done)
+        return combined
+
+    def predict(self, X):
+        return self.submit(X).result()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            rows = len(items[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while rows < self.max_batch_rows:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                items.append(item)
+                rows += len(item[0])
+            self._predict_batch(items)
+
+    def _predict_batch(self, items):
+        # rows of different widths cannot be stacked; predict them separately
+        groups = {}
+        for item in items:
+            groups.setdefault(np.shape(item[0])[1:], []).append(item)
+        for group in groups.values():
+            self._predict_group(group)
+
+    def _predict_group(self, items):
+        start = time.perf_counter()
+        try:
+            nonempty = [X for X, _ in items if len(X)]
+            preds = self.clf.predict(np.concatenate(nonempty)) if nonempty else np.empty(0)
+        except Exception as exc:
+            if len(items) > 1:
+                # retry one by one so only the offending request fails
+                for item in items:
+                    self._predict_group([item])
+                return
+            items[0][1].set_exception(exc)
+            return
+        self.batch_ms.add((time.perf_counter() - start) * 1000)
+        self.batch_rows.add(sum(len(X) for X, _ in items))
+        pos = 0
+        for X, future in items:
+            future.set_result(preds[pos : pos + len(X)])
+            pos += len(X)
+
+
+class BatchedModel:
+    """``predict`` through a :class:`PredictionBatcher`, for tiled prediction."""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.feature_encoding_ = getattr(batcher.clf, "feature_encoding_", None)
+        self.n_features_in_ = getattr(batcher.clf, "n_features_in_", None)
+
+    def predict(self, X):
+        return self.batcher.predict(X)
@@ -1,5 +1,201 @@
+import math
+import os
+import time
+
 import numpy as np
-from sklearn.ensemble import RandomForestClassifier
+from joblib import parallel_config
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from threadpoolctl import threadpool_limits
+
+# approximate size of one sklearn tree node without its class values
+NODE_BYTES = 64
+
+# name -> (factory, parameter holding the number of trees/iterations,
+# whether memory_budget_mb applies). Factories take the common training
+# parameters plus model specific ``model_params``.
+MODELS = {}
+
+
+def register_model(name, size_param, budgeted=False):
+    """Register a classifier factory selectable by ``model_type``."""
+
+    def decorator(fn):
+        MODELS[name] = (fn, size_param, budgeted)
+        return fn
+
+    return decorator
+
+
+@register_model("random_forest", "n_estimators", budgeted=True)
+def _random_forest(n_estimators, random_state, max_depth, max_samples, verbose, **params):
+    return RandomForestClassifier(
+        n_estimators=n_estimators,
+        random_state=random_state,
+        max_depth=max_depth,
+        max_samples=max_samples,
+        verbose=verbose,
+        **params,
+    )
+
+
+@register_model("hist_gradient_boosting", "max_iter")
+def _hist_gradient_boosting(n_estimators, random_state, max_depth, max_samples, verbose, **params):
+    # n_estimators is the number of boosting iterations (one tree per class
+    # each); max_samples does not apply
+    return HistGradientBoostingClassifier(
+        max_iter=n_estimators,
+        random_state=random_state,
+        max_depth=max_depth,
+        verbose=verbose,
+        **params,
+    )
+
+
+class TrainingBackend:
+    """How a model is fitted: parallelism, memory budget and progress.
+
+    Parameters
+    ----------
+    n_jobs : int or None, optional
+        Trees fitted in parallel; ``-1`` uses all cores. For models without
+        ``n_jobs`` (gradient boosting) it limits the OpenMP threads.
+    parallelism : {"threads", "processes"}, optional
+        Fit trees in threads (shared memory, default) or in worker
+        processes (large arrays are memory-mapped into the workers).
+    memory_budget_mb : float or None, optional
+        Peak memory allowed for the training data, the per-job working
+        arrays and the fitted forest. ``max_samples`` (``max_depth``
+        without bootstrap) is lowered so that fully grown trees fit into
+        it, see :meth:`limit`.
+    progress_every : int or None, optional
+        Fit the model in chunks of this many trees or iterations (warm
+        start) and report the time of every chunk. Chunks smaller than
+        ``n_jobs`` limit the parallel speed-up of forests.
+    """
+
+    def __init__(self, n_jobs=None, parallelism="threads", memory_budget_mb=None, progress_every=None):
+        if parallelism not in {"threads", "processes"}:
+            raise ValueError(f"parallelism must be 'threads' or 'processes', not '{parallelism}'")
+        self.n_jobs = n_jobs
+        self.parallelism = parallelism
+        self.memory_budget_mb = memory_budget_mb
+        self.progress_every = progress_every
+
+    @classmethod
+    def from_config(cls, cfg):
+        """Backend from the ``n_jobs``/``parallelism``/``memory_budget_mb``/``progress_every`` keys."""
+        return cls(
+            n_jobs=cfg.get("n_jobs"),
+            parallelism=cfg.get("parallelism", "threads"),
+            memory_budget_mb=cfg.get("memory_budget_mb"),
+            progress_every=cfg.get("progress_every"),
+        )
+
+    @property
+    def effective_jobs(self):
+        if self.n_jobs is None:
+            return 1
+        if self.n_jobs < 0:
+            return max((os.cpu_count() or 1) + 1 + self.n_jobs, 1)
+        return self.n_jobs
+
+    def limit(
+        self, n_samples, n_features, n_classes, n_estimators, max_samples, max_depth, bootstrap=True
+    ):
+        """Return ``(max_samples, max_depth, limited)`` lowered to fit the memory budget.
+
+        A fully grown tree has at most ``2 * samples - 1`` nodes, so lowering
+        ``max_samples`` bounds every tree without changing how it grows.
+        Only without bootstrap, where ``max_samples`` does not apply, is
+        ``max_depth`` capped instead (to the depth of a balanced tree with
+        the allowed number of nodes). ``limited`` lists the parameters that
+        were lowered.
+        """
+        if self.memory_budget_mb is None:
+            return max_samples, max_depth, []
+        budget = self.memory_budget_mb * 2**20
+        # float32 copy of X made by sklearn plus per-job index/weight arrays
+        data_bytes = n_samples * n_features * 4 + self.effective_jobs * n_samples * 24
+        node_bytes = NODE_BYTES + 8 * n_classes
+        nodes = (budget - data_bytes) / (n_estimators * node_bytes)
+        if nodes < 3:
+            raise MemoryError(
+                f"memory_budget_mb={self.memory_budget_mb} is too small for "
+                f"{n_samples} samples and {n_estimators} trees"
+            )
+        if not bootstrap or max_samples is None:
+            per_tree = n_samples
+        elif isinstance(max_samples, float):
+            per_tree = max(int(round(max_samples * n_samples)), 1)
+        else:
+            per_tree = int(max_samples)
+        limited = []
+        # a fully grown tree has at most 2 * samples - 1 nodes
+        if 2 * per_tree - 1 <= nodes:
+            return max_samples, max_depth, limited
+        if bootstrap:
+            max_samples = max(int((nodes + 1) // 2), 1)
+            limited.append("max_samples")
+        else:
+            depth_cap = int(math.log2(nodes + 1)) - 1
+            if max_depth is None or max_depth > depth_cap:
+                max_depth = depth_cap
+                limited.append("max_depth")
+        return max_samples, max_depth, limited
+
+    def fit(
+        self, clf, X, y, sample_weight=None, verbose=0, size_param="n_estimators", warm_start=False
+    ):
+        """Fit ``clf`` and record the time per chunk of trees in ``clf.training_log_``.
+
+        With ``warm_start`` the trees already in ``clf`` are kept and only the
+        missing ones up to its ``size_param`` are fitted on ``X``.
+        """
+        total = clf.get_params()[size_param]
+        first = len(getattr(clf, "estimators_", ())) if warm_start else 0
+        step = self.progress_every or total - first
+        backend = "threading" if self.parallelism == "threads" else "loky"
+        threads = self.effective_jobs if self.n_jobs is not None else None
+        log = []
+        with parallel_config(backend=backend), threadpool_limits(limits=threads):
+            if "n_jobs" in clf.get_params():
+                clf.set_params(n_jobs=self.n_jobs)
+            clf.set_params(warm_start=warm_start or step < total)
+            # warm start draws the same per-tree seeds as a single fit
+            for n in range(min(first + step, total), total + step, step):
+                n = min(n, total)
+                start = time.perf_counter()
+                clf.set_params(**{size_param: n})
+                clf.fit(X, y, sample_weight=sample_weight)
+                seconds = time.perf_counter() - start
+                log.append({"trees": n, "seconds": round(seconds, 3)})
+                if step < total - first or verbose:
+                    done = n - (log[-2]["trees"] if len(log) > 1 else first)
+                    print(f"trees {n}/{total}: {seconds:.2f}s ({seconds / done:.3f}s/tree)")
+                if n == total:
+                    break
+        clf.set_params(warm_start=False)
+        clf.training_log_ = log
+        return clf
+
+
+def valid_samples(X, nodata=None):
+    """Rows of ``X`` ``(n_samples, n_features)`` without invalid values."""
+    if nodata is None:
+        return ~np.isnan(X).any(axis=1)
+    return (X != nodata).all(axis=1)
+
+
+def _training_rows(features, labels, nodata, sample_weight, assume_valid=False):
+    X = features.reshape(features.shape[0], -1).T
+    if assume_valid:
+        # views of (possibly memory-mapped) prepared rows, not copies
+        return X, np.asarray(labels).reshape(-1), sample_weight
+    y = labels.flatten()
+    mask = valid_samples(X, nodata)
+    if sample_weight is not None:
+        sample_weight = np.asarray(sample_weight).ravel()[mask]
+    return X[mask], y[mask], sample_weight
 
 
 def train_model(
@@ -10,8 +206,14 @@ def train_model(
     max_depth=None,
     max_samples=None,
     verbose=0,
+    nodata=None,
+    sample_weight=None,
+    backend=None,
+    model_type="random_forest",
+    model_params=None,
+    assume_valid=False,
 ):
-    """Train a RandomForest model.
+    """Train a classifier, a RandomForest by default.
 
     Parameters
     ----------
@@ -21,27 +223,95 @@ def train_model(
     labels : np.ndarray
         Corresponding label raster or array.
     n_estimators : int, optional
-        Number of trees in the forest.
+        Number of trees in the forest (boosting iterations for
+        ``hist_gradient_boosting``).
     random_state : int, optional
-        Seed for the ``RandomForestClassifier``.
+        Seed of the classifier.
     max_depth : int or None, optional
         Maximum depth of the trees.
     max_samples : int, float or None, optional
         Number or fraction of samples to draw for training each tree.
     verbose : int, optional
-        Verbosity level for ``RandomForestClassifier``.
+        Verbosity level of the classifier.
+    nodata : int or float, optional
+        Value marking invalid samples, e.g. for quantized int16 features.
+        ``None`` drops samples containing NaN.
+    sample_weight : np.ndarray, optional
+        Weight of each sample, e.g. the counts of deduplicated rows from
+        :func:`src.classification.dedup.dedup_samples`.
+    backend : TrainingBackend, optional
+        Parallelism, memory budget and progress reporting; defaults to a
+        single job without a budget.
+    model_type : str, optional
+        Name of a model in :data:`MODELS`.
+    model_params : dict, optional
+        Extra keyword arguments for the model, e.g. ``learning_rate``.
+    assume_valid : bool, optional
+        ``features`` are ``(bands, n_samples)`` rows known to be valid, such
+        as prepared cached samples; they are used as they are instead of
+        being filtered into a copy.
     """
-    X = features.reshape(features.shape[0], -1).T
-    y = labels.flatten()
-    mask = ~np.isnan(X).any(axis=1)
-    X = X[mask]
-    y = y[mask]
-    clf = RandomForestClassifier(
-        n_estimators=n_estimators,
-        random_state=random_state,
-        max_depth=max_depth,
-        max_samples=max_samples,
-        verbose=verbose,
+    X, y, sample_weight = _training_rows(features, labels, nodata, sample_weight, assume_valid)
+    if model_type not in MODELS:
+        raise ValueError(f"Unknown model_type '{model_type}'. Use one of {sorted(MODELS)}")
+    factory, size_param, budgeted = MODELS[model_type]
+    backend = backend or TrainingBackend()
+    model_params = model_params or {}
+    limited = []
+    if budgeted:
+        max_samples, max_depth, limited = backend.limit(
+            y.size, X.shape[1], np.unique(y).size, n_estimators, max_samples, max_depth,
+            bootstrap=model_params.get("bootstrap", True),
+        )
+    clf = factory(n_estimators, random_state, max_depth, max_samples, verbose, **model_params)
+    clf = backend.fit(
+        clf, X, y, sample_weight=sample_weight, verbose=verbose, size_param=size_param
+    )
+    clf.budget_limits_ = limited
+    return clf
+
+
+def add_trees(
+    clf,
+    features,
+    labels,
+    n_estimators,
+    verbose=0,
+    nodata=None,
+    sample_weight=None,
+    backend=None,
+):
+    """Grow ``n_estimators`` more trees of a fitted RandomForest on new samples.
+
+    The existing trees are kept unchanged (warm start), so the cost depends
+    only on the new samples. Every tree votes on the same classes, hence the
+    samples must contain exactly the classes of ``clf``; mix in a few samples
+    of the previous training data to keep rare classes present.
+
+    Parameters
+    ----------
+    clf : RandomForestClassifier
+        Fitted forest, updated in place and returned.
+    features, labels, verbose, nodata, sample_weight, backend
+        As for :func:`train_model`.
+    n_estimators : int
+        Number of trees to add.
+    """
+    if not isinstance(clf, RandomForestClassifier):
+        raise TypeError(f"Trees can only be added to a RandomForest, not {type(clf).__name__}")
+    X, y, sample_weight = _training_rows(features, labels, nodata, sample_weight)
+    classes = np.unique(y)
+    if not np.array_equal(classes, clf.classes_):
+        raise ValueError(
+            f"New samples have classes {classes.tolist()} but the model was trained on "
+            f"{clf.classes_.tolist()}; retrain the model from scratch"
+        )
+    backend = backend or TrainingBackend()
+    total = len(clf.estimators_) + n_estimators
+    max_samples, max_depth, limited = backend.limit(
+        y.size, X.shape[1], classes.size, total, clf.max_samples, clf.max_depth, clf.bootstrap
     )
-    clf.fit(X, y)
+    clf.set_params(n_estimators=total, max_samples=max_samples, max_depth=max_depth, verbose=verbose)
+    clf = backend.fit(clf, X, y, sample_weight=sample_weight, verbose=verbose, warm_start=True)
+    clf.budget_limits_ = limited
     return clf
@@ -11,9 +11,14 @@ def main() -> None:
     parser.add_argument(
         "--input-dir", required=True, help="Directory containing dated scenes"
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun even if a scene's inputs are unchanged since the last run",
+    )
     args = parser.parse_args()
 
-    apply_cloud_mask_to_directory(Path(args.input_dir))
+    apply_cloud_mask_to_directory(Path(args.input_dir), force=args.force)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,15 @@
 import argparse
 from pathlib import Path
 
-from ..utils.mosaic import mosaic_sentinel_directory
+from ..utils.datacube import CUBE_DIR
+from ..utils.manifest import SUFFIX, StageCache, scene_files
+from ..utils.mosaic import (
+    COMPOSITE_METHODS,
+    INCREMENTAL_METHODS,
+    STATE_DIR,
+    mosaic_sentinel_directory,
+    update_mosaic_incremental,
+)
 
 
 def main() -> None:
@@ -12,12 +20,78 @@ def main() -> None:
         "--input-dir", required=True, help="Directory containing dated scenes"
     )
     parser.add_argument(
-        "--method", default="best", choices=["best", "median"],
+        "--method", default="best", choices=sorted(COMPOSITE_METHODS),
         help="Pixel compositing strategy"
     )
+    parser.add_argument(
+        "--from-datacube",
+        action="store_true",
+        help="Read scenes from the datacube built by src.utils.datacube",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only composite scene folders added since the previous incremental run "
+        "(--method best or median)",
+    )
+    parser.add_argument(
+        "--max-samples",
+        type=int,
+        default=16,
+        help="Per-pixel sample buffer size for incremental median compositing",
+    )
+    parser.add_argument(
+        "--split-bands",
+        action="store_true",
+        help="Also write one GeoTIFF per band next to BANDS.tif",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun even if the scenes are unchanged since the last run",
+    )
     args = parser.parse_args()
+    if args.incremental and args.method not in INCREMENTAL_METHODS:
+        parser.error(
+            f"--incremental supports --method {' or '.join(INCREMENTAL_METHODS)}, not {args.method}"
+        )
+
+    input_dir = Path(args.input_dir)
+    if args.from_datacube:
+        inputs = sorted((input_dir / CUBE_DIR).glob("*"))
+    else:
+        inputs = scene_files(input_dir, {"BANDS.tif", "SCL.tif", "MASK.tif"})
+    outputs = [input_dir / "BANDS.tif"]
+    if args.incremental:
+        outputs.append(input_dir / STATE_DIR / "state.json")
+    cache = StageCache(
+        input_dir / f"mosaic{SUFFIX}",
+        "mosaic",
+        inputs=[*inputs, input_dir / "download.yaml"],
+        config={
+            k: getattr(args, k)
+            for k in ("method", "from_datacube", "incremental", "max_samples", "split_bands")
+        },
+        outputs=outputs,
+    )
+    if cache.skip(args.force):
+        return
 
-    mosaic_sentinel_directory(Path(args.input_dir), method=args.method)
+    if args.incremental:
+        update_mosaic_incremental(
+            input_dir,
+            method=args.method,
+            max_samples=args.max_samples,
+            split_bands=args.split_bands,
+        )
+    else:
+        mosaic_sentinel_directory(
+            input_dir,
+            method=args.method,
+            use_datacube=args.from_datacube,
+            split_bands=args.split_bands,
+        )
+    cache.record()
 
 
 if __name__ == "__main__":
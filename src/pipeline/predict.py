@@ -1,20 +1,27 @@
 import argparse
+import contextlib
 import json
 import joblib
+import os
 import shutil
+import time
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import rasterio
 import yaml
-
-from ..classification.predict import predict_model
-from ..preprocess.cloudmask import cloud_mask
-from ..preprocess.stack_bands import stack_bands
-from ..preprocess.features import compute_features
-from .preprocess import split_band_stack
-from ..utils.morph_difference import apply_morphology, save_highlight_rgba
+from rasterio.windows import Window
+
+from ..classification.flat_forest import SUFFIX as FLAT_SUFFIX, FlatForest
+from ..classification.metrics import ConfusionAccumulator, metrics_from_confusion
+from ..classification.predict import iter_tiles, predict_model
+from ..preprocess.blockwise import BandBlockReader, compute_window
+from ..preprocess.feature_store import QUANTIZED_NODATA, FeatureStore, quantization_params, quantize
+from ..preprocess.features import DEFAULT_INDICES, REFLECTANCE_SCALE, FeatureSet
+from .preprocess import resolve_band_inputs
+from ..utils.manifest import SUFFIX, StageCache
+from ..utils.morph_difference import apply_morphology, highlight_rgba_from_mask
 import errno
 
 
@@ -24,101 +31,6 @@ def _safe_divide(numerator: float, denominator: float) -> Optional[float]:
     return float(numerator) / float(denominator)
 
 
-def _compute_core_metrics(
-    predictions: np.ndarray, labels: np.ndarray
-) -> Optional[Dict[str, object]]:
-    # Treat label value 0 as background / nodata and exclude it from evaluation.
-    valid_mask = labels > 0
-    if not np.any(valid_mask):
-        return None
-
-    pred_flat = predictions[valid_mask].ravel()
-    label_flat = labels[valid_mask].ravel()
-
-    positive_labels = {int(c) for c in np.unique(label_flat) if c > 0}
-    positive_preds = {int(c) for c in np.unique(pred_flat) if c > 0}
-    class_id_set = positive_labels | positive_preds
-    has_unclassified = np.any(pred_flat <= 0)
-    if has_unclassified:
-        class_id_set.add(0)
-
-    if not class_id_set:
-        return None
-
-    class_ids = sorted(class_id_set)
-    class_to_index = {cls: idx for idx, cls in enumerate(class_ids)}
-    matrix = np.zeros((len(class_ids), len(class_ids)), dtype=int)
-
-    for true_val, pred_val in zip(label_flat, pred_flat):
-        true_cls = int(true_val)
-        if true_cls <= 0:
-            continue
-        pred_cls = int(pred_val) if int(pred_val) > 0 else 0 if has_unclassified else int(pred_val)
-        matrix[class_to_index[true_cls], class_to_index[pred_cls]] += 1
-
-    totals = label_flat.size
-    if totals == 0:
-        return None
-
-    diagonal = np.diag(matrix)
-    row_sums = matrix.sum(axis=1)
-    col_sums = matrix.sum(axis=0)
-
-    producer_accuracy: Dict[str, Optional[float]] = {}
-    user_accuracy: Dict[str, Optional[float]] = {}
-    f1_per_class: Dict[str, Optional[float]] = {}
-
-    eval_indices = [i for i, cls in enumerate(class_ids) if cls > 0]
-
-    for idx in eval_indices:
-        cls = class_ids[idx]
-        recall = _safe_divide(diagonal[idx], row_sums[idx])
-        precision = _safe_divide(diagonal[idx], col_sums[idx])
-
-        producer_accuracy[str(cls)] = recall
-        user_accuracy[str(cls)] = precision
-
-        if recall is None or precision is None:
-            f1_per_class[str(cls)] = None
-        elif recall == 0 and precision == 0:
-            f1_per_class[str(cls)] = 0.0
-        else:
-            f1_per_class[str(cls)] = 2 * precision * recall / (precision + recall)
-
-    f1_values = [v for v in f1_per_class.values() if v is not None]
-    macro_f1 = _safe_divide(sum(f1_values), len(f1_values)) if f1_values else None
-
-    correct = sum(int(diagonal[idx]) for idx in eval_indices)
-    overall_accuracy = _safe_divide(correct, totals)
-
-    producer_accuracy = {
-        cls: (float(val) if val is not None else None)
-        for cls, val in producer_accuracy.items()
-    }
-    user_accuracy = {
-        cls: (float(val) if val is not None else None)
-        for cls, val in user_accuracy.items()
-    }
-    f1_per_class = {
-        cls: (float(val) if val is not None else None)
-        for cls, val in f1_per_class.items()
-    }
-
-    classes = [int(cls) for cls in class_ids]
-    overall_accuracy = overall_accuracy if overall_accuracy is None else float(overall_accuracy)
-    macro_f1 = macro_f1 if macro_f1 is None else float(macro_f1)
-
-    return {
-        "classes": classes,
-        "confusion_matrix": matrix.tolist(),
-        "overall_accuracy": overall_accuracy,
-        "producer_accuracy": producer_accuracy,
-        "user_accuracy": user_accuracy,
-        "f1_per_class": f1_per_class,
-        "macro_f1": macro_f1,
-    }
-
-
 def _load_model_safely(model_path: Path):
     """
     Load a potentially large joblib model while providing clearer diagnostics when
@@ -127,6 +39,9 @@ def _load_model_safely(model_path: Path):
     exceptions so the caller can surface a readable message instead of the
     interpreter being killed by the OS OOM killer.
     """
+    if model_path.suffix == FLAT_SUFFIX:
+        # flat forest exported by src.pipeline.train (export_flat)
+        return FlatForest.open(model_path)
     model_path_str = str(model_path)
     try:
         return joblib.load(model_path_str, mmap_mode="r")
@@ -164,128 +79,300 @@ def _load_model_safely(model_path: Path):
         raise
 
 
-def main() -> None:
-    parser = argparse.ArgumentParser(description="Run model inference")
-    parser.add_argument("--config", required=True, help="YAML config file")
-    parser.add_argument("--input-dir", required=True, help="Directory containing the dataset")
-    parser.add_argument("--model-dir", required=True, help="Directory with trained model")
-    parser.add_argument("--output-dir", required=True, help="Directory for prediction result")
-    args = parser.parse_args()
-
-    with open(args.config) as f:
-        cfg = yaml.safe_load(f)
-
-    input_dir = Path(args.input_dir)
-    model_dir = Path(args.model_dir)
-    output_dir = Path(args.output_dir)
+def _region_cache(cfg: dict, input_dir: Path, output_dir: Path, model_path: Path) -> StageCache:
+    features_path = input_dir / "preprocess" / cfg["features"]
+    if features_path.exists():
+        inputs = [features_path]
+    else:
+        bands, indexes, _, scl_path, mask_path = resolve_band_inputs(cfg, input_dir)
+        inputs = [p for p in (*(bands if indexes is None else [bands]), scl_path, mask_path) if p]
+    return StageCache(
+        output_dir / f"predict{SUFFIX}",
+        "predict",
+        inputs=[*inputs, model_path, input_dir / cfg.get("labels", "labels.tif")],
+        config=cfg,
+        outputs=[output_dir / "prediction.tif"]
+        + ([output_dir / "confidence.tif"] if cfg.get("confidence") else []),
+    )
+
+
+def _evaluate_prediction(
+    pred_path: Path,
+    labels_path: Path,
+    difference_path: Path,
+    tile_size: int,
+    erode_count: int,
+    dilate_count: int,
+) -> Optional[dict]:
+    """Compare ``pred_path`` with ``labels_path`` tile by tile.
+
+    Accumulates the metrics and writes a binary mismatch highlight layer to
+    ``difference_path`` for visual inspection. Tiles are read with a halo of
+    ``erode_count + dilate_count`` pixels, so the morphology matches that of
+    the whole scene while memory stays proportional to ``tile_size``.
+    Pixels predicted as 0 had invalid features and are not highlighted.
+    """
+    halo = max(erode_count, 0) + max(dilate_count, 0)
+    confusion = ConfusionAccumulator()
+    evaluated_pixels = mismatch_pixels = 0
+    with contextlib.ExitStack() as stack:
+        pred_src = stack.enter_context(rasterio.open(pred_path))
+        labels_src = stack.enter_context(rasterio.open(labels_path))
+        if labels_src.shape != pred_src.shape:
+            raise ValueError(
+                "Shape mismatch between predictions and labels: "
+                f"{pred_src.shape} vs {labels_src.shape}"
+            )
+        height, width = pred_src.shape
+        meta = pred_src.meta.copy()
+        meta.update(count=4, dtype="uint8")
+        meta.pop("nodata", None)
+        dst = stack.enter_context(rasterio.open(difference_path, "w", **meta))
+        for window in iter_tiles(height, width, tile_size):
+            outer = Window(
+                window.col_off - halo, window.row_off - halo,
+                window.width + 2 * halo, window.height + 2 * halo,
+            ).intersection(Window(0, 0, width, height))
+            predictions = pred_src.read(1, window=outer)
+            labels = labels_src.read(1, window=outer)
+            valid_diff_mask = labels_src.dataset_mask(window=outer) > 0
+            if labels_src.nodata is not None:
+                valid_diff_mask &= labels != labels_src.nodata
+            valid_diff_mask &= labels > 0
+            valid_diff_mask &= predictions > 0
+            mismatch_mask = (
+                predictions.astype(np.int32) != labels.astype(np.int32)
+            ) & valid_diff_mask
+            highlight_mask = apply_morphology(
+                mismatch_mask, valid_diff_mask, erode_count=erode_count, dilate_count=dilate_count
+            )
 
+            inner = (
+                slice(window.row_off - outer.row_off, window.row_off - outer.row_off + window.height),
+                slice(window.col_off - outer.col_off, window.col_off - outer.col_off + window.width),
+            )
+            confusion.add(predictions[inner], labels[inner])
+            dst.write(highlight_rgba_from_mask(highlight_mask[inner]), window=window)
+            dst.write_mask(np.where(valid_diff_mask[inner], 255, 0).astype(np.uint8), window=window)
+            evaluated_pixels += int(valid_diff_mask[inner].sum())
+            mismatch_pixels += int(highlight_mask[inner].sum())
+
+    metrics = confusion.metrics()
+    if metrics is not None:
+        metrics["difference_summary"] = {
+            "mismatch_pixels": mismatch_pixels,
+            "evaluated_pixels": evaluated_pixels,
+            "mismatch_rate": _safe_divide(mismatch_pixels, evaluated_pixels),
+        }
+    return metrics
+
+
+def predict_region(cfg: dict, clf, input_dir: Path, output_dir: Path) -> Optional[dict]:
+    """Predict one input directory into ``output_dir``.
+
+    Writes ``prediction.tif`` (plus ``confidence.tif`` with ``confidence``)
+    and, when labels exist, ``difference.tif`` and ``metrics.json``.
+    Returns the metrics or ``None`` without labels.
+    """
     difference_erode = int(cfg.get("difference_erode", 0))
     difference_dilate = int(cfg.get("difference_dilate", 0))
 
     features_path = input_dir / "preprocess" / cfg["features"]
-    feature_valid_mask = None
+    labels_path = input_dir / cfg.get("labels", "labels.tif")
+    out_path = output_dir / "prediction.tif"
+    # models trained by src.pipeline.train record their feature encoding
+    encoding = getattr(clf, "feature_encoding_", None)
+    tile_size = int(cfg.get("tile_size", 512))
+    n_workers = int(cfg.get("n_workers", 1))
+    confidence_path = output_dir / "confidence.tif" if cfg.get("confidence") else None
+    top_k = int(cfg.get("top_k", 0))
+    out_path.parent.mkdir(parents=True, exist_ok=True)
     if features_path.exists():
-        data = np.load(features_path)["features"]
         meta_path = (
             input_dir
             / "preprocess"
             / Path(cfg.get("meta", Path(cfg["features"]).with_suffix(".meta.json"))).name
         )
-        with open(meta_path) as f:
-            meta = json.load(f)
-        feature_valid_mask = np.all(np.isfinite(data), axis=0)
+        store = FeatureStore.open(features_path, meta_path)
+        if encoding is not None and store.encoding != encoding:
+            raise ValueError(
+                f"Features in {features_path} do not match the encoding the model "
+                f"was trained with: {store.encoding} vs {encoding}"
+            )
+        meta = store.profile
+        predict_model(
+            clf, store.data, meta, out_path, nodata=store.nodata,
+            tile_size=tile_size, n_workers=n_workers,
+            confidence_path=confidence_path, top_k=top_k, return_raster=False,
+        )
     else:
-        dl_cfg_path = input_dir / "download.yaml"
-        if dl_cfg_path.exists():
-            dl_cfg = yaml.safe_load(dl_cfg_path.read_text())
-            spectral = [b for b in dl_cfg.get("bands", []) if b not in {"SCL", "dataMask"}]
-            stack = input_dir / "BANDS.tif"
-            if stack.exists():
-                missing = [b for b in spectral if not (input_dir / f"{b}.tif").exists()]
-                if missing:
-                    split_band_stack(stack, spectral)
-            else:
-                raise ValueError("BANDS.tif not found in input directory")
-
-            bands = [input_dir / f"{b}.tif" for b in spectral]
-            scl_path = input_dir / "SCL.tif" if "SCL" in dl_cfg.get("bands", []) else input_dir / Path(cfg["scl"]).name
-            mask_path = (
-                input_dir / "MASK.tif"
-                if "dataMask" in dl_cfg.get("bands", [])
-                else input_dir / Path(cfg.get("mask", "")).name
-                if cfg.get("mask")
-                else None
+        bands, indexes, band_names, scl_path, mask_path = resolve_band_inputs(cfg, input_dir)
+        names = cfg.get("indices", DEFAULT_INDICES)
+        quantization = None
+        if encoding is not None:
+            # compute exactly the features the model was trained on
+            if "indices" in cfg and list(cfg["indices"]) != encoding["feature_names"]:
+                raise ValueError(
+                    f"indices {cfg['indices']} do not match the features the model "
+                    f"was trained with: {encoding['feature_names']}"
+                )
+            names = encoding["feature_names"]
+            if encoding.get("scale") is not None:
+                quantization = (encoding["scale"], encoding["offset"])
+        with BandBlockReader(bands, indexes, scl_path, mask_path) as reader:
+            feature_set = FeatureSet(
+                names,
+                band_names,
+                reflectance_scale=cfg.get("reflectance_scale", REFLECTANCE_SCALE),
+                band_dtype=reader.source_dtype,
             )
-        else:
-            bands = [input_dir / Path(p).name for p in cfg["bands"]]
-            scl_path = input_dir / Path(cfg["scl"]).name
-            mask_path = input_dir / Path(cfg.get("mask", "")).name if cfg.get("mask") else None
-
-        mask = cloud_mask(scl_path, mask_path)
-        stack, meta = stack_bands(bands, mask)
-        data = compute_features(stack, red_idx=2, nir_idx=3, swir_idx=4)
-        feature_valid_mask = np.all(np.isfinite(data), axis=0)
-
-    clf = _load_model_safely(model_dir / cfg["model"])
-    out_path = output_dir / "prediction.tif"
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    predictions = predict_model(clf, data, meta, out_path)
-
-    labels_path = input_dir / cfg.get("labels", "labels.tif")
-    if labels_path.exists():
-        label_dataset_mask = None
-        label_nodata = None
-        with rasterio.open(labels_path) as src:
-            labels = src.read(1)
-            label_dataset_mask = src.dataset_mask()
-            label_nodata = src.nodata
-
-        if labels.shape != predictions.shape:
-            raise ValueError(
-                "Shape mismatch between predictions and labels: "
-                f"{predictions.shape} vs {labels.shape}"
+            if quantization is not None and not np.allclose(
+                quantization_params(feature_set.value_ranges), quantization
+            ):
+                raise ValueError(
+                    f"Quantization of the features of {input_dir} (bands stored as "
+                    f"{reader.source_dtype}) does not match the encoding the model "
+                    f"was trained with: {encoding}"
+                )
+            meta = reader.meta
+            height, width = meta["height"], meta["width"]
+
+            # computed on the fly in this process, so n_workers does not apply
+            def read_features(window):
+                # features of each tile are computed from its band window
+                block = compute_window(
+                    reader.read, feature_set.compute, window, height, width, feature_set.halo
+                )
+                return block if quantization is None else quantize(block, *quantization)
+
+            predict_model(
+                clf, read_features, meta, out_path,
+                nodata=None if quantization is None else QUANTIZED_NODATA,
+                tile_size=tile_size, confidence_path=confidence_path, top_k=top_k,
+                return_raster=False,
             )
 
-        metrics = _compute_core_metrics(predictions, labels)
-
-        # Export a binary mismatch highlight layer for visual inspection.
-        difference_path = out_path.parent / "difference.tif"
-        valid_diff_mask = feature_valid_mask.copy() if feature_valid_mask is not None else np.ones_like(labels, dtype=bool)
-        if label_dataset_mask is not None and label_dataset_mask.size:
-            valid_diff_mask &= label_dataset_mask > 0
-        if label_nodata is not None:
-            valid_diff_mask &= labels != label_nodata
-        valid_diff_mask &= labels > 0
-        valid_diff_mask &= predictions > 0
-
-        mismatch_mask = (
-            predictions.astype(np.int32) != labels.astype(np.int32)
-        ) & valid_diff_mask
-
-        highlight_mask = apply_morphology(
-            mismatch_mask,
-            valid_diff_mask,
-            erode_count=difference_erode,
-            dilate_count=difference_dilate,
+    metrics = None
+    if labels_path.exists():
+        metrics = _evaluate_prediction(
+            out_path, labels_path, out_path.parent / "difference.tif", tile_size,
+            difference_erode, difference_dilate,
         )
-
-        save_highlight_rgba(difference_path, highlight_mask, meta, valid_diff_mask)
-
-        if metrics is not None:
-            total_pixels = int(valid_diff_mask.sum())
-            mismatch_pixels = int(highlight_mask.sum())
-            metrics["difference_summary"] = {
-                "mismatch_pixels": mismatch_pixels,
-                "evaluated_pixels": total_pixels,
-                "mismatch_rate": _safe_divide(mismatch_pixels, total_pixels),
-            }
-
         if metrics is not None:
             metrics_path = out_path.parent / "metrics.json"
             with open(metrics_path, "w", encoding="utf-8") as f:
                 json.dump(metrics, f, indent=2, ensure_ascii=False)
 
-    shutil.copy(args.config, out_path.parent / Path(args.config).name)
+    return metrics
+
+
+def _region_pairs(parser, args) -> list:
+    inputs, outputs = args.input_dir or [], args.output_dir or []
+    if len(inputs) != len(outputs):
+        parser.error("--input-dir and --output-dir must be given the same number of times")
+    pairs = [(Path(i), Path(o)) for i, o in zip(inputs, outputs)]
+    if args.regions:
+        with open(args.regions) as f:
+            pairs += [(Path(r["input_dir"]), Path(r["output_dir"])) for r in yaml.safe_load(f)]
+    if not pairs:
+        parser.error("Give --input-dir/--output-dir pairs or --regions")
+    return pairs
+
+
+def _summary_entry(metrics: Optional[dict], seconds: Optional[float]) -> dict:
+    if metrics is None:
+        return {"seconds": seconds}
+    return {
+        "overall_accuracy": metrics["overall_accuracy"],
+        "macro_f1": metrics["macro_f1"],
+        "evaluated_pixels": int(np.sum(metrics["confusion_matrix"])),
+        "seconds": seconds,
+    }
+
+
+def aggregate_metrics(region_metrics: list) -> Optional[dict]:
+    """Pool the confusion matrices of several ``metrics.json`` results."""
+    region_metrics = [m for m in region_metrics if m is not None]
+    if not region_metrics:
+        return None
+    class_ids = sorted({c for m in region_metrics for c in m["classes"]})
+    pooled = np.zeros((len(class_ids), len(class_ids)), dtype=np.int64)
+    for m in region_metrics:
+        index = np.searchsorted(class_ids, m["classes"])
+        pooled[np.ix_(index, index)] += np.asarray(m["confusion_matrix"], dtype=np.int64)
+    return metrics_from_confusion(pooled, class_ids)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run model inference")
+    parser.add_argument("--config", required=True, help="YAML config file")
+    parser.add_argument(
+        "--input-dir",
+        action="append",
+        help="Directory containing the dataset; repeat together with --output-dir",
+    )
+    parser.add_argument("--model-dir", required=True, help="Directory with trained model")
+    parser.add_argument(
+        "--output-dir",
+        action="append",
+        help="Directory for prediction result, one per --input-dir",
+    )
+    parser.add_argument(
+        "--regions",
+        help="YAML list of {input_dir, output_dir} entries to predict in addition",
+    )
+    parser.add_argument(
+        "--summary",
+        help="Aggregate report over all regions "
+        "(default: predict_summary.json in the common parent of the output directories)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun even if the features, model and config are unchanged",
+    )
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        cfg = yaml.safe_load(f)
+
+    pairs = _region_pairs(parser, args)
+    model_path = Path(args.model_dir) / cfg["model"]
+
+    # the model is loaded once, and only if a region needs predicting
+    clf = None
+    summary = {"model": str(model_path), "model_load_seconds": None, "regions": {}}
+    region_metrics = []
+    for input_dir, output_dir in pairs:
+        cache = _region_cache(cfg, input_dir, output_dir, model_path)
+        if cache.skip(args.force):
+            metrics_path = output_dir / "metrics.json"
+            metrics = json.loads(metrics_path.read_text()) if metrics_path.exists() else None
+            seconds = None
+        else:
+            if clf is None:
+                start = time.perf_counter()
+                clf = _load_model_safely(model_path)
+                summary["model_load_seconds"] = time.perf_counter() - start
+            start = time.perf_counter()
+            metrics = predict_region(cfg, clf, input_dir, output_dir)
+            seconds = time.perf_counter() - start
+            shutil.copy(args.config, output_dir / Path(args.config).name)
+            cache.record()
+        region_metrics.append(metrics)
+        summary["regions"][str(input_dir)] = _summary_entry(metrics, seconds)
+
+    if len(pairs) > 1 or args.summary:
+        summary["aggregate"] = aggregate_metrics(region_metrics)
+        summary_path = Path(
+            args.summary
+            or Path(os.path.commonpath([str(o.resolve()) for _, o in pairs])) / "predict_summary.json"
+        )
+        summary_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        aggregate = summary["aggregate"] or {}
+        print(f"{summary_path}: overall accuracy {aggregate.get('overall_accuracy')}")
 
 
 if __name__ == "__main__":
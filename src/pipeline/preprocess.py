@@ -1,35 +1,79 @@
 import argparse
 import json
 import shutil
+from functools import partial
 from pathlib import Path
 
 import numpy as np
-import rasterio
 import yaml
 
-from ..preprocess.cloudmask import cloud_mask
-from ..preprocess.stack_bands import stack_bands
-from ..preprocess.features import compute_features
+from ..preprocess.blockwise import BandBlockReader, open_feature_output, process_blocks
+from ..preprocess.feature_store import quantization_params, quantize
+from ..preprocess.features import DEFAULT_INDICES, REFLECTANCE_SCALE, FeatureSet
+from ..utils.datacube import CUBE_DIR, DataCube
+from ..utils.io_raster import split_band_stack
+from ..utils.manifest import SUFFIX, StageCache
 
 # 雲をマスクして cloud_mask()
-# NDVI and NDWI 特徴を抽出する compute_features()
-def split_band_stack(stack_path: Path, bands: list[str]) -> None:
-    """Split a multi-band GeoTIFF into separate single-band files."""
-    with rasterio.open(stack_path) as src:
-        meta = src.meta.copy()
-        if src.count < len(bands):
-            raise ValueError("Band stack has fewer layers than expected")
-        for i, name in enumerate(bands, 1):
-            meta.update(count=1)
-            out = stack_path.parent / f"{name}.tif"
-            with rasterio.open(out, "w", **meta) as dst:
-                dst.write(src.read(i), 1)
+# preprocess.yaml の indices に列挙した特徴を FeatureSet で抽出する
+def resolve_band_inputs(cfg: dict, input_dir: Path, split_bands: bool = False):
+    """Locate the spectral bands and ``SCL``/``dataMask`` rasters of a dataset.
+
+    With a ``download.yaml`` in ``input_dir`` the spectral bands are read
+    directly from ``BANDS.tif`` by index, in the order listed there, instead
+    of from per-band copies. Those copies are only written when
+    ``split_bands`` is set.
+
+    Returns
+    -------
+    tuple
+        ``(bands, indexes, band_names, scl_path, mask_path)``. ``bands`` is
+        ``BANDS.tif`` with 1-based ``indexes``, or a list of single-band
+        paths with ``indexes`` set to ``None``.
+    """
+    dl_cfg_path = input_dir / "download.yaml"
+    if not dl_cfg_path.exists():
+        bands = [input_dir / Path(p).name for p in cfg["bands"]]
+        scl_path = input_dir / Path(cfg["scl"]).name
+        mask_path = input_dir / Path(cfg.get("mask", "")).name if cfg.get("mask") else None
+        return bands, None, [b.stem for b in bands], scl_path, mask_path
+
+    with open(dl_cfg_path) as f:
+        dl_cfg = yaml.safe_load(f)
+
+    spectral = [b for b in dl_cfg.get("bands", []) if b not in {"SCL", "dataMask"}]
+    stack = input_dir / "BANDS.tif"
+    if not stack.exists():
+        raise ValueError("BANDS.tif not found in input directory")
+    if split_bands:
+        split_band_stack(stack, spectral)
+
+    if "SCL" in dl_cfg.get("bands", []):
+        scl_path = input_dir / "SCL.tif"
+    else:
+        scl_path = input_dir / Path(cfg["scl"]).name
+    if "dataMask" in dl_cfg.get("bands", []):
+        mask_path = input_dir / "MASK.tif"
+    else:
+        mask_path = input_dir / Path(cfg.get("mask", "")).name if cfg.get("mask") else None
+    return stack, list(range(1, len(spectral) + 1)), spectral, scl_path, mask_path
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Preprocess Sentinel bands")
     parser.add_argument("--config", required=True, help="YAML config file")
     parser.add_argument("--input-dir", required=True, help="Directory with raw bands")
     parser.add_argument("--output-dir", help="Directory for dataset root")
+    parser.add_argument(
+        "--split-bands",
+        action="store_true",
+        help="Also write one GeoTIFF per band from BANDS.tif",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun even if the inputs and config are unchanged since the last run",
+    )
     args = parser.parse_args()
 
     with open(args.config) as f:
@@ -45,52 +89,93 @@ def main() -> None:
     output_dir.mkdir(parents=True, exist_ok=True)
 
     dl_cfg_path = input_dir / "download.yaml"
-    if dl_cfg_path.exists():
-        with open(dl_cfg_path) as f:
-            dl_cfg = yaml.safe_load(f)
-
-        spectral = [b for b in dl_cfg.get("bands", []) if b not in {"SCL", "dataMask"}]
-        stack = input_dir / "BANDS.tif"
-        if stack.exists():
-            missing = [b for b in spectral if not (input_dir / f"{b}.tif").exists()]
-            if missing:
-                split_band_stack(stack, spectral)
-        else:
-            raise ValueError("BANDS.tif not found in input directory")
-
-        bands = [input_dir / f"{b}.tif" for b in spectral]
-        if "SCL" in dl_cfg.get("bands", []):
-            scl_path = input_dir / "SCL.tif"
-        else:
-            scl_path = input_dir / Path(cfg["scl"]).name
-        if "dataMask" in dl_cfg.get("bands", []):
-            mask_path = input_dir / "MASK.tif"
-        else:
-            mask_path = input_dir / Path(cfg.get("mask", "")).name if cfg.get("mask") else None
+    out_path = output_dir / Path(cfg.get("features_out", "features.feat")).name
+    split_bands = args.split_bands or cfg.get("split_bands", False)
+    if cfg.get("datacube_date"):
+        inputs = [input_dir / CUBE_DIR / "cube.json", input_dir / CUBE_DIR / "data.npy"]
     else:
-        bands = [input_dir / Path(p).name for p in cfg["bands"]]
-        scl_path = input_dir / Path(cfg["scl"]).name
-        mask_path = input_dir / Path(cfg.get("mask", "")).name if cfg.get("mask") else None
-
-    mask = cloud_mask(scl_path, mask_path)
-    stack, meta = stack_bands(bands, mask)
-    features = compute_features(stack, red_idx=2, nir_idx=3, swir_idx=4)
-
-    out_path = output_dir / Path(cfg.get("features_out", "features.npz")).name
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    np.savez(out_path, features=features)
+        bands, indexes, band_names, scl_path, mask_path = resolve_band_inputs(cfg, input_dir)
+        inputs = [*(bands if indexes is None else [bands]), scl_path, mask_path]
+    outputs = [out_path]
+    if out_path.suffix in {".npy", ".npz"}:
+        outputs.append(out_path.with_suffix(".meta.json"))
+    cache = StageCache(
+        output_dir / f"{out_path.name}{SUFFIX}",
+        "preprocess",
+        inputs=[p for p in [*inputs, dl_cfg_path] if p is not None],
+        config=[cfg, split_bands],
+        outputs=outputs,
+    )
+    if cache.skip(args.force):
+        return
+
+    reader = None
+    if cfg.get("datacube_date"):
+        # read a single date directly from the time-series datacube
+        cube = DataCube(input_dir / CUBE_DIR)
+        read_block = partial(cube.masked_window, str(cfg["datacube_date"]))
+        n_bands = cube.header["n_bands"]
+        band_names = cube.channels[:n_bands]
+        meta = cube.profile
+        meta.update(count=n_bands, dtype="float32")
+        band_dtype = cube.band_dtype
+    else:
+        if split_bands and indexes is not None:
+            split_band_stack(bands, band_names)
+        reader = BandBlockReader(bands, indexes, scl_path, mask_path)
+        read_block, n_bands, meta = reader.read, reader.count, reader.meta
+        band_dtype = reader.source_dtype
+
+    feature_set = FeatureSet(
+        cfg.get("indices", DEFAULT_INDICES),
+        band_names,
+        reflectance_scale=cfg.get("reflectance_scale", REFLECTANCE_SCALE),
+        band_dtype=band_dtype,
+    )
+
+    height, width = meta["height"], meta["width"]
+    feature_fn = feature_set.compute
+    quantization = None
+    if cfg.get("quantize", False):
+        # int16 コードで保存 (値 = code * scale + offset)
+        quantization = quantization_params(feature_set.value_ranges)
+        scale, offset = quantization
+
+        def feature_fn(stack, out):
+            return quantize(feature_set.compute(stack, out), scale, offset)
+
+    features = open_feature_output(
+        out_path, (len(feature_set), height, width), feature_set.names, meta, quantization
+    )
+    try:
+        process_blocks(
+            read_block, n_bands, height, width, features, feature_fn,
+            block_rows=int(cfg.get("block_rows", 512)), halo=feature_set.halo,
+        )
+    finally:
+        if reader is not None:
+            reader.close()
+    if out_path.suffix == ".npz":
+        np.savez(out_path, features=features)
+    else:
+        features.flush()
+    del features
 
-    meta_json = meta.copy()
-    if "crs" in meta_json and hasattr(meta_json["crs"], "to_string"):
-        meta_json["crs"] = meta_json["crs"].to_string()
+    if out_path.suffix in {".npy", ".npz"}:
+        # legacy formats keep their georeferencing in a sidecar file
+        meta_json = meta.copy()
+        meta_json["feature_names"] = feature_set.names
+        if "crs" in meta_json and hasattr(meta_json["crs"], "to_string"):
+            meta_json["crs"] = meta_json["crs"].to_string()
 
-    with open(out_path.with_suffix(".meta.json"), "w") as f:
-        json.dump(meta_json, f)
+        with open(out_path.with_suffix(".meta.json"), "w") as f:
+            json.dump(meta_json, f)
 
-    config_copy_name = Path(cfg.get("features_out", "features.npz")).with_suffix(".yaml").name
+    config_copy_name = Path(cfg.get("features_out", "features.feat")).with_suffix(".yaml").name
     shutil.copy(args.config, out_path.parent / config_copy_name)
     if dl_cfg_path.exists():
         shutil.copy(dl_cfg_path, out_path.parent / dl_cfg_path.name)
+    cache.record()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+import argparse
+import json
+import shutil
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import yaml
+
+from ..classification.sampling import (
+    ClassReservoir,
+    draw_sample_coords,
+    read_cube_sample_features,
+    read_sample_features,
+    reservoir_sample_stores,
+    save_sample_table,
+)
+from ..preprocess.blockwise import BandBlockReader
+from ..preprocess.feature_store import (
+    QUANTIZED_DTYPE,
+    QUANTIZED_NODATA,
+    FeatureStore,
+    feature_encoding,
+    quantization_params,
+)
+from ..preprocess.features import DEFAULT_INDICES, REFLECTANCE_SCALE, FeatureSet
+from ..utils.datacube import CUBE_DIR, DataCube
+from ..utils.manifest import SUFFIX, StageCache
+from .preprocess import resolve_band_inputs
+
+# train.yaml の input_dirs から学習用サンプルテーブル (npz) を作成する
+#   method: coords    サンプル画素だけバンドを読み込んで特徴量を計算
+#                     (preprocess の datacube_date があればデータキューブから直接読む)
+#   method: reservoir 特徴量ストアをブロックごとに走査し、クラスごとに上限付きで抽出
+
+
+def _class_caps(sampling: dict):
+    """Per-class caps from ``class_proportions`` or ``class_caps``/``max_per_class``."""
+    proportions = sampling.get("class_proportions")
+    if proportions:
+        total = int(sampling["n_samples"])
+        caps = {int(c): int(round(total * p)) for c, p in proportions.items()}
+        return lambda c: caps.get(c, 0)
+    caps = {int(c): int(n) for c, n in (sampling.get("class_caps") or {}).items()}
+    default = int(sampling.get("max_per_class", 100000))
+    return lambda c: caps.get(c, default)
+
+
+def _region_inputs(prep_cfg: dict, d: Path):
+    """Band inputs of a region, or ``None`` when it is read from its datacube."""
+    if prep_cfg.get("datacube_date"):
+        return None
+    return resolve_band_inputs(prep_cfg, d)
+
+
+def _sample_coords(cfg: dict, sampling: dict, prep_cfg: dict, regions: list, rng):
+    tables = []
+    feature_set = None
+    quantization = None
+    date = prep_cfg.get("datacube_date")
+    for r, (d, band_inputs) in enumerate(regions):
+        with rasterio.open(d / cfg["labels"]) as src:
+            labels = src.read(1)
+            nodata = src.nodata
+        if sampling.get("n_samples"):
+            n_samples = int(sampling["n_samples"])
+        else:
+            n_samples = int(labels.size * sampling.get("sample_fraction", 0.1))
+        rows, cols = draw_sample_coords(
+            labels,
+            n_samples,
+            rng,
+            stratify=sampling.get("stratify", False),
+            nodata=None if nodata is None else int(nodata),
+        )
+
+        with ExitStack() as stack:
+            if band_inputs is None:
+                cube = DataCube(d / CUBE_DIR)
+                band_names = cube.channels[: cube.header["n_bands"]]
+                band_dtype = cube.band_dtype
+            else:
+                bands, indexes, band_names, scl_path, mask_path = band_inputs
+                reader = stack.enter_context(BandBlockReader(bands, indexes, scl_path, mask_path))
+                band_dtype = reader.source_dtype
+            feature_set = FeatureSet(
+                prep_cfg.get("indices", DEFAULT_INDICES),
+                band_names,
+                reflectance_scale=prep_cfg.get("reflectance_scale", REFLECTANCE_SCALE),
+                band_dtype=band_dtype,
+            )
+            if prep_cfg.get("quantize", False):
+                quantization = quantization_params(feature_set.value_ranges)
+            tile = int(sampling.get("tile", 256))
+            if band_inputs is None:
+                # same date and masking as src.pipeline.preprocess with datacube_date
+                X = read_cube_sample_features(
+                    cube, str(date), feature_set, rows, cols, tile=tile, quantization=quantization
+                )
+            else:
+                X = read_sample_features(
+                    reader.read,
+                    feature_set,
+                    reader.meta["height"],
+                    reader.meta["width"],
+                    rows,
+                    cols,
+                    tile=tile,
+                    quantization=quantization,
+                )
+        tables.append((X, labels[rows, cols], np.full(rows.size, r), rows, cols))
+        print(f"{d}: {rows.size} samples")
+
+    if quantization is not None:
+        encoding = feature_encoding(feature_set.names, QUANTIZED_DTYPE, QUANTIZED_NODATA, *quantization)
+    else:
+        encoding = feature_encoding(feature_set.names)
+    return [np.concatenate(parts) for parts in zip(*tables)], encoding, None
+
+
+def _sample_reservoir(cfg: dict, sampling: dict, input_dirs: list, rng):
+    stores = [FeatureStore.open(d / "preprocess" / cfg["features"]) for d in input_dirs]
+    encoding = stores[0].encoding
+    if any(s.encoding != encoding for s in stores[1:]):
+        raise ValueError(
+            "All input directories must use the same feature encoding "
+            "(feature names, dtype and quantization)"
+        )
+    reservoir = ClassReservoir(
+        _class_caps(sampling), stores[0].shape[0], stores[0].data.dtype, rng
+    )
+    with ExitStack() as stack:
+        label_readers = [stack.enter_context(rasterio.open(d / cfg["labels"])) for d in input_dirs]
+        reservoir_sample_stores(
+            stores, label_readers, reservoir, block_rows=int(sampling.get("block_rows", 512))
+        )
+    table = reservoir.table()
+    stats = {
+        "seen": {str(c): n for c, n in sorted(reservoir.seen.items())},
+        "kept": {str(c): n for c, n in sorted(reservoir.kept.items())},
+        "kept_per_region": {
+            str(d): {
+                str(c): int(np.count_nonzero((table[2] == r) & (table[1] == c)))
+                for c in sorted(reservoir.kept)
+            }
+            for r, d in enumerate(input_dirs)
+        },
+    }
+    return table, encoding, stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Extract a training sample table")
+    parser.add_argument("--config", required=True, help="Training YAML config file")
+    parser.add_argument(
+        "--output", help="Sample table path (defaults to 'samples' in the config)"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rerun even if the inputs and config are unchanged since the last run",
+    )
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        cfg = yaml.safe_load(f)
+    sampling = cfg.get("sampling", {})
+    method = sampling.get("method", "coords")
+    out_path = Path(args.output or cfg["samples"])
+    stats_path = out_path.with_name(f"{out_path.stem}.class_counts.json")
+
+    input_dirs = [Path(d) for d in cfg.get("input_dirs", [])]
+    if not input_dirs:
+        raise ValueError("No input directories provided in config")
+
+    if method == "reservoir":
+        prep_cfg = None
+        inputs = [
+            p
+            for d in input_dirs
+            for p in (d / "preprocess" / cfg["features"], d / cfg["labels"])
+        ]
+        outputs = [out_path, stats_path]
+    elif method == "coords":
+        with open(sampling.get("preprocess_config", "configs/preprocess.yaml")) as f:
+            prep_cfg = yaml.safe_load(f)
+        regions = [(d, _region_inputs(prep_cfg, d)) for d in input_dirs]
+        inputs = []
+        for d, band_inputs in regions:
+            if band_inputs is None:
+                inputs += [d / CUBE_DIR / "cube.json", d / CUBE_DIR / "data.npy"]
+            else:
+                bands, indexes, _, scl_path, mask_path = band_inputs
+                inputs += [p for p in (*(bands if indexes is None else [bands]), scl_path, mask_path) if p]
+            inputs.append(d / cfg["labels"])
+        outputs = [out_path]
+    else:
+        raise ValueError(f"Unknown sampling method '{method}', use 'coords' or 'reservoir'")
+
+    cache = StageCache(
+        out_path.with_name(f"{out_path.name}{SUFFIX}"),
+        "sample",
+        inputs=inputs,
+        config=[cfg["labels"], cfg.get("features"), sampling, prep_cfg],
+        outputs=outputs,
+    )
+    if cache.skip(args.force):
+        return
+
+    rng = np.random.default_rng(sampling.get("seed", 0))
+    if method == "reservoir":
+        table, encoding, stats = _sample_reservoir(cfg, sampling, input_dirs, rng)
+    else:
+        table, encoding, stats = _sample_coords(cfg, sampling, prep_cfg, regions, rng)
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    save_sample_table(
+        out_path,
+        *table,
+        info={
+            "feature_names": encoding["feature_names"],
+            "regions": [str(d) for d in input_dirs],
+            "encoding": encoding,
+        },
+    )
+    if stats is not None:
+        with open(stats_path, "w") as f:
+            json.dump(stats, f, indent=2)
+        print(json.dumps(stats["kept"]))
+    shutil.copy(args.config, out_path.parent / Path(args.config).name)
+    cache.record()
+
+
+if __name__ == "__main__":
+    main()
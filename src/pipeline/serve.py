@@ -0,0 +1,257 @@
+"""Resident prediction service on localhost HTTP.
+
+Loads one or more models once and classifies feature arrays or windows of
+feature stores on request, so repeated predictions skip the model load::
+
+    python -m src.pipeline.serve --model rf=data/outputs/model/model.pkl --port 8765
+
+Endpoints (``model`` may be omitted when only one model is loaded):
+
+``POST /predict?model=rf[&nodata=v]``
+    Body: ``.npy`` of a ``(features, rows, cols)`` array. Response: ``.npy``
+    of the ``(rows, cols)`` ``uint8`` class raster (0 for invalid pixels).
+``POST /predict_path``
+    JSON ``{"model", "path", "window": [col, row, width, height],
+    "output"}`` reading a ``.feat`` store. ``window`` defaults to the whole
+    grid. With ``output`` the georeferenced GeoTIFF is written there and a
+    JSON summary returned, otherwise the ``.npy`` raster.
+``GET /stats``
+    Latency histograms per endpoint and batch sizes per model.
+``GET /models``
+    Loaded models and their feature encodings.
+
+Pixels of concurrent requests are classified together by
+:class:`src.classification.serving.PredictionBatcher`. Malformed requests
+(unknown model, wrong feature count, bad window, ...) get status 400 and
+``{"error": ...}`` before they reach the batcher. The server binds to
+``127.0.0.1`` by default; it has no authentication.
+"""
+import argparse
+import io
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+from ..classification.predict import iter_tiles, predict_block, predict_model
+from ..classification.serving import BatchedModel, Histogram, PredictionBatcher
+from ..preprocess.feature_store import FeatureStore
+from .predict import _load_model_safely
+
+
+class ModelServer(ThreadingHTTPServer):
+    """HTTP server holding the resident models and the request statistics."""
+
+    daemon_threads = True
+
+    def __init__(self, address, models, tile_size=512, max_batch_rows=262144, max_wait_ms=5.0):
+        super().__init__(address, RequestHandler)
+        self.tile_size = tile_size
+        self.batchers = {
+            name: PredictionBatcher(clf, max_batch_rows, max_wait_ms) for name, clf in models.items()
+        }
+        self.models = {name: BatchedModel(b) for name, b in self.batchers.items()}
+        self.latency = {name: Histogram() for name in ("predict", "predict_path")}
+        self.started = time.time()
+
+    def model(self, name):
+        if name is None and len(self.models) == 1:
+            return next(iter(self.models.values()))
+        if name not in self.models:
+            raise KeyError(f"Unknown model {name!r}; loaded: {sorted(self.models)}")
+        return self.models[name]
+
+    def predict_array(self, model, features, nodata):
+        """Tiled prediction of an in-memory ``(features, rows, cols)`` array."""
+        _, rows, cols = features.shape
+        pred = np.zeros((rows, cols), dtype=np.uint8)
+        for window in iter_tiles(rows, cols, self.tile_size):
+            (r0, r1), (c0, c1) = window.toranges()
+            pred[r0:r1, c0:c1] = predict_block(model, features[:, r0:r1, c0:c1], nodata)[0]
+        return pred
+
+    def stats(self):
+        return {
+            "uptime_seconds": time.time() - self.started,
+            "latency": {name: h.summary() for name, h in self.latency.items()},
+            "batches": {
+                name: {"rows": b.batch_rows.summary(), "predict": b.batch_ms.summary()}
+                for name, b in self.batchers.items()
+            },
+        }
+
+
+def _encoding_nodata(model):
+    encoding = model.feature_encoding_
+    return None if encoding is None else encoding.get("nodata")
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server: ModelServer
+
+    def log_message(self, format, *args):
+        # latency statistics replace the per-request access log
+        pass
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj, status=200):
+        self._send(status, json.dumps(obj).encode(), "application/json")
+
+    def _send_array(self, array):
+        buf = io.BytesIO()
+        np.save(buf, array, allow_pickle=False)
+        self._send(200, buf.getvalue(), "application/octet-stream")
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/stats":
+            self._send_json(self.server.stats())
+        elif path == "/models":
+            self._send_json(
+                {name: {"feature_encoding": m.feature_encoding_} for name, m in self.server.models.items()}
+            )
+        else:
+            self._send_json({"error": f"Unknown path {path}"}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        handlers = {
+            "/predict": (self._parse_predict, self._predict),
+            "/predict_path": (self._parse_predict_path, self._predict_path),
+        }
+        if url.path not in handlers:
+            self._send_json({"error": f"Unknown path {url.path}"}, 404)
+            return
+        parse, run = handlers[url.path]
+        start = time.perf_counter()
+        try:
+            request = parse({k: v[-1] for k, v in parse_qs(url.query).items()})
+        except Exception as exc:  # anything wrong with the request is the client's error
+            self._send_json({"error": f"{type(exc).__name__}: {exc}"}, 400)
+            return
+        try:
+            run(*request)
+        except Exception as exc:
+            self._send_json({"error": f"{type(exc).__name__}: {exc}"}, 500)
+            return
+        self.server.latency[url.path.lstrip("/")].add((time.perf_counter() - start) * 1000)
+
+    def _check_features(self, model, n_features):
+        expected = model.n_features_in_
+        if expected is not None and n_features != expected:
+            raise ValueError(f"The model expects {expected} features, got {n_features}")
+
+    def _parse_predict(self, query):
+        model = self.server.model(query.get("model"))
+        features = np.load(io.BytesIO(self._body()), allow_pickle=False)
+        if features.ndim != 3:
+            raise ValueError(f"Expected a (features, rows, cols) array, got shape {features.shape}")
+        self._check_features(model, features.shape[0])
+        nodata = float(query["nodata"]) if "nodata" in query else _encoding_nodata(model)
+        return model, features, nodata
+
+    def _predict(self, model, features, nodata):
+        self._send_array(self.server.predict_array(model, features, nodata))
+
+    def _parse_predict_path(self, query):
+        request = json.loads(self._body())
+        model = self.server.model(request.get("model", query.get("model")))
+        store = FeatureStore.open(Path(request["path"]))
+        encoding = model.feature_encoding_
+        if encoding is not None and store.encoding != encoding:
+            raise ValueError(
+                f"Features in {request['path']} do not match the encoding the model "
+                f"was trained with: {store.encoding} vs {encoding}"
+            )
+        n_features, height, width = store.shape
+        self._check_features(model, n_features)
+        window = request.get("window", [0, 0, width, height])
+        if len(window) != 4:
+            raise ValueError(f"window must be [col, row, width, height], got {window}")
+        window = Window(*(int(v) for v in window)).intersection(Window(0, 0, width, height))
+        output = Path(request["output"]) if "output" in request else None
+        return model, store, window, output
+
+    def _predict_path(self, model, store, window, output):
+        (r0, r1), (c0, c1) = window.toranges()
+        features = store.data[:, r0:r1, c0:c1]
+        if output is None:
+            self._send_array(self.server.predict_array(model, features, store.nodata))
+            return
+        meta = store.profile
+        meta["transform"] = window_transform(window, meta["transform"])
+        output.parent.mkdir(parents=True, exist_ok=True)
+        pred = predict_model(
+            model, features, meta, output, nodata=store.nodata, tile_size=self.server.tile_size
+        )
+        self._send_json(
+            {
+                "output": str(output),
+                "window": [int(c0), int(r0), int(c1 - c0), int(r1 - r0)],
+                "classified_pixels": int(np.count_nonzero(pred)),
+            }
+        )
+
+
+def _parse_models(specs):
+    models = {}
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            name, path = Path(spec).stem, spec
+        models[name] = _load_model_safely(Path(path))
+    return models
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve resident models over localhost HTTP")
+    parser.add_argument(
+        "--model",
+        action="append",
+        required=True,
+        help="Model to keep loaded as name=path (or just path, named by its stem); repeatable",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address")
+    parser.add_argument("--port", type=int, default=8765, help="Port (0 picks a free one)")
+    parser.add_argument("--tile-size", type=int, default=512, help="Tile edge length in pixels")
+    parser.add_argument(
+        "--max-batch-rows", type=int, default=262144, help="Pixels classified per predict call at most"
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=5.0,
+        help="How long a batch waits for concurrent requests to join",
+    )
+    args = parser.parse_args()
+
+    models = _parse_models(args.model)
+    server = ModelServer(
+        (args.host, args.port), models, args.tile_size, args.max_batch_rows, args.max_wait_ms
+    )
+    host, port = server.server_address[:2]
+    print(f"Serving {', '.join(models)} on http://{host}:{port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Client of :mod:`src.pipeline.serve`.
+
+Uses only the standard library and numpy, so scripts can request
+predictions from a running server::
+
+    python -m src.pipeline.serve_client --path data/outputs/r1/preprocess/features.feat \\
+        --window 0 0 512 512 --output /tmp/window.tif
+    python -m src.pipeline.serve_client --path features.feat --load-test 200 --concurrency 8
+
+``--load-test`` sends random windows of the store from several threads and
+prints the client latencies next to the server's ``/stats``, which shows how
+many pixels the batcher combined per ``predict`` call.
+"""
+import argparse
+import io
+import json
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import numpy as np
+
+from ..classification.serving import Histogram
+from ..preprocess.feature_store import FeatureStore
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+class ServeError(RuntimeError):
+    """Error response of the server; ``status`` is the HTTP status code."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class ServeClient:
+    """Requests against a prediction server at ``url``."""
+
+    def __init__(self, url=DEFAULT_URL, timeout=600):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, path, body=None, content_type="application/json"):
+        request = urllib.request.Request(self.url + path, data=body)
+        if body is not None:
+            request.add_header("Content-Type", content_type)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = response.read()
+                kind = response.headers.get("Content-Type")
+        except urllib.error.HTTPError as exc:
+            raise ServeError(json.loads(exc.read()).get("error", str(exc)), exc.code) from exc
+        if kind == "application/json":
+            return json.loads(data)
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    def predict_array(self, features, model=None, nodata=None):
+        """Class raster of a ``(features, rows, cols)`` array."""
+        query = {k: v for k, v in (("model", model), ("nodata", nodata)) if v is not None}
+        buf = io.BytesIO()
+        np.save(buf, np.ascontiguousarray(features), allow_pickle=False)
+        path = "/predict" + (f"?{urlencode(query)}" if query else "")
+        return self._request(path, buf.getvalue(), "application/octet-stream")
+
+    def predict_path(self, path, window=None, output=None, model=None):
+        """Class raster of a window of a feature store, or a summary when ``output`` is set."""
+        request = {"path": str(path)}
+        for key, value in (("window", window), ("output", output), ("model", model)):
+            if value is not None:
+                request[key] = [int(v) for v in value] if key == "window" else str(value)
+        return self._request("/predict_path", json.dumps(request).encode())
+
+    def stats(self):
+        return self._request("/stats")
+
+    def models(self):
+        return self._request("/models")
+
+
+def load_test(client, path, n_requests, concurrency, size, model=None, seed=0):
+    """Send random ``size`` x ``size`` windows concurrently; return client latencies."""
+    _, height, width = FeatureStore.open(path).shape
+    rng = np.random.default_rng(seed)
+    windows = [
+        (int(rng.integers(0, max(width - size, 0) + 1)), int(rng.integers(0, max(height - size, 0) + 1)), size, size)
+        for _ in range(n_requests)
+    ]
+    latency = Histogram()
+
+    def send(window):
+        start = time.perf_counter()
+        client.predict_path(path, window, model=model)
+        latency.add((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(send, windows))
+    summary = latency.summary()
+    summary["requests_per_second"] = n_requests / (time.perf_counter() - start)
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Request predictions from src.pipeline.serve")
+    parser.add_argument("--url", default=DEFAULT_URL, help="Server address")
+    parser.add_argument("--model", help="Model name (optional with a single model)")
+    parser.add_argument("--path", help="Feature store (.feat) to predict")
+    parser.add_argument(
+        "--window", type=int, nargs=4, metavar=("COL", "ROW", "WIDTH", "HEIGHT"), help="Window of --path"
+    )
+    parser.add_argument("--output", help="GeoTIFF the server writes the prediction to")
+    parser.add_argument("--load-test", type=int, metavar="N", help="Send N random windows of --path")
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel load-test requests")
+    parser.add_argument("--size", type=int, default=64, help="Load-test window edge length")
+    parser.add_argument("--stats", action="store_true", help="Print the server statistics")
+    args = parser.parse_args()
+
+    client = ServeClient(args.url)
+    if args.load_test:
+        if not args.path:
+            parser.error("--load-test needs --path")
+        result = load_test(client, args.path, args.load_test, args.concurrency, args.size, args.model)
+        print(json.dumps({"client": result, "server": client.stats()}, indent=2))
+    elif args.path:
+        result = client.predict_path(args.path, args.window, args.output, args.model)
+        if isinstance(result, dict):
+            print(json.dumps(result, indent=2))
+        else:
+            classes, counts = np.unique(result, return_counts=True)
+            print(f"{result.shape} prediction; pixels per class: {dict(zip(classes.tolist(), counts.tolist()))}")
+    if args.stats:
+        print(json.dumps(client.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import csv
+import itertools
+import json
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import yaml
+from joblib import Parallel, delayed
+
+from ..classification.sample_cache import holdout_split, load_rows
+from ..classification.train_model import train_model
+from .train import prepare_training_data
+
+# train.yaml の sweep セクションのパラメータの組み合わせを、キャッシュした
+# サンプル (memmap) に対して並列に学習し、ホールドアウト精度を比較表に書き出す
+
+
+def _fit_and_score(params: dict, split: dict) -> dict:
+    """Fit one configuration on the cached train rows and score the test rows."""
+    # memory-mapped rows are shared by all workers and passed to the model
+    # without copies; the cache only holds valid rows
+    X, y, weight = load_rows(split["train"])
+    X_test, y_test, weight_test = load_rows(split["test"])
+
+    start = time.perf_counter()
+    clf = train_model(X.T, y, sample_weight=weight, assume_valid=True, **params)
+    fit_seconds = time.perf_counter() - start
+    pred = clf.predict(X_test)
+    correct = pred == y_test
+    return {
+        **params,
+        "fit_seconds": round(fit_seconds, 3),
+        "holdout_accuracy": float(np.average(correct, weights=weight_test)),
+        "n_train": int(y.size),
+        "n_test": int(y_test.size),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare RandomForest parameters on cached training samples"
+    )
+    parser.add_argument("--config", required=True, help="Training YAML config with a sweep section")
+    parser.add_argument("--output-dir", required=True, help="Directory for the comparison table")
+    parser.add_argument("--n-jobs", type=int, help="Parallel fits (overrides sweep.n_jobs)")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        cfg = yaml.safe_load(f)
+    sweep = dict(cfg.get("sweep", {}))
+    if not cfg.get("sample_cache_dir"):
+        raise ValueError("sweep requires 'sample_cache_dir' so the fits can share the samples")
+    holdout = float(sweep.pop("holdout_fraction", 0.2))
+    seed = int(sweep.pop("seed", 0))
+    n_jobs = args.n_jobs or int(sweep.pop("n_jobs", 1))
+    sweep.pop("n_jobs", None)  # when overridden on the command line
+    grid = {k: v if isinstance(v, list) else [v] for k, v in sweep.items()}
+    if not grid:
+        raise ValueError("No parameters to sweep in the 'sweep' section")
+
+    samples = prepare_training_data(cfg)
+    encoding = samples["info"]["encoding"]
+    configs = [
+        {"nodata": encoding["nodata"], **dict(zip(grid, values))}
+        for values in itertools.product(*grid.values())
+    ]
+    print(f"{len(configs)} configurations on {samples['y'].size} samples, {n_jobs} jobs")
+
+    split = holdout_split(samples, holdout, seed)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_and_score)(params, split) for params in configs
+    )
+    results.sort(key=lambda r: -r["holdout_accuracy"])
+    for r in results:
+        r.pop("nodata")
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / "sweep.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+    with open(output_dir / "sweep.json", "w") as f:
+        json.dump(results, f, indent=2)
+    for r in results:
+        print(json.dumps(r))
+    shutil.copy(args.config, output_dir / Path(args.config).name)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,76 +1,448 @@
 import argparse
 import joblib
+import json
 import shutil
+import time
+from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import rasterio
 import yaml
 
-from ..classification.train_model import train_model
+from ..classification.cross_validation import cross_validate, spatial_folds
+from ..classification.dedup import dedup_samples
+from ..classification.flat_forest import SUFFIX as FLAT_SUFFIX, save_flat_forest
+from ..classification.sample_cache import (
+    load_cached_samples,
+    sample_cache_key,
+    save_cached_samples,
+)
+from ..classification.sampling import load_sample_table
+from ..classification.train_model import (
+    TrainingBackend,
+    add_trees,
+    train_model,
+    valid_samples,
+)
+from ..preprocess.feature_store import FeatureStore
+from ..utils.manifest import SUFFIX, StageCache
 
 
-def main() -> None:
-    parser = argparse.ArgumentParser(description="Train classification model")
-    parser.add_argument("--config", required=True, help="YAML config file")
-    parser.add_argument("--output-dir", required=True, help="Directory for model")
-    parser.add_argument(
-        "--verbose",
-        type=int,
-        default=0,
-        help="Verbosity level for RandomForest training",
-    )
-    args = parser.parse_args()
+def load_feature_stores(cfg: dict, input_dirs: list[Path]):
+    """Load features and labels of all ``input_dirs`` from their feature stores.
 
-    with open(args.config) as f:
-        cfg = yaml.safe_load(f)
+    With ``sample_fraction`` only the sampled pixels are read.
 
-    output_dir = Path(args.output_dir)
-
-    input_dirs = [Path(d) for d in cfg.get("input_dirs", [])]
-
-    feature_arrays = []
+    Returns
+    -------
+    tuple
+        ``(features (n_features, n_samples), labels, encoding, positions)``
+        where ``positions`` holds the ``(n_samples, 3)`` region index, row
+        and column of every sample.
+    """
+    stores = []
     label_arrays = []
 
     for d in input_dirs:
         features_path = d / "preprocess" / cfg["features"]
-        features = np.load(features_path)["features"]
-        feature_arrays.append(features.reshape(features.shape[0], -1))
+        stores.append(FeatureStore.open(features_path))
 
         labels_path = d / cfg["labels"]
         with rasterio.open(labels_path) as src:
             labels = src.read(1)
         label_arrays.append(labels.flatten())
 
-    if not feature_arrays:
+    if not stores:
         raise ValueError("No input directories provided in config")
+    if len({s.shape[0] for s in stores}) > 1:
+        raise ValueError("All input directories must provide the same features")
+    encoding = stores[0].encoding
+    if any(s.encoding != encoding for s in stores[1:]):
+        raise ValueError(
+            "All input directories must use the same feature encoding "
+            "(feature names, dtype and quantization)"
+        )
 
-    data = np.hstack(feature_arrays)
     labels = np.hstack(label_arrays)
+    offsets = np.cumsum([0] + [s.shape[1] * s.shape[2] for s in stores])
+    widths = np.array([s.shape[2] for s in stores])
 
     sample_fraction = cfg.get("sample_fraction")
     if sample_fraction:
-        n_samples = data.shape[1]
+        n_samples = labels.size
         size = int(n_samples * sample_fraction)
         rng = np.random.default_rng(0)
         idx = rng.choice(n_samples, size=size, replace=False)
-        data = data[:, idx]
+        # read only the sampled pixels from each memory-mapped store
+        region = np.searchsorted(offsets, idx, side="right") - 1
+        data = np.empty((stores[0].shape[0], size), dtype=stores[0].data.dtype)
+        for r, store in enumerate(stores):
+            pos = np.flatnonzero(region == r)
+            local = idx[pos] - offsets[r]
+            order = np.argsort(local)
+            data[:, pos[order]] = store.read_flat(local[order])
         labels = labels[idx]
+    else:
+        data = np.hstack([s.data.reshape(s.shape[0], -1) for s in stores])
+        idx = np.arange(labels.size)
+        region = np.repeat(np.arange(len(stores)), np.diff(offsets))
+
+    rows, cols = np.divmod(idx - offsets[region], widths[region])
+    positions = np.stack([region, rows, cols], axis=1).astype(np.int32)
+    return data, labels, encoding, positions
+
+
+def training_inputs(cfg: dict) -> list[Path]:
+    """Files the prepared training samples depend on."""
+    if cfg.get("samples"):
+        return [Path(cfg["samples"])]
+    return [
+        p
+        for d in (Path(d) for d in cfg.get("input_dirs", []))
+        for p in (d / "preprocess" / cfg["features"], d / cfg["labels"])
+    ]
+
+
+def prepare_training_data(cfg: dict) -> dict:
+    """Load, filter and optionally deduplicate the training samples.
+
+    With ``sample_cache_dir`` in ``cfg`` the result is stored there and
+    memory-mapped by later runs with the same inputs and settings (see
+    :mod:`src.classification.sample_cache`).
+
+    Returns
+    -------
+    dict
+        ``X`` ``(n_samples, n_features)``, ``y``, ``weight`` (dedup counts or
+        ``None``), ``positions`` (region index, row and column of each
+        sample) and ``info`` with the feature ``encoding`` and a ``report``.
+    """
+    cache_dir = cfg.get("sample_cache_dir")
+    if cache_dir:
+        key = sample_cache_key(cfg, training_inputs(cfg))
+        cached = load_cached_samples(cache_dir, key)
+        if cached is not None:
+            print(f"Using cached samples {cached['path']}")
+            return cached
+
+    start = time.perf_counter()
+    if cfg.get("samples"):
+        # sample table written by src.pipeline.sample
+        table = load_sample_table(cfg["samples"])
+        data, labels = table["X"].T, table["y"]
+        encoding = table["info"]["encoding"]
+        positions = np.stack([table["region"], table["rows"], table["cols"]], axis=1)
+    else:
+        data, labels, encoding, positions = load_feature_stores(
+            cfg, [Path(d) for d in cfg.get("input_dirs", [])]
+        )
+    X = data.reshape(data.shape[0], -1).T
+    valid = valid_samples(X, encoding["nodata"])
+    X, y, positions = X[valid], labels.ravel()[valid], positions[valid].astype(np.int32)
+    weight = None
+    report = {"n_samples": int(y.size)}
+    if cfg.get("dedup", False):
+        X, y, weight, first = dedup_samples(X, y, step=cfg.get("dedup_step"), return_index=True)
+        positions = positions[first]
+        report.update(
+            n_unique=int(y.size),
+            reduction_ratio=float(weight.sum() / max(y.size, 1)),
+        )
+    report["prepare_seconds"] = time.perf_counter() - start
+    info = {"encoding": encoding, "report": report}
+    if cache_dir:
+        return save_cached_samples(cache_dir, key, X, y, weight, info, positions)
+    return {"X": X, "y": y, "weight": weight, "positions": positions, "info": info}
+
+
+def _report_fit(report: dict, clf) -> None:
+    report["max_samples"] = getattr(clf, "max_samples", None)
+    report["max_depth"] = clf.max_depth
+    # parameters lowered to fit memory_budget_mb
+    report["budget_limits"] = getattr(clf, "budget_limits_", [])
+    report["training_log"] = clf.training_log_
+
+
+def _fit_params(cfg: dict, verbose: int, nodata) -> dict:
+    """Keyword arguments for :func:`train_model` from ``train.yaml``."""
+    return {
+        "n_estimators": cfg.get("n_estimators", 100),
+        "max_depth": cfg.get("max_depth"),
+        "max_samples": cfg.get("max_samples"),
+        "verbose": verbose,
+        "nodata": nodata,
+        "backend": TrainingBackend.from_config(cfg),
+        "model_type": cfg.get("model_type", "random_forest"),
+        "model_params": cfg.get("model_params"),
+    }
+
+
+def run_cross_validation(cfg: dict, samples: dict, out_dir: Path) -> dict:
+    """Spatial block CV of the configured model; writes ``cv_metrics.json``."""
+    cv = cfg.get("cv") or {}
+    if samples.get("positions") is None:
+        raise ValueError("Cached samples have no positions; clear sample_cache_dir")
+    block_size = int(cv.get("block_size", 256))
+    fold, n_blocks = spatial_folds(
+        samples["positions"], block_size, int(cv.get("folds", 5)), int(cv.get("seed", 0))
+    )
+    start = time.perf_counter()
+    report = cross_validate(
+        samples["X"],
+        samples["y"],
+        samples["weight"],
+        fold,
+        _fit_params(cfg, 0, samples["info"]["encoding"]["nodata"]),
+        n_jobs=int(cv.get("n_jobs", 1)),
+    )
+    report.update(
+        folds=int(fold.max()) + 1,
+        block_size=block_size,
+        n_blocks=n_blocks,
+        cv_seconds=time.perf_counter() - start,
+    )
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(out_dir / "cv_metrics.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
+
+
+def _train_full(cfg: dict, verbose: int, out_dir: Path):
+    """Fit a new model on all input directories."""
+    samples = prepare_training_data(cfg)
+    X, y, weight = samples["X"], samples["y"], samples["weight"]
+    encoding = samples["info"]["encoding"]
+    report = dict(samples["info"]["report"])
+    if cfg.get("cv"):
+        cv = run_cross_validation(cfg, samples, out_dir)
+        report["cv_overall_accuracy"] = cv["overall_accuracy"]
+        report["cv_seconds"] = cv["cv_seconds"]
+    fit = partial(train_model, **_fit_params(cfg, verbose, encoding["nodata"]))
+    if weight is not None and cfg.get("dedup_compare", False):
+        # expanding the counts restores the rows before dedup
+        start = time.perf_counter()
+        fit(np.repeat(X, weight, axis=0).T, np.repeat(y, weight))
+        report["fit_seconds_without_dedup"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    clf = fit(X.T, y, sample_weight=weight)
+    report["fit_seconds"] = time.perf_counter() - start
+    report["model_type"] = cfg.get("model_type", "random_forest")
+    _report_fit(report, clf)
+    # prediction checks its features against this
+    clf.feature_encoding_ = encoding
+    n_trees = len(clf.estimators_) if hasattr(clf, "estimators_") else int(clf.n_iter_)
+    batch = {
+        "trees": [0, n_trees],
+        "regions": [str(d) for d in cfg.get("input_dirs", [])],
+        "samples": str(samples["path"]) if "path" in samples else None,
+        "n_samples": int(y.size),
+        "class_counts": class_counts(y),
+        "replay_samples": 0,
+    }
+    return clf, report, batch
 
-    clf = train_model(
-        data,
-        labels,
-        n_estimators=cfg.get("n_estimators", 100),
-        max_depth=cfg.get("max_depth"),
-        max_samples=cfg.get("max_samples"),
-        verbose=args.verbose,
+
+def class_counts(y) -> dict:
+    """Rows per class, as stored with every batch in ``lineage.json``."""
+    classes, counts = np.unique(y, return_counts=True)
+    return {str(int(c)): int(n) for c, n in zip(classes, counts)}
+
+
+def replay_samples(batches: list[dict], per_class: int, seed: int = 0):
+    """Uniform sample of up to ``per_class`` rows per class from earlier batches.
+
+    The rows are drawn by random rank within each class, using the class
+    counts recorded in ``lineage.json``, and only the drawn rows are read
+    from the memory-mapped sample cache, so the cost depends on
+    ``per_class`` rather than on the size of the earlier batches.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        ``(X, y, weight)``.
+    """
+    rng = np.random.default_rng(seed)
+    entries = []
+    for batch in batches:
+        entry = Path(batch["samples"]) if batch.get("samples") else None
+        cached = entry and load_cached_samples(entry.parent, entry.name)
+        if not cached:
+            raise ValueError(
+                f"Samples of the training batch with regions {batch['regions']} are not "
+                "in the sample cache; set sample_cache_dir or retrain with --force"
+            )
+        # batches recorded before class counts were kept need one pass over y
+        counts = batch.get("class_counts") or class_counts(cached["y"])
+        entries.append((cached, {int(c): n for c, n in counts.items()}))
+
+    ranks = [[] for _ in entries]
+    for c in sorted({c for _, counts in entries for c in counts}):
+        sizes = np.array([counts.get(c, 0) for _, counts in entries])
+        ends = np.cumsum(sizes)
+        pick = rng.choice(ends[-1], min(per_class, ends[-1]), replace=False)
+        which = np.searchsorted(ends, pick, side="right")
+        for b in np.unique(which):
+            # rank within the rows of class c of batch b
+            ranks[b].append((c, pick[which == b] - (ends[b] - sizes[b])))
+
+    parts = []
+    for (cached, counts), batch_ranks in zip(entries, ranks):
+        if not batch_ranks:
+            continue
+        order = cached["order"]
+        if order is None:
+            order = np.argsort(cached["y"], kind="stable")
+        # rows of class c start at this offset in the label-sorted order
+        classes = sorted(counts)
+        offset = dict(zip(classes, np.cumsum([0] + [counts[c] for c in classes[:-1]])))
+        rows = np.sort(np.concatenate([order[offset[c] + r] for c, r in batch_ranks]))
+        weight = cached["weight"]
+        parts.append(
+            (
+                np.asarray(cached["X"][rows]),
+                np.asarray(cached["y"][rows]),
+                np.ones(rows.size) if weight is None else np.asarray(weight[rows], dtype=float),
+            )
+        )
+    if not parts:
+        return None
+    return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+
+def _train_incremental(cfg: dict, model_path: Path, lineage: dict, verbose: int):
+    """Add trees fitted on the input directories not yet in ``lineage``."""
+    if cfg.get("samples"):
+        raise ValueError("Incremental training needs 'input_dirs', not a 'samples' table")
+    known = {r for batch in lineage["batches"] for r in batch["regions"]}
+    new_dirs = [str(d) for d in cfg.get("input_dirs", []) if str(d) not in known]
+    removed = known - {str(d) for d in cfg.get("input_dirs", [])}
+    if removed:
+        print(f"Warning: the model still contains trees trained on {sorted(removed)}")
+    if not new_dirs:
+        print(
+            f"No new input directories for {model_path}; "
+            "retrain with --force and incremental: false to apply other changes"
+        )
+        return None
+
+    clf = joblib.load(model_path)
+    samples = prepare_training_data({**cfg, "input_dirs": new_dirs})
+    encoding = samples["info"]["encoding"]
+    if encoding != getattr(clf, "feature_encoding_", None):
+        raise ValueError(
+            f"Features of {new_dirs} do not match the encoding the model was trained "
+            f"with: {encoding} vs {getattr(clf, 'feature_encoding_', None)}"
+        )
+    report = dict(samples["info"]["report"])
+    X, y = samples["X"], samples["y"]
+    weight = samples["weight"] if samples["weight"] is not None else np.ones(y.size)
+    # a few earlier samples keep every class present in the new trees
+    per_class = int(cfg.get("replay_per_class", 1000))
+    replay = replay_samples(lineage["batches"], per_class) if per_class > 0 else None
+    if replay is not None:
+        X = np.concatenate([X, replay[0]])
+        y = np.concatenate([y, replay[1]])
+        weight = np.concatenate([weight, replay[2]])
+
+    first = len(clf.estimators_)
+    n_new = int(cfg.get("incremental_trees", cfg.get("n_estimators", 100)))
+    start = time.perf_counter()
+    clf = add_trees(
+        clf,
+        X.T,
+        y,
+        n_new,
+        verbose=verbose,
+        nodata=encoding["nodata"],
+        sample_weight=weight,
+        backend=TrainingBackend.from_config(cfg),
+    )
+    report["fit_seconds"] = time.perf_counter() - start
+    report["model_type"] = "random_forest"
+    _report_fit(report, clf)
+    batch = {
+        "trees": [first, len(clf.estimators_)],
+        "regions": new_dirs,
+        "samples": str(samples["path"]) if "path" in samples else None,
+        "n_samples": int(samples["y"].size),
+        "class_counts": class_counts(samples["y"]),
+        "replay_samples": 0 if replay is None else int(replay[1].size),
+    }
+    return clf, report, batch
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Train classification model")
+    parser.add_argument("--config", required=True, help="YAML config file")
+    parser.add_argument("--output-dir", required=True, help="Directory for model")
+    parser.add_argument(
+        "--verbose",
+        type=int,
+        default=0,
+        help="Verbosity level for RandomForest training",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Retrain even if the features, labels and config are unchanged",
+    )
+    parser.add_argument(
+        "--cv-only",
+        action="store_true",
+        help="Only run the spatial cross-validation (cv section) and write cv_metrics.json",
     )
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        cfg = yaml.safe_load(f)
+
+    output_dir = Path(args.output_dir)
+    if args.cv_only:
+        report = run_cross_validation(cfg, prepare_training_data(cfg), output_dir)
+        print(json.dumps({k: report[k] for k in ("overall_accuracy", "macro_f1", "per_fold")}))
+        return
 
     model_path = output_dir / cfg.get("model_name", "model.pkl")
+    flat_path = model_path.with_suffix(FLAT_SUFFIX) if cfg.get("export_flat", False) else None
+    cache = StageCache(
+        model_path.parent / f"{model_path.name}{SUFFIX}",
+        "train",
+        inputs=training_inputs(cfg),
+        config=cfg,
+        outputs=[p for p in (model_path, flat_path, model_path.parent / "lineage.json") if p],
+    )
+    if cache.skip(args.force):
+        return
+
+    lineage_path = model_path.parent / "lineage.json"
+    if cfg.get("incremental", False) and model_path.exists() and lineage_path.exists():
+        lineage = json.loads(lineage_path.read_text())
+        result = _train_incremental(cfg, model_path, lineage, args.verbose)
+        if result is None:
+            return
+        clf, report, batch = result
+    else:
+        lineage = {"batches": []}
+        clf, report, batch = _train_full(cfg, args.verbose, model_path.parent)
+    batch["created"] = datetime.now().isoformat(timespec="seconds")
+    lineage["batches"].append(batch)
+    report["lineage"] = batch
+
     model_path.parent.mkdir(parents=True, exist_ok=True)
     joblib.dump(clf, model_path)
+    if flat_path is not None:
+        report["flat_model_bytes"] = save_flat_forest(clf, flat_path)
+    with open(model_path.parent / "train_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    with open(lineage_path, "w") as f:
+        json.dump(lineage, f, indent=2)
+    print(json.dumps(report))
 
     shutil.copy(args.config, model_path.parent / Path(args.config).name)
+    cache.record()
 
 
 if __name__ == "__main__":
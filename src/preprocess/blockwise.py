@@ -0,0 +1,176 @@
+"""Block-wise cloud mask → band stack → feature engine.
+
+Instead of materializing full-scene masks and band stacks, the raster is
+processed ``block_rows`` lines at a time. Each block of ``SCL``/``dataMask``
+and spectral bands is read into preallocated float32 buffers, masked, turned
+into features and written to the output array, which is typically a
+memory-mapped feature store (see :mod:`src.preprocess.feature_store`). Peak memory is a few blocks instead of several
+copies of the scene.
+"""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from .cloudmask import CLOUDY_VALUES, cloud_mask_array
+from .feature_store import QUANTIZED_DTYPE, QUANTIZED_NODATA, create_feature_store
+
+
+class BandBlockReader:
+    """Read cloud-masked float32 band blocks.
+
+    Parameters
+    ----------
+    bands : Path or list[Path]
+        Multi-band raster read at ``indexes`` or a list of single-band rasters,
+        as returned by :func:`src.pipeline.preprocess.resolve_band_inputs`.
+    indexes : list[int] or None
+        1-based band indexes when ``bands`` is a multi-band raster.
+    scl_path : Path
+        ``SCL`` scene classification raster.
+    mask_path : Path, optional
+        ``dataMask`` raster where 0 marks invalid pixels.
+    """
+
+    def __init__(self, bands, indexes, scl_path, mask_path=None, cloudy_values=CLOUDY_VALUES):
+        self.cloudy_values = cloudy_values
+        if indexes is not None:
+            self._bands = [(rasterio.open(bands), list(indexes))]
+        else:
+            self._bands = [(rasterio.open(p), [1]) for p in bands]
+        self._scl = rasterio.open(scl_path)
+        self._mask = rasterio.open(mask_path) if mask_path else None
+        first = self._bands[0][0]
+        self.count = sum(len(idx) for _, idx in self._bands)
+        # dtype of the band files; blocks are always read as float32
+        self.source_dtype = first.dtypes[0]
+        self.meta = first.meta.copy()
+        self.meta.update(count=self.count, dtype="float32")
+
+    def read(self, window: Window, out: np.ndarray | None = None) -> np.ndarray:
+        """Return the masked ``(bands, rows, cols)`` block for ``window``."""
+        if out is None:
+            out = np.empty((self.count, int(window.height), int(window.width)), dtype=np.float32)
+        i = 0
+        for src, idx in self._bands:
+            src.read(idx, window=window, out=out[i : i + len(idx)])
+            i += len(idx)
+        scl = self._scl.read(1, window=window)
+        data_mask = self._mask.read(1, window=window) if self._mask else None
+        out[:, cloud_mask_array(scl, data_mask, self.cloudy_values)] = np.nan
+        return out
+
+    def close(self) -> None:
+        for src, _ in self._bands:
+            src.close()
+        self._scl.close()
+        if self._mask:
+            self._mask.close()
+
+    def __enter__(self) -> "BandBlockReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def process_blocks(
+    read_block: Callable[[Window, np.ndarray], np.ndarray],
+    n_bands: int,
+    height: int,
+    width: int,
+    target: np.ndarray,
+    feature_fn: Callable[[np.ndarray, np.ndarray], np.ndarray],
+    block_rows: int = 512,
+    halo: int = 0,
+) -> np.ndarray:
+    """Compute features block by block into ``target``.
+
+    Parameters
+    ----------
+    read_block : callable
+        ``read_block(window, out)`` fills ``out`` with the masked band block.
+    n_bands : int
+        Number of bands returned by ``read_block``.
+    height, width : int
+        Raster size.
+    target : np.ndarray
+        ``(features, height, width)`` output, e.g. an ``open_memmap`` array.
+    feature_fn : callable
+        ``feature_fn(stack, out)`` writes the features of a band block to
+        ``out``, e.g. :meth:`src.preprocess.features.FeatureSet.compute`.
+    block_rows : int
+        Raster rows processed per block.
+    halo : int
+        Extra rows read above and below each block (clipped at the raster
+        edges) for neighbourhood features, see
+        :attr:`src.preprocess.features.FeatureSet.halo`. Only the block rows
+        are written to ``target``, so the result does not depend on
+        ``block_rows``.
+    """
+    band_buf = feat_buf = None
+    for row in range(0, height, block_rows):
+        rows = min(block_rows, height - row)
+        top = min(halo, row)
+        bottom = min(halo, height - row - rows)
+        ext = top + rows + bottom
+        if band_buf is None or band_buf.shape[1] != ext:
+            band_buf = np.empty((n_bands, ext, width), dtype=np.float32)
+            feat_buf = np.empty((target.shape[0], ext, width), dtype=np.float32)
+        stack = read_block(Window(0, row - top, width, ext), band_buf)
+        target[:, row : row + rows] = feature_fn(stack, feat_buf)[:, top : top + rows]
+    return target
+
+
+def compute_window(
+    read_block: Callable[[Window], np.ndarray],
+    feature_fn: Callable[[np.ndarray], np.ndarray],
+    window: Window,
+    height: int,
+    width: int,
+    halo: int = 0,
+) -> np.ndarray:
+    """Compute the features of one window, reading ``halo`` pixels around it.
+
+    The halo is clipped at the raster edges, so the values equal those
+    written by :func:`process_blocks`.
+    """
+    (row0, row1), (col0, col1) = window.toranges()
+    top, left = max(row0 - halo, 0), max(col0 - halo, 0)
+    bottom, right = min(row1 + halo, height), min(col1 + halo, width)
+    features = feature_fn(read_block(Window(left, top, right - left, bottom - top)))
+    return features[:, row0 - top : row1 - top, col0 - left : col1 - left]
+
+
+def open_feature_output(
+    path: Path,
+    shape: tuple[int, int, int],
+    feature_names: list[str],
+    meta: dict,
+    quantization: tuple[list[float], list[float]] | None = None,
+) -> np.ndarray:
+    """Create the feature output array for ``path``.
+
+    ``.feat`` feature stores and ``.npy`` files are memory-mapped and filled
+    in place; for the legacy ``.npz`` format an in-memory array is returned
+    and must be saved with ``np.savez`` afterwards. ``quantization`` is a
+    ``(scale, offset)`` pair creating an int16 feature store.
+    """
+    suffix = Path(path).suffix
+    if quantization is not None:
+        if suffix in {".npy", ".npz"}:
+            raise ValueError("Quantized features require the .feat format")
+        scale, offset = quantization
+        return create_feature_store(
+            path, shape, feature_names, meta,
+            dtype=QUANTIZED_DTYPE, nodata=QUANTIZED_NODATA, scale=scale, offset=offset,
+        )
+    if suffix == ".npy":
+        return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+    if suffix == ".npz":
+        return np.empty(shape, dtype=np.float32)
+    return create_feature_store(path, shape, feature_names, meta)
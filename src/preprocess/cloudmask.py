@@ -1,8 +1,22 @@
 import numpy as np
 import rasterio
 
+CLOUDY_VALUES = (3, 7, 8, 9, 10, 11)
 
-def cloud_mask(scl_path, mask_path=None, cloudy_values=(3, 7, 8, 9, 10, 11)):
+
+def cloud_mask_array(scl, data_mask=None, cloudy_values=CLOUDY_VALUES):
+    """Return a boolean cloud mask from ``SCL``/``dataMask`` arrays.
+
+    ``True`` marks pixels whose ``SCL`` value is in ``cloudy_values`` or whose
+    ``dataMask`` is 0.
+    """
+    mask = np.isin(scl, cloudy_values)
+    if data_mask is not None:
+        mask |= data_mask == 0
+    return mask
+
+
+def cloud_mask(scl_path, mask_path=None, cloudy_values=CLOUDY_VALUES):
     """Return a boolean cloud mask from Sentinel‑2 ``SCL``/``dataMask`` bands.
 
     Parameters
@@ -21,9 +35,8 @@ def cloud_mask(scl_path, mask_path=None, cloudy_values=(3, 7, 8, 9, 10, 11)):
     """
     with rasterio.open(scl_path) as src:
         scl = src.read(1)
-    mask = np.isin(scl, cloudy_values)
+    data_mask = None
     if mask_path:
         with rasterio.open(mask_path) as src:
             data_mask = src.read(1)
-        mask |= data_mask == 0
-    return mask
+    return cloud_mask_array(scl, data_mask, cloudy_values)
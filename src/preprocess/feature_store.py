@@ -0,0 +1,249 @@
+"""Memory-mappable feature store.
+
+A feature store is a single file holding a ``(features, height, width)``
+array together with everything needed to interpret it::
+
+    b"RSFEAT01"                 8-byte magic
+    <uint32 little endian>      length of the JSON header in bytes
+    {...JSON header...}         shape, dtype, feature names, CRS,
+                                geotransform, nodata, optional per-feature
+                                scale/offset (space padded)
+    raw C-order array           starts at a 64-byte aligned offset
+
+Because the array is stored uncompressed it can be memory-mapped, so
+training and prediction read only the windows or pixels they touch and
+opening a store costs the same regardless of the scene size.
+
+Stores may be quantized to int16: feature ``i`` is then stored as
+``round((value - offset[i]) / scale[i])`` with ``-32768`` marking invalid
+pixels, halving the file size compared to float32. Models can be trained
+and applied on the integer codes directly because the mapping is monotonic.
+"""
+from __future__ import annotations
+
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+from affine import Affine
+from rasterio.windows import Window
+
+MAGIC = b"RSFEAT01"
+ALIGN = 64
+SUFFIX = ".feat"
+
+QUANTIZED_DTYPE = "int16"
+QUANTIZED_NODATA = -32768
+QUANTIZED_MAX = 32767
+
+
+def quantization_params(value_ranges) -> tuple[list[float], list[float]]:
+    """Per-feature ``(scale, offset)`` mapping ``(low, high)`` onto int16."""
+    scale = [(high - low) / (2 * QUANTIZED_MAX) for low, high in value_ranges]
+    offset = [(high + low) / 2 for low, high in value_ranges]
+    return scale, offset
+
+
+def _broadcast(values, ndim: int) -> np.ndarray:
+    return np.asarray(values, dtype=np.float32).reshape((-1,) + (1,) * (ndim - 1))
+
+
+def quantize(block: np.ndarray, scale, offset, out: np.ndarray | None = None) -> np.ndarray:
+    """Encode a float ``(features, ...)`` block as int16 codes.
+
+    Values are clipped to the representable range and NaN becomes
+    :data:`QUANTIZED_NODATA`. ``block`` is used as scratch space.
+    """
+    if out is None:
+        out = np.empty(block.shape, dtype=QUANTIZED_DTYPE)
+    invalid = np.isnan(block)
+    np.subtract(block, _broadcast(offset, block.ndim), out=block)
+    np.divide(block, _broadcast(scale, block.ndim), out=block)
+    np.rint(block, out=block)
+    np.clip(block, -QUANTIZED_MAX, QUANTIZED_MAX, out=block)
+    block[invalid] = QUANTIZED_NODATA
+    np.copyto(out, block, casting="unsafe")
+    return out
+
+
+def dequantize(block: np.ndarray, scale, offset) -> np.ndarray:
+    """Decode int16 codes to float32 values with NaN for nodata."""
+    values = block.astype(np.float32)
+    values *= _broadcast(scale, block.ndim)
+    values += _broadcast(offset, block.ndim)
+    values[block == QUANTIZED_NODATA] = np.nan
+    return values
+
+
+def feature_encoding(feature_names, dtype="float32", nodata=None, scale=None, offset=None) -> dict:
+    """How feature values are represented; models record this at training."""
+    return {
+        "feature_names": list(feature_names),
+        "dtype": np.dtype(dtype).name,
+        "nodata": nodata,
+        "scale": None if scale is None else [float(v) for v in scale],
+        "offset": None if offset is None else [float(v) for v in offset],
+    }
+
+
+def _header_from_meta(
+    shape, dtype, feature_names, meta, nodata, scale=None, offset=None
+) -> dict:
+    crs = meta.get("crs")
+    header = {
+        "shape": [int(v) for v in shape],
+        "dtype": np.dtype(dtype).name,
+        "feature_names": list(feature_names),
+        "crs": crs.to_string() if hasattr(crs, "to_string") else crs,
+        "transform": list(meta["transform"])[:6],
+        "nodata": nodata,
+    }
+    if scale is not None:
+        header["scale"] = [float(v) for v in scale]
+        header["offset"] = [float(v) for v in offset]
+    return header
+
+
+def create_feature_store(
+    path: Path,
+    shape: tuple[int, int, int],
+    feature_names: list[str],
+    meta: dict,
+    dtype="float32",
+    nodata=None,
+    scale=None,
+    offset=None,
+) -> np.memmap:
+    """Create a feature store and return its writable array.
+
+    Parameters
+    ----------
+    path : Path
+        Output file, conventionally with the ``.feat`` suffix.
+    shape : tuple of int
+        ``(features, height, width)``.
+    feature_names : list of str
+        Name of each feature layer.
+    meta : dict
+        Rasterio profile providing ``crs`` and ``transform``.
+    dtype : str, optional
+        Storage dtype.
+    nodata : float, optional
+        Value marking invalid pixels. ``None`` means NaN for float stores.
+    scale, offset : list of float, optional
+        Per-feature quantization parameters, see :func:`quantize`.
+    """
+    header = _header_from_meta(shape, dtype, feature_names, meta, nodata, scale, offset)
+    blob = json.dumps(header).encode("utf-8")
+    offset = len(MAGIC) + 4 + len(blob)
+    pad = -offset % ALIGN
+    blob += b" " * pad
+    offset += pad
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(blob)) + blob)
+        f.truncate(offset + nbytes)
+    return np.memmap(path, dtype=dtype, mode="r+", offset=offset, shape=tuple(shape))
+
+
+def _read_header(path: Path) -> tuple[dict, int]:
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a feature store")
+        (length,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(length).decode("utf-8"))
+    return header, len(MAGIC) + 4 + length
+
+
+class FeatureStore:
+    """Read access to a feature array and its georeferencing.
+
+    Use :meth:`open` for ``.feat`` files; legacy ``.npy``/``.npz`` outputs
+    with a ``.meta.json`` sidecar are wrapped transparently.
+    """
+
+    def __init__(self, data: np.ndarray, header: dict):
+        self.data = data
+        self.header = header
+        self.feature_names: list[str] = header.get("feature_names", [])
+        self.nodata = header.get("nodata")
+        self.scale: list[float] | None = header.get("scale")
+        self.offset: list[float] | None = header.get("offset")
+
+    @classmethod
+    def open(cls, path: Path, meta_path: Path | None = None) -> "FeatureStore":
+        path = Path(path)
+        if path.suffix not in {".npy", ".npz"}:
+            header, offset = _read_header(path)
+            data = np.memmap(
+                path, dtype=header["dtype"], mode="r", offset=offset, shape=tuple(header["shape"])
+            )
+            return cls(data, header)
+
+        data = np.load(path, mmap_mode="r")
+        if isinstance(data, np.lib.npyio.NpzFile):
+            with data:
+                data = data["features"]
+        meta = json.loads(Path(meta_path or path.with_suffix(".meta.json")).read_text())
+        header = _header_from_meta(
+            data.shape, data.dtype, meta.get("feature_names", []), meta, None
+        )
+        return cls(data, header)
+
+    @property
+    def shape(self) -> tuple[int, int, int]:
+        return tuple(self.data.shape)
+
+    @property
+    def quantized(self) -> bool:
+        return self.scale is not None
+
+    @property
+    def encoding(self) -> dict:
+        """See :func:`feature_encoding`."""
+        return feature_encoding(
+            self.feature_names, self.data.dtype, self.nodata, self.scale, self.offset
+        )
+
+    @property
+    def profile(self) -> dict:
+        """Rasterio profile matching the feature grid."""
+        count, height, width = self.shape
+        return {
+            "driver": "GTiff",
+            "dtype": self.data.dtype.name,
+            "nodata": self.nodata,
+            "width": width,
+            "height": height,
+            "count": count,
+            "crs": self.header["crs"],
+            "transform": Affine(*self.header["transform"]),
+        }
+
+    def read_window(self, window: Window) -> np.ndarray:
+        """Return the ``(features, rows, cols)`` block covered by ``window``."""
+        (row0, row1), (col0, col1) = window.toranges()
+        return np.asarray(self.data[:, int(row0) : int(row1), int(col0) : int(col1)])
+
+    def read_pixels(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Return the ``(n, features)`` values of individual pixels."""
+        return np.asarray(self.data[:, rows, cols]).T
+
+    def read_flat(self, index: np.ndarray) -> np.ndarray:
+        """Return the ``(features, n)`` values at flat pixel indexes."""
+        width = self.shape[2]
+        index = np.asarray(index)
+        return np.asarray(self.data[:, index // width, index % width])
+
+    def to_float(self, block: np.ndarray) -> np.ndarray:
+        """Return ``block`` as float32 values with NaN for invalid pixels."""
+        if self.quantized:
+            return dequantize(block, self.scale, self.offset)
+        return np.asarray(block, dtype=np.float32)
+
+    def valid_mask(self, block: np.ndarray) -> np.ndarray:
+        """Pixels of a ``(features, ...)`` block where every feature is valid."""
+        if self.nodata is None:
+            return np.all(np.isfinite(block), axis=0)
+        return np.all(block != self.nodata, axis=0)
@@ -1,5 +1,313 @@
+import re
+from functools import partial
+
 import numpy as np
 
+# Sentinel-2 L2A bands are stored as reflectance * 10000.
+REFLECTANCE_SCALE = 1e-4
+DEFAULT_INDICES = ["NDVI", "NDWI"]
+
+# Value ranges used when features are quantized to int16.
+NORMALIZED_RANGE = (-1.0, 1.0)
+# Raw bands span the range of their source dtype (see raw_band_range); the
+# default covers the uint16 digital numbers of Sentinel-2 L2A.
+RAW_BAND_RANGE = (0.0, 65535.0)
+RATIO_RANGE = (0.0, 64.0)
+
+# name -> (required band names, kernel, value range). A kernel writes one
+# feature into ``out`` using the preallocated float32 scratch ``tmp`` and the
+# boolean scratch ``zero`` so that no full-size temporaries are allocated.
+FEATURES = {}
+
+
+def register_feature(name, bands, value_range=NORMALIZED_RANGE):
+    """Register a spectral index computed from the named ``bands``.
+
+    ``value_range`` bounds the index values and sets the int16 quantization
+    step; values outside it are clipped when quantizing.
+    """
+
+    def decorator(fn):
+        FEATURES[name] = (tuple(bands), fn, tuple(value_range))
+        return fn
+
+    return decorator
+
+
+def _guarded_divide(out, denom, zero):
+    """``out /= denom`` with NaN where the denominator is zero."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        np.divide(out, denom, out=out)
+    np.equal(denom, 0, out=zero)
+    np.copyto(out, np.nan, where=zero)
+    return out
+
+
+def _normalized_difference(a, b, out, tmp, zero):
+    np.add(a, b, out=tmp)
+    np.subtract(a, b, out=out)
+    return _guarded_divide(out, tmp, zero)
+
+
+@register_feature("NDVI", ["B08", "B04"])
+def _ndvi(nir, red, out, tmp, zero, scale):
+    return _normalized_difference(nir, red, out, tmp, zero)
+
+
+@register_feature("NDWI", ["B08", "B11"])
+def _ndwi(nir, swir, out, tmp, zero, scale):
+    return _normalized_difference(nir, swir, out, tmp, zero)
+
+
+@register_feature("MNDWI", ["B03", "B11"])
+def _mndwi(green, swir, out, tmp, zero, scale):
+    return _normalized_difference(green, swir, out, tmp, zero)
+
+
+@register_feature("NDBI", ["B11", "B08"])
+def _ndbi(swir, nir, out, tmp, zero, scale):
+    return _normalized_difference(swir, nir, out, tmp, zero)
+
+
+@register_feature("EVI", ["B08", "B04", "B02"], value_range=(-2.5, 2.5))
+def _evi(nir, red, blue, out, tmp, zero, scale):
+    # 2.5 * (N - R) / (N + 6R - 7.5B + 1) on reflectance; the constant is
+    # rescaled so the digital numbers can be used directly.
+    np.multiply(red, 6.0, out=tmp)
+    np.add(tmp, nir, out=tmp)
+    np.multiply(blue, 7.5, out=out)
+    np.subtract(tmp, out, out=tmp)
+    np.add(tmp, 1.0 / scale, out=tmp)
+    np.subtract(nir, red, out=out)
+    np.multiply(out, 2.5, out=out)
+    return _guarded_divide(out, tmp, zero)
+
+
+@register_feature("SAVI", ["B08", "B04"], value_range=(-1.5, 1.5))
+def _savi(nir, red, out, tmp, zero, scale, soil=0.5):
+    # (1 + L) * (N - R) / (N + R + L) with L = 0.5 in reflectance units
+    np.add(nir, red, out=tmp)
+    np.add(tmp, soil / scale, out=tmp)
+    np.subtract(nir, red, out=out)
+    np.multiply(out, 1.0 + soil, out=out)
+    return _guarded_divide(out, tmp, zero)
+
+
+def _raw_band(band, out, tmp, zero, scale):
+    np.copyto(out, band)
+    return out
+
+
+def _band_ratio(a, b, out, tmp, zero, scale):
+    np.copyto(out, a)
+    return _guarded_divide(out, b, zero)
+
+
+# Neighbourhood features "<base>_<op><size>", e.g. "NDVI_mean5" or
+# "B08_contrast7": statistics of a feature over a size x size window.
+FOCAL_OPS = ("mean", "std", "var", "contrast")
+_FOCAL_RE = re.compile(r"(?P<base>.+)_(?P<op>%s)(?P<size>\d+)" % "|".join(FOCAL_OPS))
+
+
+def _running_sum(a, size, axis):
+    """Sums over ``size`` consecutive elements centred on each element.
+
+    Uses a cumulative sum so the cost does not depend on ``size``; the
+    window is truncated at the array edges.
+    """
+    r = size // 2
+    n = a.shape[axis]
+    shape = list(a.shape)
+    shape[axis] = n + 2 * r + 1
+    c = np.zeros(shape, dtype=np.float64)
+    body = [slice(None)] * a.ndim
+    body[axis] = slice(r + 1, r + 1 + n)
+    np.cumsum(a, axis=axis, out=c[tuple(body)])
+    tail, last = list(body), list(body)
+    tail[axis] = slice(r + 1 + n, None)
+    last[axis] = slice(r + n, r + n + 1)
+    c[tuple(tail)] = c[tuple(last)]
+    hi, lo = list(body), list(body)
+    hi[axis] = slice(size, None)
+    lo[axis] = slice(None, n)
+    return c[tuple(hi)] - c[tuple(lo)]
+
+
+def _box_sum(a, size):
+    """Sum over the ``size`` x ``size`` window around each pixel."""
+    return _running_sum(_running_sum(a, size, 0), size, 1)
+
+
+def _focal_moments(x, valid, size, second=True):
+    """Window mean and, if ``second``, variance of the valid pixels of ``x``."""
+    x = np.where(valid, x, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv_count = 1.0 / _box_sum(valid, size)
+    mean = _box_sum(x, size)
+    mean *= inv_count
+    if not second:
+        return mean, None
+    var = _box_sum(np.square(x, dtype=np.float64), size)
+    var *= inv_count
+    var -= np.square(mean)
+    np.maximum(var, 0.0, out=var)
+    return mean, var
+
+
+def _focal_contrast(x, valid, size):
+    # GLCM-lite: mean squared difference of horizontally and vertically
+    # adjacent pixel pairs in the window (contrast without grey levels)
+    total = np.zeros(x.shape, dtype=np.float64)
+    pairs = np.zeros(x.shape, dtype=np.float64)
+    for axis in (0, 1):
+        lead = [slice(None)] * 2
+        lead[axis] = slice(None, -1)
+        tail = [slice(None)] * 2
+        tail[axis] = slice(1, None)
+        lead, tail = tuple(lead), tuple(tail)
+        ok = valid[lead] & valid[tail]
+        total[lead] += np.where(ok, np.square(x[tail] - x[lead], dtype=np.float64), 0.0)
+        pairs[lead] += ok
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return _box_sum(total, size) / _box_sum(pairs, size)
+
+
+def _focal(base, op, size, *args):
+    """Kernel applying the neighbourhood ``op`` to the ``base`` feature."""
+    *bands, out, tmp, zero, scale = args
+    base(*bands, out, tmp, zero, scale)
+    valid = np.isfinite(out)
+    if op == "contrast":
+        result = _focal_contrast(out, valid, size)
+    else:
+        mean, var = _focal_moments(out, valid, size, second=op != "mean")
+        result = mean if op == "mean" else var
+        if op == "std":
+            np.sqrt(var, out=var)
+    np.copyto(out, result, casting="same_kind")
+    np.copyto(out, np.nan, where=~valid)
+    return out
+
+
+def _focal_range(op, value_range):
+    low, high = value_range
+    half = (high - low) / 2
+    return {
+        "mean": (low, high),
+        "std": (0.0, half),
+        "var": (0.0, half * half),
+        "contrast": (0.0, (high - low) ** 2),
+    }[op]
+
+
+def feature_halo(name):
+    """Pixels of context a feature needs on each side of a block."""
+    m = _FOCAL_RE.fullmatch(name)
+    if not m:
+        return 0
+    # contrast pairs each pixel with its right/lower neighbour
+    return int(m["size"]) // 2 + (m["op"] == "contrast")
+
+
+def raw_band_range(dtype=None):
+    """Value range of raw band features for bands stored as ``dtype``.
+
+    Integer dtypes use their full range so that no valid value (including
+    saturated pixels and fill values such as 65535) is clipped when
+    quantizing; other dtypes fall back to :data:`RAW_BAND_RANGE`. For
+    uint16 the int16 step is 65535 / 65534 DN, so values decode to within
+    half a step.
+    """
+    if dtype is not None and np.issubdtype(np.dtype(dtype), np.integer):
+        info = np.iinfo(np.dtype(dtype))
+        return float(info.min), float(info.max)
+    return RAW_BAND_RANGE
+
+
+def resolve_feature(name, band_names, band_range=RAW_BAND_RANGE):
+    """Return ``(band indexes, kernel, value range)`` for a feature name.
+
+    ``name`` is a registered index (``"NDVI"``), a raw band (``"B08"``), a
+    band ratio (``"B08/B04"``) or a neighbourhood statistic of any of these
+    (``"NDVI_std5"``, see :data:`FOCAL_OPS`). ``band_range`` bounds raw
+    band values, see :func:`raw_band_range`.
+    """
+    m = _FOCAL_RE.fullmatch(name)
+    if m:
+        size = int(m["size"])
+        if size < 3 or size % 2 == 0:
+            raise ValueError(f"Window size of '{name}' must be an odd number >= 3")
+        idx, base, value_range = resolve_feature(m["base"], band_names, band_range)
+        kernel = partial(_focal, base, m["op"], size)
+        return idx, kernel, _focal_range(m["op"], value_range)
+    if name in FEATURES:
+        bands, kernel, value_range = FEATURES[name]
+    elif name in band_names:
+        bands, kernel, value_range = (name,), _raw_band, tuple(band_range)
+    elif re.fullmatch(r"\w+/\w+", name):
+        bands, kernel, value_range = tuple(name.split("/")), _band_ratio, RATIO_RANGE
+    else:
+        raise ValueError(
+            f"Unknown feature '{name}'. Use one of {sorted(FEATURES)}, "
+            f"a band name, a ratio such as 'B08/B04' or a neighbourhood "
+            f"statistic such as 'NDVI_std5'"
+        )
+    missing = [b for b in bands if b not in band_names]
+    if missing:
+        raise ValueError(f"Feature '{name}' needs bands {missing} not in {band_names}")
+    return [band_names.index(b) for b in bands], kernel, value_range
+
+
+class FeatureSet:
+    """A list of features evaluated in one pass over a band block.
+
+    Parameters
+    ----------
+    names : list of str
+        Feature names, see :func:`resolve_feature`.
+    band_names : list of str
+        Names of the bands in the stacks passed to :meth:`compute`.
+    reflectance_scale : float, optional
+        Factor converting band values to reflectance (used by EVI/SAVI).
+    band_dtype : str or np.dtype, optional
+        Dtype of the source band files; sets the quantization range of raw
+        band features (see :func:`raw_band_range`).
+    """
+
+    def __init__(self, names, band_names, reflectance_scale=REFLECTANCE_SCALE, band_dtype=None):
+        self.names = list(names)
+        self.band_names = list(band_names)
+        self.scale = reflectance_scale
+        band_range = raw_band_range(band_dtype)
+        self._kernels = [resolve_feature(n, self.band_names, band_range) for n in self.names]
+        self._tmp = None
+        self._zero = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def halo(self):
+        """Pixels of context around a block needed by :meth:`compute`."""
+        return max((feature_halo(n) for n in self.names), default=0)
+
+    @property
+    def value_ranges(self):
+        """``(low, high)`` bounds of every feature."""
+        return [value_range for _, _, value_range in self._kernels]
+
+    def compute(self, stack, out=None):
+        """Write all features of ``stack`` ``(bands, ...)`` into ``out``."""
+        shape = stack.shape[1:]
+        if out is None:
+            out = np.empty((len(self),) + shape, dtype=np.float32)
+        if self._tmp is None or self._tmp.shape != shape:
+            self._tmp = np.empty(shape, dtype=np.float32)
+            self._zero = np.empty(shape, dtype=bool)
+        for i, (idx, kernel, _) in enumerate(self._kernels):
+            kernel(*(stack[j] for j in idx), out[i], self._tmp, self._zero, self.scale)
+        return out
+
 
 def ndvi(nir, red):
     """Compute NDVI."""
@@ -13,8 +321,9 @@ def ndwi(nir, swir):
 
 def compute_features(stack, red_idx, nir_idx, swir_idx):
     """Compute NDVI and NDWI from a band stack."""
-    red = stack[red_idx]
-    nir = stack[nir_idx]
-    swir = stack[swir_idx]
-    features = np.stack([ndvi(nir, red), ndwi(nir, swir)])
-    return features.astype('float32')
+    out = np.empty((2,) + stack.shape[1:], dtype=np.float32)
+    tmp = np.empty(stack.shape[1:], dtype=np.float32)
+    zero = np.empty(stack.shape[1:], dtype=bool)
+    _normalized_difference(stack[nir_idx], stack[red_idx], out[0], tmp, zero)
+    _normalized_difference(stack[nir_idx], stack[swir_idx], out[1], tmp, zero)
+    return out
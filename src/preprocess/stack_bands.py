@@ -2,8 +2,21 @@ import numpy as np
 import rasterio
 
 
-def stack_bands(band_paths, mask):
-    """Stack multiple bands applying a cloud mask."""
+def stack_bands(band_paths, mask, indexes=None):
+    """Stack multiple bands applying a cloud mask.
+
+    ``band_paths`` is a list of single-band rasters. When ``indexes`` is
+    given, ``band_paths`` is instead a single multi-band raster (such as
+    ``BANDS.tif``) and ``indexes`` lists the 1-based bands read from it.
+    """
+    if indexes is not None:
+        with rasterio.open(band_paths) as src:
+            stack = src.read(list(indexes), out_dtype="float32")
+            meta = src.meta.copy()
+        stack[:, mask] = np.nan
+        meta.update(count=len(indexes), dtype='float32')
+        return stack, meta
+
     arrays = []
     meta = None
     for path in band_paths:
@@ -6,10 +6,15 @@ import numpy as np
 import rasterio
 
 from ..preprocess.cloudmask import cloud_mask
+from .manifest import SUFFIX, StageCache
 
 
-def apply_cloud_mask(scene_dir: Path) -> None:
-    """Mask cloudy pixels in all band files of a scene folder."""
+def apply_cloud_mask(scene_dir: Path, force: bool = False) -> None:
+    """Mask cloudy pixels in all band files of a scene folder.
+
+    The scene is skipped when its inputs and outputs are unchanged since the
+    last run, unless ``force`` is set.
+    """
 
     band_stack = scene_dir / "BANDS.tif"
     scl_file = scene_dir / "SCL.tif"
@@ -18,8 +23,17 @@ def apply_cloud_mask(scene_dir: Path) -> None:
     if not band_stack.exists() or not scl_file.exists():
         return
 
-    # BANDS.tifが存在し、BANDS_raw.tifが未作成ならバックアップ
     band_stack_raw = scene_dir / "BANDS_raw.tif"
+    cache = StageCache(
+        scene_dir / f"cloud_removal{SUFFIX}",
+        "cloud_removal",
+        inputs=[band_stack_raw, scl_file, mask_file],
+        outputs=[band_stack, *sorted(scene_dir.glob("B??.tif"))],
+    )
+    if cache.skip(force):
+        return
+
+    # BANDS.tifが存在し、BANDS_raw.tifが未作成ならバックアップ
     if band_stack.exists() and not band_stack_raw.exists():
         import shutil
         shutil.copy2(band_stack, band_stack_raw)
@@ -49,9 +63,11 @@ def apply_cloud_mask(scene_dir: Path) -> None:
             dst.write(arr, 1)
         tmp_band.replace(band_file)
 
+    cache.record()
+
 
-def apply_cloud_mask_to_directory(out_dir: Path) -> None:
+def apply_cloud_mask_to_directory(out_dir: Path, force: bool = False) -> None:
     """Apply cloud masking to all dated subfolders."""
     for sub in out_dir.iterdir():
         if sub.is_dir():
-            apply_cloud_mask(sub)
+            apply_cloud_mask(sub, force=force)
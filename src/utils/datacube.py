@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Chunked time-series datacube built from dated Sentinel-2 folders.
+
+``build_datacube`` ingests the ``BANDS.tif``/``SCL.tif`` (and ``MASK.tif``)
+files of every dated subfolder into a single ``float32`` array with shape
+``(time, channel, y, x)`` where the channels are the spectral bands followed
+by ``SCL`` (and ``MASK``). On disk the array is stored chunk-major in one
+``.npy`` file::
+
+    datacube/
+        cube.json   # dates, channel names, grid, chunk size, layer profiles
+        data.npy    # (chunk_rows, chunk_cols, time, channel, cy, cx)
+
+so it can be memory-mapped, a spatial window only touches the chunks it
+overlaps and the full time series of a pixel is contiguous within one
+chunk. Nodata values of the source layers are stored as NaN.
+
+Example
+-------
+```bash
+python -m src.utils.datacube --input-dir data/example_run/Sentinel-2/fukuoka
+```
+"""
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import yaml
+from affine import Affine
+from rasterio.windows import Window
+
+CUBE_DIR = "datacube"
+CLOUDY_SCL = (3, 7, 8, 9, 10, 11)
+
+
+class DataCube:
+    """Read access to a datacube written by :func:`build_datacube`."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.header = json.loads((self.path / "cube.json").read_text())
+        self.data = np.load(self.path / "data.npy", mmap_mode="r")
+        self.dates: list[str] = self.header["dates"]
+        self.channels: list[str] = self.header["channels"]
+        self.chunk = tuple(self.header["chunk"])
+        self.height, self.width = self.header["height"], self.header["width"]
+
+    @property
+    def shape(self) -> tuple[int, int, int, int]:
+        return (len(self.dates), len(self.channels), self.height, self.width)
+
+    @property
+    def band_dtype(self) -> str:
+        """Dtype of the ingested ``BANDS.tif`` files (the cube stores float32)."""
+        return self.header["layers"][0]["dtype"]
+
+    @property
+    def profile(self) -> dict:
+        """Rasterio profile of one spatial layer of the cube."""
+        return {
+            "driver": "GTiff",
+            "height": self.height,
+            "width": self.width,
+            "crs": self.header["crs"],
+            "transform": Affine(*self.header["transform"]),
+        }
+
+    def layer_metas(self) -> list[dict]:
+        """Profiles of the ingested ``BANDS``/``SCL``/``MASK`` layers."""
+        metas = []
+        for layer in self.header["layers"]:
+            meta = self.profile
+            meta.update(count=layer["count"], dtype=layer["dtype"], nodata=layer["nodata"])
+            metas.append(meta)
+        return metas
+
+    def _index(self, names, values) -> list[int] | slice:
+        if values is None:
+            return slice(None)
+        return [v if isinstance(v, int) else names.index(v) for v in values]
+
+    def read_window(self, window: Window, dates=None, channels=None) -> np.ndarray:
+        """Return the ``(time, channel, rows, cols)`` block covered by ``window``.
+
+        ``dates`` and ``channels`` select a subset by name or position.
+        """
+        cy, cx = self.chunk
+        row0, col0 = int(window.row_off), int(window.col_off)
+        row1, col1 = row0 + int(window.height), col0 + int(window.width)
+        t_idx = self._index(self.dates, dates)
+        c_idx = self._index(self.channels, channels)
+        n_t = len(self.dates) if isinstance(t_idx, slice) else len(t_idx)
+        n_c = len(self.channels) if isinstance(c_idx, slice) else len(c_idx)
+        out = np.empty((n_t, n_c, row1 - row0, col1 - col0), dtype=np.float32)
+        for iy in range(row0 // cy, (row1 - 1) // cy + 1):
+            for ix in range(col0 // cx, (col1 - 1) // cx + 1):
+                r0, r1 = max(row0, iy * cy), min(row1, (iy + 1) * cy)
+                c0, c1 = max(col0, ix * cx), min(col1, (ix + 1) * cx)
+                block = self.data[
+                    iy, ix, :, :, r0 - iy * cy : r1 - iy * cy, c0 - ix * cx : c1 - ix * cx
+                ]
+                out[:, :, r0 - row0 : r1 - row0, c0 - col0 : c1 - col0] = block[t_idx][:, c_idx]
+        return out
+
+    def read_pixel(self, row: int, col: int, channels=None) -> np.ndarray:
+        """Return the ``(time, channel)`` time series of a single pixel."""
+        cy, cx = self.chunk
+        series = self.data[row // cy, col // cx, :, :, row % cy, col % cx]
+        return np.asarray(series[:, self._index(self.channels, channels)])
+
+    def read_pixels(
+        self, rows: np.ndarray, cols: np.ndarray, dates=None, channels=None
+    ) -> np.ndarray:
+        """Return the ``(n, time, channel)`` time series of many pixels.
+
+        Only the requested dates of the pixels are read from the memory map.
+        """
+        cy, cx = self.chunk
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        t_idx = range(len(self.dates)) if dates is None else self._index(self.dates, dates)
+        series = np.stack(
+            [self.data[rows // cy, cols // cx, t, :, rows % cy, cols % cx] for t in t_idx], axis=1
+        )
+        return series[:, :, self._index(self.channels, channels)]
+
+    def _cloud_mask(self, block: np.ndarray, cloudy_values) -> np.ndarray:
+        # block holds all channels of one date
+        mask = np.isin(block[self.header["n_bands"]], cloudy_values)
+        if "MASK" in self.channels:
+            mask |= block[self.channels.index("MASK")] == 0
+        return mask
+
+    def masked_window(
+        self, date: str, window: Window, out: np.ndarray | None = None, cloudy_values=CLOUDY_SCL
+    ) -> np.ndarray:
+        """Return the cloud-masked band block of one date.
+
+        Mirrors :func:`src.preprocess.stack_bands.stack_bands`: cloudy or
+        invalid pixels (``SCL`` in ``cloudy_values`` or ``MASK == 0``) are NaN.
+        """
+        n_bands = self.header["n_bands"]
+        block = self.read_window(window, dates=[date])[0]
+        if out is None:
+            out = np.empty((n_bands,) + block.shape[1:], dtype=np.float32)
+        out[:] = block[:n_bands]
+        out[:, self._cloud_mask(block, cloudy_values)] = np.nan
+        return out
+
+    def masked_pixels(self, date: str, rows, cols, cloudy_values=CLOUDY_SCL) -> np.ndarray:
+        """Return the cloud-masked ``(bands, n)`` values of individual pixels of one date."""
+        block = self.read_pixels(rows, cols, dates=[date])[:, 0].T
+        out = np.array(block[: self.header["n_bands"]], dtype=np.float32)
+        out[:, self._cloud_mask(block, cloudy_values)] = np.nan
+        return out
+
+    def masked_stack(self, date: str, cloudy_values=CLOUDY_SCL) -> tuple[np.ndarray, dict]:
+        """Return the cloud-masked band stack of one date and its profile."""
+        window = Window(0, 0, self.width, self.height)
+        stack = self.masked_window(date, window, cloudy_values=cloudy_values)
+        meta = self.profile
+        meta.update(count=self.header["n_bands"], dtype="float32")
+        return stack, meta
+
+
+def _scene_dirs(region_dir: Path) -> list[Path]:
+    return sorted(
+        d for d in region_dir.iterdir()
+        if d.is_dir() and (d / "BANDS.tif").exists() and (d / "SCL.tif").exists()
+    )
+
+
+def build_datacube(
+    region_dir: Path,
+    output_dir: Path | None = None,
+    chunk: int = 256,
+    band_names: list[str] | None = None,
+) -> Path:
+    """Ingest all dated subfolders of ``region_dir`` into a datacube.
+
+    Parameters
+    ----------
+    region_dir : Path
+        Directory containing dated subfolders with ``BANDS.tif`` and
+        ``SCL.tif`` (``MASK.tif`` is included when every folder has one).
+    output_dir : Path, optional
+        Destination directory, defaults to ``region_dir / "datacube"``.
+    chunk : int, optional
+        Edge length of the square spatial chunks.
+    band_names : list[str], optional
+        Names of the ``BANDS.tif`` layers, e.g. from ``download.yaml``.
+    """
+    region_dir = Path(region_dir)
+    output_dir = Path(output_dir) if output_dir else region_dir / CUBE_DIR
+    scenes = _scene_dirs(region_dir)
+    if not scenes:
+        raise FileNotFoundError(f"No scene folders with BANDS.tif/SCL.tif in {region_dir}")
+
+    use_mask = all((d / "MASK.tif").exists() for d in scenes)
+    layer_files = ["BANDS.tif", "SCL.tif"] + (["MASK.tif"] if use_mask else [])
+    with rasterio.open(scenes[0] / "BANDS.tif") as src:
+        height, width, n_bands = src.height, src.width, src.count
+        crs, transform = src.crs, src.transform
+    band_names = list(band_names or [f"band{i}" for i in range(1, n_bands + 1)])
+    if len(band_names) != n_bands:
+        raise ValueError(f"Expected {n_bands} band names, got {len(band_names)}")
+    channels = band_names + ["SCL"] + (["MASK"] if use_mask else [])
+
+    ny, nx = -(-height // chunk), -(-width // chunk)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    data = np.lib.format.open_memmap(
+        output_dir / "data.npy",
+        mode="w+",
+        dtype=np.float32,
+        shape=(ny, nx, len(scenes), len(channels), chunk, chunk),
+    )
+
+    layers = []
+    cloud_frac = []
+    for t, scene in enumerate(scenes):
+        channel = 0
+        cloudy = 0
+        for name in layer_files:
+            with rasterio.open(scene / name) as src:
+                if (src.height, src.width) != (height, width):
+                    raise ValueError(f"{scene / name} does not match the cube grid")
+                if t == 0:
+                    layers.append(
+                        {"name": name, "count": src.count, "dtype": src.dtypes[0], "nodata": src.nodata}
+                    )
+                for iy in range(ny):
+                    rows = min(chunk, height - iy * chunk)
+                    block = src.read(window=Window(0, iy * chunk, width, rows)).astype(np.float32)
+                    if src.nodata is not None:
+                        block[block == src.nodata] = np.nan
+                    if name == "SCL.tif":
+                        cloudy += int(np.isin(block, CLOUDY_SCL).sum())
+                    for ix in range(nx):
+                        cols = min(chunk, width - ix * chunk)
+                        target = data[iy, ix, t, channel : channel + src.count]
+                        target[:] = np.nan
+                        target[:, :rows, :cols] = block[:, :, ix * chunk : ix * chunk + cols]
+                channel += src.count
+        cloud_frac.append(cloudy / (height * width))
+    data.flush()
+    del data
+
+    header = {
+        "dates": [d.name for d in scenes],
+        "channels": channels,
+        "n_bands": n_bands,
+        "height": height,
+        "width": width,
+        "chunk": [chunk, chunk],
+        "crs": crs.to_string() if crs else None,
+        "transform": list(transform)[:6],
+        "layers": layers,
+        "cloud_frac": cloud_frac,
+    }
+    (output_dir / "cube.json").write_text(json.dumps(header, indent=2))
+    print(f"Ingested {len(scenes)} scenes into {output_dir}")
+    return output_dir
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Build a time-series datacube from dated folders")
+    p.add_argument("--input-dir", required=True, help="Directory with dated scene folders")
+    p.add_argument("--output-dir", help="Datacube directory (default: <input-dir>/datacube)")
+    p.add_argument("--chunk", type=int, default=256, help="Spatial chunk size in pixels")
+    args = p.parse_args()
+
+    input_dir = Path(args.input_dir)
+    band_names = None
+    cfg_path = input_dir / "download.yaml"
+    if cfg_path.exists():
+        cfg = yaml.safe_load(cfg_path.read_text())
+        band_names = [b for b in cfg.get("bands", []) if b not in {"SCL", "dataMask"}] or None
+    build_datacube(
+        input_dir,
+        Path(args.output_dir) if args.output_dir else None,
+        chunk=args.chunk,
+        band_names=band_names,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,8 @@ from sentinelhub import (
 from oauthlib.oauth2.rfc6749.errors import InvalidClientError
 import sys
 
+from .io_raster import split_band_stack
+
 SH_BASE_URL="https://sh.dataspace.copernicus.eu"
 SH_TOKEN_URL="https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
 
@@ -37,18 +39,6 @@ DEFAULT_BANDS = ["B02", "B03", "B04", "B08", "B11", "SCL", "dataMask"] # Sentine
 # dataMask is L2A data mask (valid pixels)
 # This repository derives cloud masks from the SCL and dataMask bands.
 
-def split_band_stack(stack_path: Path, bands: list[str]) -> None:
-    """Split a multi-band GeoTIFF into separate single-band files."""
-    with rasterio.open(stack_path) as src:
-        meta = src.meta.copy()
-        if src.count < len(bands):
-            raise ValueError("Band stack has fewer layers than expected")
-        for i, name in enumerate(bands, 1):
-            meta.update(count=1)
-            out = stack_path.parent / f"{name}.tif"
-            with rasterio.open(out, "w", **meta) as dst:
-                dst.write(src.read(i), 1)
-
 def normalize_date(value: str) -> str:
     """Return date in YYYY-MM-DD format."""
     if "-" in value:
@@ -87,6 +77,11 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--max-cloud", type=float, default=None, help="Maximum cloud cover percentage")
     parser.add_argument("--min-valid", type=float, default=None, help="Minimum percent of valid pixels")
     parser.add_argument("--zip-output", action="store_true", help="Create ZIP archive of output directory")
+    parser.add_argument(
+        "--split-bands",
+        action="store_true",
+        help="Also write one GeoTIFF per band next to BANDS.tif",
+    )
     parser.add_argument(
         "--sh-base-url",
         default=SH_BASE_URL,
@@ -112,6 +107,7 @@ def parse_args() -> argparse.Namespace:
         args.max_cloud = cfg.get("max_cloud", args.max_cloud)
         args.min_valid = cfg.get("min_valid", args.min_valid)
         args.zip_output = cfg.get("zip_output", args.zip_output)
+        args.split_bands = cfg.get("split_bands", args.split_bands)
         args.name = cfg.get("name", args.name)
     if None in {args.lat, args.lon, args.start, args.end}:
         parser.error("lat, lon, start and end must be provided")
@@ -136,8 +132,13 @@ def download_sentinel(
     max_cloud: float | None = None,
     min_valid: float | None = None,
     zip_output: bool = False,
+    split_bands: bool = False,
 ) -> Path:
-    """Download selected bands using sentinelhub."""
+    """Download selected bands using sentinelhub.
+
+    Each scene is saved as a multi-band ``BANDS.tif``. Set ``split_bands`` to
+    additionally write one GeoTIFF per spectral band.
+    """
     if bands is None:
         bands = DEFAULT_BANDS
     if name:
@@ -298,7 +299,8 @@ def download_sentinel(
                     shutil.rmtree(date_dir)
                     continue
 
-        split_band_stack(date_dir / "BANDS.tif", spectral)
+        if split_bands:
+            split_band_stack(date_dir / "BANDS.tif", spectral)
         results.append(date_dir)
 
     print(f"✅  Saved GeoTIFFs to {out_dir}")
@@ -332,6 +334,7 @@ def download_from_config(
         max_cloud=cfg.get("max_cloud"),
         min_valid=cfg.get("min_valid"),
         zip_output=cfg.get("zip_output", False),
+        split_bands=cfg.get("split_bands", False),
     )
 
 
@@ -352,6 +355,7 @@ def main() -> None:
         max_cloud=args.max_cloud,
         min_valid=args.min_valid,
         zip_output=args.zip_output,
+        split_bands=args.split_bands,
     )
     if args.config:
         # Store the configuration under a standard name so other
@@ -1,3 +1,4 @@
+from pathlib import Path
 from typing import Mapping, Optional, Tuple
 
 import rasterio
@@ -15,3 +16,20 @@ def write_raster(
         if colormap:
             for band, cmap in colormap.items():
                 dst.write_colormap(band, dict(cmap))
+
+
+def split_band_stack(stack_path: Path, bands: list[str]) -> None:
+    """Split a multi-band GeoTIFF into separate single-band files.
+
+    The pipeline reads bands straight from the stack by index, so this is
+    only needed when per-band files are explicitly requested.
+    """
+    with rasterio.open(stack_path) as src:
+        meta = src.meta.copy()
+        if src.count < len(bands):
+            raise ValueError("Band stack has fewer layers than expected")
+        for i, name in enumerate(bands, 1):
+            meta.update(count=1)
+            out = stack_path.parent / f"{name}.tif"
+            with rasterio.open(out, "w", **meta) as dst:
+                dst.write(src.read(i), 1)
@@ -0,0 +1,158 @@
+"""Input fingerprints for skipping pipeline stages whose inputs are unchanged.
+
+Every stage writes a ``<stage>.manifest.json`` next to its outputs recording
+
+* a fingerprint of every input file (size and modification time, or a
+  SHA-256 of the contents when ``content_hash`` is set),
+* a hash of the stage configuration and parameters,
+* the code version (hash of the ``src`` package sources),
+* a fingerprint of every output file.
+
+On the next run the stage compares the current fingerprints with the
+manifest and returns immediately when they match and the outputs are
+untouched::
+
+    cache = StageCache(out_dir / "preprocess.manifest.json", "preprocess",
+                       inputs=[bands, scl], config=cfg, outputs=[features])
+    if not force and cache.is_fresh():
+        return
+    ...  # run the stage
+    cache.record()
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable
+
+SUFFIX = ".manifest.json"
+SRC_ROOT = Path(__file__).resolve().parents[1]
+
+
+def _sha256(path: Path, chunk: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(chunk):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_fingerprint(path: Path, content_hash: bool = False) -> dict | None:
+    """Fingerprint of a file, or ``None`` when it does not exist."""
+    path = Path(path)
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    if content_hash:
+        return {"size": st.st_size, "sha256": _sha256(path)}
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def config_hash(*objs) -> str:
+    """Stable hash of JSON-serializable configuration objects."""
+    blob = json.dumps(objs, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()
+
+
+@lru_cache(maxsize=1)
+def code_version() -> str:
+    """Hash of all Python sources of the ``src`` package."""
+    h = hashlib.sha256()
+    for path in sorted(SRC_ROOT.rglob("*.py")):
+        h.update(str(path.relative_to(SRC_ROOT)).encode("utf-8"))
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def scene_files(directory: Path, names: Iterable[str]) -> list[Path]:
+    """Files called ``names`` inside the subfolders of ``directory``."""
+    names = set(names)
+    return sorted(
+        p
+        for sub in Path(directory).iterdir()
+        if sub.is_dir()
+        for p in sub.iterdir()
+        if p.name in names
+    )
+
+
+class StageCache:
+    """Manifest of one stage run.
+
+    Parameters
+    ----------
+    path : Path
+        Manifest file, conventionally ``<output dir>/<stage>.manifest.json``.
+    stage : str
+        Stage name stored in the manifest.
+    inputs : iterable of Path
+        Files the stage reads. Missing files are fingerprinted as ``None``.
+    config : object, optional
+        Configuration and parameters affecting the outputs.
+    outputs : iterable of Path
+        Files the stage writes; the stage is rerun when any is missing or
+        was modified after the manifest was recorded.
+    content_hash : bool, optional
+        Hash file contents instead of comparing size and mtime.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        stage: str,
+        inputs: Iterable[Path],
+        config=None,
+        outputs: Iterable[Path] = (),
+        content_hash: bool = False,
+    ):
+        self.path = Path(path)
+        self.stage = stage
+        self.inputs = [Path(p) for p in inputs]
+        self.config = config
+        self.outputs = [Path(p) for p in outputs]
+        self.content_hash = content_hash
+
+    def _files(self, paths: list[Path]) -> dict:
+        return {str(p): file_fingerprint(p, self.content_hash) for p in paths}
+
+    def fingerprint(self) -> dict:
+        """Fingerprint of the current inputs, configuration and code."""
+        return {
+            "stage": self.stage,
+            "code_version": code_version(),
+            "config_hash": config_hash(self.config),
+            "content_hash": self.content_hash,
+            "inputs": self._files(self.inputs),
+        }
+
+    def is_fresh(self) -> bool:
+        """``True`` when the recorded run matches the current inputs."""
+        try:
+            recorded = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return False
+        outputs = self._files(self.outputs)
+        if any(fp is None for fp in outputs.values()) or recorded.get("outputs") != outputs:
+            return False
+        recorded.pop("outputs")
+        return recorded == self.fingerprint()
+
+    def record(self) -> None:
+        """Write the manifest after the stage produced its outputs."""
+        manifest = self.fingerprint()
+        manifest["outputs"] = self._files(self.outputs)
+        tmp = self.path.with_suffix(".tmp")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp, self.path)
+
+    def skip(self, force: bool = False) -> bool:
+        """Return ``True`` (and report it) when the stage can be skipped."""
+        if force or not self.is_fresh():
+            return False
+        print(f"{self.stage}: inputs unchanged, skipping {self.path.parent} (use --force to rerun)")
+        return True
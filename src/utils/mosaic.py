@@ -2,15 +2,26 @@ from __future__ import annotations
 
 """Utility functions to mosaic raster files."""
 
+import json
+import warnings
 from pathlib import Path
-from typing import Iterable
+from typing import Callable, Iterable
 
 import rasterio
 from rasterio.merge import merge
+from rasterio.windows import Window
 import numpy as np
 import yaml
 
-from .download_sentinel import split_band_stack, DEFAULT_BANDS
+from .datacube import CUBE_DIR, DataCube
+from .download_sentinel import DEFAULT_BANDS
+from .io_raster import split_band_stack
+
+# Persistent compositor state used by ``update_mosaic_incremental``.
+STATE_DIR = "composite_state"
+# methods update_mosaic_incremental can maintain from per-pixel state
+INCREMENTAL_METHODS = ("best", "median")
+CLOUDY_SCL = (3, 7, 8, 9, 10, 11)
 
 
 def mosaic_rasters(raster_paths: Iterable[Path], output_path: Path) -> Path:
@@ -43,86 +54,328 @@ def mosaic_rasters(raster_paths: Iterable[Path], output_path: Path) -> Path:
     return output_path
 
 
-def _prioritized_mosaic(band_paths: list[Path], scl_paths: list[Path], output_path: Path, method: str = "best") -> Path:
-    """Composite scenes using SCL-based pixel priority.
+def _scl_priority(scl: np.ndarray) -> np.ndarray:
+    """Return pixel priority levels: clear < unclassified < cloudy/shadow."""
+    priority = np.full_like(scl, 2, dtype=np.uint8)
+    priority[np.isin(scl, [4, 5, 6])] = 0  # vegetation, bare, water
+    priority[np.isin(scl, [7])] = 1        # unclassified
+    return priority
 
-    Parameters
-    ----------
-    band_paths : list[Path]
-        ``BANDS.tif`` files from each scene.
-    scl_paths : list[Path]
-        ``SCL.tif`` files matching ``band_paths`` order.
-    output_path : Path
-        Where to save the composite image.
-    method : {"best", "median"}
-        Pixel selection strategy. ``"best"`` picks the single best pixel based on
-        SCL priority (ties are broken by the scene's overall cloud fraction)
-        while ``"median"`` computes the median over clear pixels.
-    """
 
-    if method not in {"best", "median"}:
-        raise ValueError("method must be 'best' or 'median'")
+# name -> (function, halo rows). Methods receive a block stack of shape
+# ``(scenes, channels, rows, cols)`` holding the spectral bands followed by
+# SCL (and MASK), the SCL priority ``(scenes, rows, cols)``, the per-scene
+# cloud fraction and a context dict, and return the ``(channels, rows, cols)``
+# composite. NaN marks pixels without a valid value.
+COMPOSITE_METHODS: dict[str, tuple[Callable, int]] = {}
 
-    band_srcs = [rasterio.open(p) for p in band_paths]
-    scl_srcs = [rasterio.open(p) for p in scl_paths]
 
-    bands_stack = np.stack([s.read() for s in band_srcs])
-    scls = np.stack([s.read(1) for s in scl_srcs])
-    meta = band_srcs[0].meta.copy()
+def register_composite_method(name: str, halo: int = 0):
+    """Register a block compositing method under ``name``.
 
-    for s in band_srcs + scl_srcs:
-        s.close()
+    ``halo`` is the number of extra rows read above and below each block for
+    methods that look at neighbouring pixels.
+    """
 
-    # Priority levels: clear < unclassified < cloudy/shadow
-    priority = np.full_like(scls, 2, dtype=np.uint8)
-    priority[np.isin(scls, [4, 5, 6])] = 0  # vegetation, bare, water
-    priority[np.isin(scls, [7])] = 1        # unclassified
+    def decorator(fn: Callable) -> Callable:
+        COMPOSITE_METHODS[name] = (fn, halo)
+        return fn
+
+    return decorator
+
+
+def _take(stack: np.ndarray, idx: np.ndarray) -> np.ndarray:
+    """Select ``stack[idx[y, x], :, y, x]`` for every pixel."""
+    return np.take_along_axis(stack, idx[None, None], axis=0)[0]
+
+
+def _best_index(priority: np.ndarray, cloud_frac: np.ndarray) -> np.ndarray:
+    # prioritize by SCL category, breaking ties using cloud fraction
+    score = priority.astype(np.float64) * 10 + cloud_frac[:, None, None]
+    return np.argmin(score, axis=0)
+
+
+@register_composite_method("best")
+def _composite_best(stack, priority, cloud_frac, ctx):
+    """Pick the single best pixel by SCL priority and scene cloudiness."""
+    return _take(stack, _best_index(priority, cloud_frac))
+
+
+@register_composite_method("median")
+def _composite_median(stack, priority, cloud_frac, ctx):
+    """Median over clear observations."""
+    data = np.where((priority == 0)[:, None], stack, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(data, axis=0)
+
+
+@register_composite_method("max_ndvi")
+def _composite_max_ndvi(stack, priority, cloud_frac, ctx):
+    """Greenest clear pixel (maximum NDVI), falling back to ``best``."""
+    names = ctx["band_names"]
+    red = stack[:, names.index(ctx.get("red_band", "B04"))]
+    nir = stack[:, names.index(ctx.get("nir_band", "B08"))]
+    denom = nir + red
+    ndvi = np.full(red.shape, -np.inf, dtype=np.float32)
+    np.divide(nir - red, denom, out=ndvi, where=(priority == 0) & (denom != 0))
+    idx = np.argmax(ndvi, axis=0)
+    no_clear = ~np.isfinite(ndvi).any(axis=0)
+    idx[no_clear] = _best_index(priority, cloud_frac)[no_clear]
+    return _take(stack, idx)
+
+
+@register_composite_method("medoid")
+def _composite_medoid(stack, priority, cloud_frac, ctx):
+    """Multi-band medoid: the clear observation with the smallest summed
+    Euclidean distance to all other clear observations of the pixel."""
+    spectral = stack[:, : ctx["n_bands"]]
+    clear = priority == 0
+    dist = np.zeros(clear.shape, dtype=np.float32)
+    for j in range(stack.shape[0]):
+        d = np.sqrt(((spectral - spectral[j]) ** 2).sum(axis=1))
+        dist += np.where(clear[j], d, 0)
+    dist[~clear] = np.inf
+    idx = np.argmin(dist, axis=0)
+    no_clear = ~clear.any(axis=0)
+    idx[no_clear] = _best_index(priority, cloud_frac)[no_clear]
+    return _take(stack, idx)
+
+
+def _cloud_distance(cloud: np.ndarray, max_dist: int) -> np.ndarray:
+    """Chessboard distance to the nearest cloudy pixel, capped at ``max_dist``."""
+    dist = np.full(cloud.shape, max_dist, dtype=np.float32)
+    grown = cloud.copy()
+    for d in range(max_dist):
+        dist[grown & (dist == max_dist)] = d
+        # separable 3x3 dilation along rows then columns
+        grown[..., 1:, :] |= grown[..., :-1, :].copy()
+        grown[..., :-1, :] |= grown[..., 1:, :].copy()
+        grown[..., :, 1:] |= grown[..., :, :-1].copy()
+        grown[..., :, :-1] |= grown[..., :, 1:].copy()
+    return dist
+
+
+CLOUD_DISTANCE_MAX = 10
+
+
+@register_composite_method("weighted", halo=CLOUD_DISTANCE_MAX)
+def _composite_weighted(stack, priority, cloud_frac, ctx):
+    """Average clear observations weighted by their distance to clouds.
+
+    Spectral bands are averaged; the categorical SCL/MASK layers are taken
+    from the observation with the largest weight.
+    """
+    n_bands = ctx["n_bands"]
+    max_dist = ctx.get("cloud_distance", CLOUD_DISTANCE_MAX)
+    clear = priority == 0
+    weight = _cloud_distance(~clear, max_dist) / max_dist
+    total = weight.sum(axis=0)
+    out = _take(stack, _best_index(priority, cloud_frac))
+    has_weight = total > 0
+    spectral = np.einsum("tbyx,tyx->byx", stack[:, :n_bands], weight)
+    np.divide(spectral, total, out=out[:n_bands], where=has_weight)
+    heaviest = _take(stack[:, n_bands:], np.argmax(weight, axis=0))
+    out[n_bands:] = np.where(has_weight, heaviest, out[n_bands:])
+    return out
+
+
+def _cloud_fraction(scl_src) -> float:
+    """Fraction of cloudy SCL pixels, read block by block."""
+    cloudy = 0
+    for _, window in scl_src.block_windows(1):
+        cloudy += np.isin(scl_src.read(1, window=window), CLOUDY_SCL).sum()
+    return cloudy / (scl_src.height * scl_src.width)
+
+
+def _layer_nodata(meta: dict) -> float:
+    nodata = meta.get("nodata")
+    if nodata is not None:
+        return nodata
+    # SCL == 0 and MASK == 0 both mean "no data"
+    return 0 if np.issubdtype(np.dtype(meta["dtype"]), np.integer) else -9999.0
+
+
+def _to_layer(values: np.ndarray, meta: dict) -> np.ndarray:
+    dtype = np.dtype(meta["dtype"])
+    values = np.where(np.isnan(values), _layer_nodata(meta), values)
+    if np.issubdtype(dtype, np.integer):
+        values = np.rint(values)
+    return values.astype(dtype)
+
+
+def composite_scenes(
+    scene_dirs: list[Path],
+    out_dir: Path,
+    method: str = "best",
+    band_names: list[str] | None = None,
+    block_rows: int = 256,
+    **options,
+) -> Path:
+    """Composite dated scene folders block by block.
+
+    ``BANDS.tif``, ``SCL.tif`` and (when every scene has one) ``MASK.tif`` are
+    read ``block_rows`` lines at a time from all scenes, composited with the
+    registered ``method`` and written to the same file names in ``out_dir``.
+    Peak memory is a few blocks of the scene stack instead of the full stack.
 
-    h, w = priority.shape[1:]
-    out = np.empty((bands_stack.shape[1], h, w), dtype=bands_stack.dtype)
+    Parameters
+    ----------
+    scene_dirs : list[Path]
+        Dated folders containing ``BANDS.tif`` and ``SCL.tif``.
+    out_dir : Path
+        Destination directory for the composite rasters.
+    method : str
+        Name of a method in ``COMPOSITE_METHODS``.
+    band_names : list[str], optional
+        Names of the ``BANDS.tif`` layers, required by band-aware methods
+        such as ``"max_ndvi"``.
+    block_rows : int, optional
+        Number of raster rows processed per block.
+    **options
+        Extra method options passed through the context dict (e.g.
+        ``red_band``, ``nir_band``, ``cloud_distance``).
+    """
+    use_mask = all((d / "MASK.tif").exists() for d in scene_dirs)
+    layer_names = ["BANDS.tif", "SCL.tif"] + (["MASK.tif"] if use_mask else [])
+    srcs = [[rasterio.open(d / name) for name in layer_names] for d in scene_dirs]
+    try:
+        metas = [s.meta.copy() for s in srcs[0]]
 
-    if method == "best":
         # overall cloudiness per scene for tie-breaking
-        cloud_mask = np.isin(scls, (3, 7, 8, 9, 10, 11))
-        cloud_frac = cloud_mask.mean(axis=(1, 2))
-
-        # prioritize by SCL category, breaking ties using cloud fraction
-        score = priority.astype(np.float32) * 10 + cloud_frac[:, None, None]
-        idx = np.argmin(score, axis=0)
-        rows, cols = np.indices((h, w))
-        for b in range(out.shape[0]):
-            out[b] = bands_stack[:, b, :, :][idx, rows, cols]
-
-    else:  # median composite
-        mask = priority == 0
-        expanded = mask[:, None, :, :]
-        data = bands_stack.astype("float32")
-        data[~expanded] = np.nan
-        out = np.nanmedian(data, axis=0)
-        nodata = meta.get("nodata", -9999.0)
-        out = np.where(np.isnan(out), nodata, out).astype(bands_stack.dtype)
-
-    meta.update({"height": h, "width": w, "count": out.shape[0]})
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-    with rasterio.open(output_path, "w", **meta) as dst:
-        dst.write(out)
+        cloud_frac = np.array([_cloud_fraction(scene[1]) for scene in srcs], dtype=np.float64)
+
+        def read_block(window: Window) -> np.ndarray:
+            return np.concatenate(
+                [
+                    np.stack([s.read(window=window) for s in layers]).astype(np.float32)
+                    for layers in zip(*srcs)
+                ],
+                axis=1,
+            )
+
+        return _composite_blocks(
+            read_block, metas, layer_names, cloud_frac, out_dir,
+            method, band_names, block_rows, options,
+        )
+    finally:
+        for scene in srcs:
+            for s in scene:
+                s.close()
+
+
+def composite_datacube(
+    cube: DataCube,
+    out_dir: Path,
+    method: str = "best",
+    band_names: list[str] | None = None,
+    block_rows: int = 256,
+    **options,
+) -> Path:
+    """Composite all dates of a :class:`~src.utils.datacube.DataCube`.
+
+    Same as :func:`composite_scenes` but reads the blocks from the memory
+    mapped cube instead of reopening every dated GeoTIFF.
+    """
+    metas = cube.layer_metas()
+    layer_names = [layer["name"] for layer in cube.header["layers"]]
+    cloud_frac = np.asarray(cube.header["cloud_frac"], dtype=np.float64)
+    band_names = band_names or cube.channels[: cube.header["n_bands"]]
+    return _composite_blocks(
+        cube.read_window, metas, layer_names, cloud_frac, out_dir,
+        method, band_names, block_rows, options,
+    )
 
-    return output_path
+
+def _composite_blocks(
+    read_block: Callable[[Window], np.ndarray],
+    metas: list[dict],
+    layer_names: list[str],
+    cloud_frac: np.ndarray,
+    out_dir: Path,
+    method: str,
+    band_names: list[str] | None,
+    block_rows: int,
+    options: dict,
+) -> Path:
+    """Stream ``read_block`` row blocks through a compositing method."""
+    if method not in COMPOSITE_METHODS:
+        raise ValueError(f"method must be one of {sorted(COMPOSITE_METHODS)}")
+    fn, halo = COMPOSITE_METHODS[method]
+    n_bands = metas[0]["count"]
+    h, w = metas[0]["height"], metas[0]["width"]
+    ctx = dict(options, n_bands=n_bands, band_names=list(band_names or []))
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tmp_paths = [out_dir / name.replace(".tif", ".tmp.tif") for name in layer_names]
+    dsts = [rasterio.open(p, "w", **m) for p, m in zip(tmp_paths, metas)]
+    try:
+        for row in range(0, h, block_rows):
+            rows = min(block_rows, h - row)
+            top = max(row - halo, 0)
+            bottom = min(row + rows + halo, h)
+            stack = read_block(Window(0, top, w, bottom - top))
+            priority = _scl_priority(np.nan_to_num(stack[:, n_bands]).astype(np.uint8))
+            out = fn(stack, priority, cloud_frac, ctx)
+            out = out[:, row - top : row - top + rows]
+            target = Window(0, row, w, rows)
+            dsts[0].write(_to_layer(out[:n_bands], metas[0]), window=target)
+            for i, dst in enumerate(dsts[1:], start=1):
+                dst.write(_to_layer(out[n_bands + i - 1], metas[i]), 1, window=target)
+    finally:
+        for dst in dsts:
+            dst.close()
+
+    for tmp, name in zip(tmp_paths, layer_names):
+        tmp.replace(out_dir / name)
+    return out_dir / "BANDS.tif"
+
+
+def _spectral_bands(out_dir: Path) -> list[str]:
+    """Spectral band order of ``BANDS.tif`` taken from ``download.yaml``."""
+    cfg_path = out_dir / "download.yaml"
+    bands = DEFAULT_BANDS
+    if cfg_path.exists():
+        cfg = yaml.safe_load(cfg_path.read_text())
+        bands = cfg.get("bands", DEFAULT_BANDS)
+    return [b for b in bands if b not in {"SCL", "dataMask"}]
 
 
-def mosaic_sentinel_directory(out_dir: Path, method: str = "best") -> Path:
+def mosaic_sentinel_directory(
+    out_dir: Path,
+    method: str = "best",
+    use_datacube: bool = False,
+    split_bands: bool = False,
+) -> Path:
     """Mosaic subdirectories produced by ``download_sentinel``.
 
     Parameters
     ----------
     out_dir : Path
         Directory containing dated subfolders with ``BANDS.tif`` and optional
-        ``SCL.tif``/``MASK.tif`` files. When ``method`` is ``"best"`` or
-        ``"median"``, ``SCL.tif`` (and ``MASK.tif`` if present) are mosaicked
-        using the same prioritized pixel selection as ``BANDS.tif``.
+        ``SCL.tif``/``MASK.tif`` files. When ``SCL.tif`` is available the
+        scenes are composited with ``method`` (see ``COMPOSITE_METHODS``) and
+        ``SCL.tif``/``MASK.tif`` are written alongside ``BANDS.tif``;
+        otherwise the band stacks are simply merged.
+    method : str
+        Name of a method in ``COMPOSITE_METHODS``.
+    use_datacube : bool, optional
+        Read the scenes from ``out_dir / "datacube"`` (see
+        :func:`src.utils.datacube.build_datacube`) instead of the dated
+        GeoTIFFs.
+    split_bands : bool, optional
+        Also write one GeoTIFF per spectral band. Later stages read the
+        bands from ``BANDS.tif`` by index, so this is off by default.
     """
     print(f"out_dir = {out_dir}")
-    subdirs = [d for d in out_dir.iterdir() if d.is_dir()]
+    if use_datacube:
+        cube = DataCube(out_dir / CUBE_DIR)
+        composite_datacube(cube, out_dir, method)
+        if split_bands:
+            split_band_stack(out_dir / "BANDS.tif", cube.channels[: cube.header["n_bands"]])
+        return out_dir / "BANDS.tif"
+
+    subdirs = sorted(d for d in out_dir.iterdir() if d.is_dir())
     if not subdirs:
         raise FileNotFoundError("No scene folders found for mosaicking")
 
@@ -134,32 +387,280 @@ def mosaic_sentinel_directory(out_dir: Path, method: str = "best") -> Path:
     if not band_paths:
         raise FileNotFoundError("BANDS.tif not found in scene folders")
 
-    scl_paths = _collect("SCL.tif")
-    use_priority = scl_paths and method in {"best", "median"}
-    if use_priority:
-        _prioritized_mosaic(band_paths, scl_paths, out_dir / "BANDS.tif", method)
+    spectral = _spectral_bands(out_dir)
+    scene_dirs = [p.parent for p in band_paths if (p.parent / "SCL.tif").exists()]
+    if scene_dirs:
+        composite_scenes(scene_dirs, out_dir, method, band_names=spectral)
     else:
         mosaic_rasters(band_paths, out_dir / "BANDS.tif")
+        mask_paths = _collect("MASK.tif")
+        if mask_paths:
+            mosaic_rasters(mask_paths, out_dir / "MASK.tif")
 
-    cfg_path = out_dir / "download.yaml"
-    spectral = DEFAULT_BANDS
-    if cfg_path.exists():
-        cfg = yaml.safe_load(cfg_path.read_text())
-        spectral = [b for b in cfg.get("bands", DEFAULT_BANDS) if b not in {"SCL", "dataMask"}]
-    split_band_stack(out_dir / "BANDS.tif", spectral)
+    if split_bands:
+        split_band_stack(out_dir / "BANDS.tif", spectral)
 
-    if scl_paths:
-        if use_priority:
-            _prioritized_mosaic(scl_paths, scl_paths, out_dir / "SCL.tif", method)
-        else:
-            mosaic_rasters(scl_paths, out_dir / "SCL.tif")
+    return out_dir / "BANDS.tif"
 
-    mask_paths = _collect("MASK.tif")
-    if mask_paths:
-        if use_priority:
-            # apply the same pixel choices to the mask for consistency
-            _prioritized_mosaic(mask_paths, scl_paths, out_dir / "MASK.tif", method)
-        else:
-            mosaic_rasters(mask_paths, out_dir / "MASK.tif")
 
+def _load_state(state_dir: Path, method: str) -> dict | None:
+    """Open the compositor state written by a previous incremental run.
+
+    The arrays are memory mapped read/write, so updates touch only the
+    blocks being processed.
+    """
+    info_path = state_dir / "state.json"
+    if not info_path.exists():
+        return None
+    info = json.loads(info_path.read_text())
+    if info.get("method") != method:
+        raise ValueError(
+            f"Existing compositor state uses method '{info.get('method')}', "
+            f"not '{method}'. Remove {state_dir} to start over."
+        )
+    if info.get("updating"):
+        raise ValueError(
+            f"A previous run was interrupted while adding {info['updating']}, so "
+            f"the compositor state is incomplete. Remove {state_dir} to start over."
+        )
+    arrays = {p.stem: np.load(p, mmap_mode="r+") for p in state_dir.glob("*.npy")}
+    return {"info": info, "arrays": arrays}
+
+
+def _write_state_info(state_dir: Path, info: dict) -> None:
+    tmp = state_dir / "state.json.tmp"
+    tmp.write_text(json.dumps(info, indent=2))
+    tmp.replace(state_dir / "state.json")
+
+
+def _state_layout(
+    method: str, metas: list[dict], max_samples: int
+) -> dict[str, tuple[tuple, np.dtype, float]]:
+    """``name -> (shape, dtype, initial value)`` of the compositor state arrays.
+
+    Layers keep the dtype of the scene rasters. Unused ``"median"`` sample
+    slots hold the layer's nodata value; ``count`` tells how many are used.
+    """
+    h, w = metas[0]["height"], metas[0]["width"]
+    lead = (max_samples,) if method == "median" else ()
+    layout = {
+        "bands": (lead + (metas[0]["count"], h, w), metas[0]["dtype"], _layer_nodata(metas[0])),
+        "scl": (lead + (h, w), metas[1]["dtype"], _layer_nodata(metas[1])),
+    }
+    if len(metas) > 2:
+        layout["mask"] = (lead + (h, w), metas[2]["dtype"], _layer_nodata(metas[2]))
+    if method == "median":
+        layout["count"] = ((h, w), np.int32, 0)
+    else:
+        layout["score"] = ((h, w), np.float64, np.inf)
+        layout["source"] = ((h, w), np.int16, -1)
+    return {name: (shape, np.dtype(dtype), fill) for name, (shape, dtype, fill) in layout.items()}
+
+
+def _open_scene(scene_dir: Path, use_mask: bool) -> list:
+    """Open ``BANDS``/``SCL`` (and ``MASK``) of one dated folder."""
+    names = ["BANDS.tif", "SCL.tif"] + (["MASK.tif"] if use_mask else [])
+    return [rasterio.open(scene_dir / name) for name in names]
+
+
+def _update_best(block, layers, priority, cloud_frac, scene_id):
+    score = priority.astype(np.float64) * 10 + cloud_frac
+    # strict comparison keeps the earlier scene on ties like argmin
+    better = score < block["score"]
+    block["score"][better] = score[better]
+    block["source"][better] = scene_id
+    for name, layer in layers.items():
+        block[name][..., better] = layer[..., better]
+
+
+def _update_median(block, layers, priority, rng):
+    count = block["count"]
+    k = block["scl"].shape[0]
+    clear = priority == 0
+    # fill free slots first, then replace with probability k / (n + 1)
+    slot = np.where(count < k, count, rng.integers(0, count + 1))
+    rows, cols = np.nonzero(clear & (slot < k))
+    slot = slot[rows, cols]
+    block["bands"][slot, :, rows, cols] = layers["bands"][:, rows, cols].T
+    for name in layers.keys() - {"bands"}:
+        block[name][slot, rows, cols] = layers[name][rows, cols]
+    count[clear] += 1
+
+
+def _median_block(block, use_mask):
+    """Per-pixel median of the used sample slots as ``(channels, rows, cols)``."""
+    k = block["scl"].shape[0]
+    used = np.arange(k)[:, None, None] < block["count"]
+    layers = [block["bands"], block["scl"][:, None]]
+    if use_mask:
+        layers.append(block["mask"][:, None])
+    stack = np.concatenate([layer.astype(np.float32) for layer in layers], axis=1)
+    stack[~np.broadcast_to(used[:, None], stack.shape)] = np.nan
+    with warnings.catch_warnings():
+        # pixels without any clear observation stay NaN -> nodata
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(stack, axis=0)
+
+
+def update_mosaic_incremental(
+    out_dir: Path,
+    method: str = "best",
+    max_samples: int = 16,
+    seed: int = 0,
+    split_bands: bool = False,
+    block_rows: int = 256,
+) -> Path:
+    """Update the composite in ``out_dir`` with scene folders not seen before.
+
+    The compositor state is kept in ``out_dir / STATE_DIR`` next to
+    ``BANDS.tif``. For ``"best"`` it stores the per-pixel score
+    (``priority * 10 + cloud fraction``, identical to the ``"best"`` method)
+    and the index of the source scene, so a new scene only replaces pixels it
+    improves. For ``"median"`` it stores a buffer of up to ``max_samples``
+    clear observations per pixel (reservoir sampled once full) from which the
+    median is recomputed. Old scenes are never read again.
+
+    The state arrays are ``.npy`` memory maps in the dtype of the scene
+    rasters, and the new scenes, the state and the composite are processed
+    ``block_rows`` lines at a time, so peak memory is a few blocks of the
+    state rather than the full buffer. ``state.json`` is rewritten only after
+    the arrays are flushed; a run interrupted in between leaves it marked as
+    incomplete and the next run refuses to use it.
+
+    Parameters
+    ----------
+    out_dir : Path
+        Directory containing dated subfolders with ``BANDS.tif`` and
+        ``SCL.tif`` (``MASK.tif`` optional).
+    method : {"best", "median"}
+        Pixel compositing strategy.
+    max_samples : int, optional
+        Size of the per-pixel sample buffer for ``"median"``. The median is
+        exact as long as no pixel has more clear observations than this.
+    seed : int, optional
+        Seed for the reservoir replacement of full median buffers.
+    split_bands : bool, optional
+        Also write one GeoTIFF per spectral band.
+    block_rows : int, optional
+        Number of raster rows processed per block.
+    """
+    if method not in INCREMENTAL_METHODS:
+        raise ValueError(f"Incremental compositing supports {INCREMENTAL_METHODS}, not {method!r}")
+
+    state_dir = out_dir / STATE_DIR
+    state = _load_state(state_dir, method)
+    seen = set(state["info"]["scenes"]) if state else set()
+
+    subdirs = sorted(
+        d for d in out_dir.iterdir()
+        if d.is_dir() and (d / "BANDS.tif").exists()
+    )
+    new_dirs = [d for d in subdirs if d.name not in seen]
+    if not new_dirs:
+        print(f"No new scene folders in {out_dir}; composite is up to date")
+        return out_dir / "BANDS.tif"
+    missing_scl = [d.name for d in new_dirs if not (d / "SCL.tif").exists()]
+    if missing_scl:
+        raise FileNotFoundError(
+            f"Incremental compositing requires SCL.tif; missing in {missing_scl}"
+        )
+
+    if state:
+        info, arrays = state["info"], state["arrays"]
+        use_mask = info["use_mask"]
+    else:
+        use_mask = all((d / "MASK.tif").exists() for d in new_dirs)
+        info = {"method": method, "scenes": [], "use_mask": use_mask}
+        arrays = None
+
+    layer_names = ["bands", "scl"] + (["mask"] if use_mask else [])
+    file_names = [f"{name.upper()}.tif" for name in layer_names]
+    srcs = [_open_scene(d, use_mask) for d in new_dirs]
+    try:
+        metas = [s.meta.copy() for s in srcs[0]]
+        h, w = metas[0]["height"], metas[0]["width"]
+        expected = tuple(info.get("shape", (h, w)))
+        for scene_dir, scene in zip(new_dirs, srcs):
+            if (scene[1].height, scene[1].width) != expected:
+                raise ValueError(
+                    f"Scene {scene_dir.name} has shape {(scene[1].height, scene[1].width)}, "
+                    f"expected {expected}"
+                )
+        info["shape"] = [h, w]
+        first_id = len(info["scenes"])
+
+        layout = _state_layout(method, metas, max_samples)
+        fresh = arrays is None
+        if fresh:
+            state_dir.mkdir(parents=True, exist_ok=True)
+            arrays = {
+                name: np.lib.format.open_memmap(
+                    state_dir / f"{name}.npy", mode="w+", dtype=dtype, shape=shape
+                )
+                for name, (shape, dtype, _) in layout.items()
+            }
+        # marks the state as incomplete until the arrays are flushed
+        _write_state_info(state_dir, {**info, "updating": [d.name for d in new_dirs]})
+
+        if method == "best":
+            cloud_frac = [_cloud_fraction(scene[1]) for scene in srcs]
+        else:
+            rngs = [np.random.default_rng([seed, first_id + i]) for i in range(len(new_dirs))]
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        tmp_paths = [out_dir / name.replace(".tif", ".tmp.tif") for name in file_names]
+        dsts = [rasterio.open(p, "w", **m) for p, m in zip(tmp_paths, metas)]
+        try:
+            for row in range(0, h, block_rows):
+                rows = min(block_rows, h - row)
+                window = Window(0, row, w, rows)
+                if fresh:
+                    block = {
+                        name: np.full(shape[:-2] + (rows, w), fill, dtype=dtype)
+                        for name, (shape, dtype, fill) in layout.items()
+                    }
+                else:
+                    block = {name: np.array(arr[..., row : row + rows, :]) for name, arr in arrays.items()}
+
+                for i, scene in enumerate(srcs):
+                    layers = {"bands": scene[0].read(window=window)}
+                    for name, src in zip(layer_names[1:], scene[1:]):
+                        layers[name] = src.read(1, window=window)
+                    priority = _scl_priority(layers["scl"])
+                    if method == "best":
+                        _update_best(block, layers, priority, cloud_frac[i], first_id + i)
+                    else:
+                        _update_median(block, layers, priority, rngs[i])
+
+                for name, arr in arrays.items():
+                    arr[..., row : row + rows, :] = block[name]
+
+                if method == "best":
+                    dsts[0].write(block["bands"], window=window)
+                    for name, dst in zip(layer_names[1:], dsts[1:]):
+                        dst.write(block[name], 1, window=window)
+                else:
+                    composite = _median_block(block, use_mask)
+                    n_bands = metas[0]["count"]
+                    dsts[0].write(_to_layer(composite[:n_bands], metas[0]), window=window)
+                    for i, dst in enumerate(dsts[1:], start=1):
+                        dst.write(_to_layer(composite[n_bands + i - 1], metas[i]), 1, window=window)
+        finally:
+            for dst in dsts:
+                dst.close()
+    finally:
+        for scene in srcs:
+            for src in scene:
+                src.close()
+
+    for arr in arrays.values():
+        arr.flush()
+    for tmp, name in zip(tmp_paths, file_names):
+        tmp.replace(out_dir / name)
+    if split_bands:
+        split_band_stack(out_dir / "BANDS.tif", _spectral_bands(out_dir))
+
+    info["scenes"].extend(d.name for d in new_dirs)
+    _write_state_info(state_dir, info)
+    print(f"Composited {len(new_dirs)} new scene(s) into {out_dir / 'BANDS.tif'}")
     return out_dir / "BANDS.tif"
@@ -9,19 +9,143 @@ should already contain individual band files such as ``B02.tif`` or
 The script merges each band across all subfolders and writes the
 mosaicked band back to the output directory while preserving the
 original file names.
+
+With ``--vrt`` no pixels are copied: a lightweight GDAL virtual mosaic
+(``B02.vrt`` ...) referencing the dated files is written per band instead.
+Readers can open it with rasterio like any GeoTIFF and only fetch the
+windows they need. ``--materialize`` additionally converts each VRT into a
+GeoTIFF block by block without holding the full mosaic in memory.
 """
 from __future__ import annotations
 
 import argparse
+import os
 from pathlib import Path
 import shutil
+from xml.sax.saxutils import escape
 
 import rasterio
 from rasterio.merge import merge
+from rasterio.windows import Window
+
+# numpy dtype name -> GDAL data type name used in VRT files
+GDAL_TYPES = {
+    "uint8": "Byte",
+    "int8": "Int8",
+    "uint16": "UInt16",
+    "int16": "Int16",
+    "uint32": "UInt32",
+    "int32": "Int32",
+    "float32": "Float32",
+    "float64": "Float64",
+}
+
+
+def _scan_folders(sub_dirs: list[Path]) -> dict[str, list[tuple[Path, dict]]]:
+    """Open every dated folder once and collect each band file's profile."""
+    band_files: dict[str, list[tuple[Path, dict]]] = {}
+    for d in sub_dirs:
+        for path in sorted(d.glob("*.tif")):
+            with rasterio.open(path) as src:
+                info = {
+                    "count": src.count,
+                    "dtype": src.dtypes[0],
+                    "nodata": src.nodata,
+                    "crs": src.crs,
+                    "bounds": src.bounds,
+                    "res": src.res,
+                    "width": src.width,
+                    "height": src.height,
+                }
+            band_files.setdefault(path.name, []).append((path, info))
+    return band_files
+
+
+def build_vrt(sources: list[tuple[Path, dict]], vrt_path: Path) -> Path:
+    """Write a virtual mosaic of ``sources`` to ``vrt_path``.
+
+    Like :func:`rasterio.merge.merge` the grid covers the union of all source
+    bounds at the first source's resolution and the first source wins where
+    sources overlap (nodata pixels are transparent).
+    """
+    first = sources[0][1]
+    res_x, res_y = first["res"]
+    left = min(info["bounds"].left for _, info in sources)
+    bottom = min(info["bounds"].bottom for _, info in sources)
+    right = max(info["bounds"].right for _, info in sources)
+    top = max(info["bounds"].top for _, info in sources)
+    width = int(round((right - left) / res_x))
+    height = int(round((top - bottom) / res_y))
+    dtype = GDAL_TYPES[first["dtype"]]
+    nodata = first["nodata"]
+
+    lines = [
+        f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+        f"  <SRS>{escape(first['crs'].to_wkt())}</SRS>" if first["crs"] else "",
+        f"  <GeoTransform>{left!r}, {res_x!r}, 0.0, {top!r}, 0.0, {-res_y!r}</GeoTransform>",
+    ]
+    for band in range(1, first["count"] + 1):
+        lines.append(f'  <VRTRasterBand dataType="{dtype}" band="{band}">')
+        if nodata is not None:
+            lines.append(f"    <NoDataValue>{nodata!r}</NoDataValue>")
+        # later sources are painted on top, so list the first folder last
+        for path, info in reversed(sources):
+            b = info["bounds"]
+            rel = os.path.relpath(path, vrt_path.parent)
+            tag = "ComplexSource" if info["nodata"] is not None else "SimpleSource"
+            lines += [
+                f"    <{tag}>",
+                f'      <SourceFilename relativeToVRT="1">{escape(rel)}</SourceFilename>',
+                f"      <SourceBand>{band}</SourceBand>",
+                f'      <SrcRect xOff="0" yOff="0" xSize="{info["width"]}" ySize="{info["height"]}"/>',
+                f'      <DstRect xOff="{(b.left - left) / res_x!r}" yOff="{(top - b.top) / res_y!r}"'
+                f' xSize="{(b.right - b.left) / res_x!r}" ySize="{(b.top - b.bottom) / res_y!r}"/>',
+            ]
+            if info["nodata"] is not None:
+                lines.append(f"      <NODATA>{info['nodata']!r}</NODATA>")
+            lines.append(f"    </{tag}>")
+        lines.append("  </VRTRasterBand>")
+    lines.append("</VRTDataset>")
+
+    vrt_path.write_text("\n".join(line for line in lines if line) + "\n")
+    return vrt_path
+
+
+def materialize_vrt(vrt_path: Path, out_path: Path, block_rows: int = 512) -> Path:
+    """Write a VRT mosaic to a GeoTIFF ``block_rows`` lines at a time."""
+    with rasterio.open(vrt_path) as src:
+        meta = src.meta.copy()
+        meta.update(driver="GTiff", tiled=True, compress="deflate")
+        with rasterio.open(out_path, "w", **meta) as dst:
+            for row in range(0, src.height, block_rows):
+                window = Window(0, row, src.width, min(block_rows, src.height - row))
+                dst.write(src.read(window=window), window=window)
+    return out_path
+
 
+def mosaic_date_folders(
+    input_dir: Path,
+    output_dir: Path | None = None,
+    vrt: bool = False,
+    materialize: bool = False,
+    block_rows: int = 512,
+) -> Path:
+    """Merge bands across date subfolders.
 
-def mosaic_date_folders(input_dir: Path, output_dir: Path | None = None) -> Path:
-    """Merge bands across date subfolders."""
+    Parameters
+    ----------
+    input_dir : Path
+        Directory containing the dated subfolders.
+    output_dir : Path, optional
+        Destination for the mosaics, defaults to ``input_dir``.
+    vrt : bool, optional
+        Write a virtual mosaic ``<band>.vrt`` per band instead of merging the
+        pixels in memory.
+    materialize : bool, optional
+        With ``vrt``, also convert each VRT to ``<band>.tif`` block by block.
+    block_rows : int, optional
+        Rows per block when materializing.
+    """
     input_dir = Path(input_dir)
     if output_dir is None:
         output_dir = input_dir
@@ -31,10 +155,19 @@ def mosaic_date_folders(input_dir: Path, output_dir: Path | None = None) -> Path
     if not sub_dirs:
         raise FileNotFoundError(f"No subfolders found in {input_dir}")
 
-    band_files = sorted(f.name for f in sub_dirs[0].glob("*.tif"))
-    for name in band_files:
-        paths = [d / name for d in sub_dirs if (d / name).exists()]
-        if not paths:
+    first_names = {f.name for f in sub_dirs[0].glob("*.tif")}
+    band_files = {
+        name: sources
+        for name, sources in _scan_folders(sub_dirs).items()
+        if name in first_names
+    }
+    for name, sources in sorted(band_files.items()):
+        paths = [path for path, _ in sources]
+        if vrt:
+            out_path = build_vrt(sources, output_dir / Path(name).with_suffix(".vrt"))
+            if materialize:
+                out_path = materialize_vrt(out_path, output_dir / name, block_rows)
+            print(f"Saved {out_path}")
             continue
         srcs = [rasterio.open(p) for p in paths]
         mosaic, transform = merge(srcs)
@@ -48,7 +181,7 @@ def mosaic_date_folders(input_dir: Path, output_dir: Path | None = None) -> Path
         print(f"Saved {out_path}")
 
     dl_yaml = input_dir / "download.yaml"
-    if dl_yaml.exists():
+    if dl_yaml.exists() and dl_yaml.resolve() != (output_dir / "download.yaml").resolve():
         shutil.copy(dl_yaml, output_dir / "download.yaml")
 
     return output_dir
@@ -58,9 +191,22 @@ def main() -> None:
     p = argparse.ArgumentParser(description="Mosaic dated subfolders of Sentinel bands")
     p.add_argument("--input-dir", required=True, help="Directory with dated folders")
     p.add_argument("--output-dir", help="Destination for mosaicked bands")
+    p.add_argument("--vrt", action="store_true", help="Write virtual mosaics (.vrt) instead of merging")
+    p.add_argument(
+        "--materialize",
+        action="store_true",
+        help="With --vrt, also write each virtual mosaic to a GeoTIFF block by block",
+    )
+    p.add_argument("--block-rows", type=int, default=512, help="Rows per block when materializing")
     args = p.parse_args()
 
-    out = mosaic_date_folders(Path(args.input_dir), Path(args.output_dir) if args.output_dir else None)
+    out = mosaic_date_folders(
+        Path(args.input_dir),
+        Path(args.output_dir) if args.output_dir else None,
+        vrt=args.vrt,
+        materialize=args.materialize,
+        block_rows=args.block_rows,
+    )
     print(f"\u2705  Mosaicked bands written to {out}")
 
 
@@ -27,11 +27,16 @@ from rasterio.warp import reproject, Resampling, transform_bounds
 from rasterio.windows import from_bounds
 from rasterio.coords import disjoint_bounds
 
+from .manifest import SUFFIX, StageCache
+
 
 def load_reference_meta(sentinel_dir: Path, cfg: dict) -> tuple[dict, tuple[float, float, float, float]]:
     """Load raster metadata from a Sentinel band to match resolution and CRS."""
     band = cfg.get("bands", ["B02"])[0]
     path = sentinel_dir / f"{band}.tif"
+    if not path.exists():
+        # per-band files are optional; the stack shares the same grid
+        path = sentinel_dir / "BANDS.tif"
     if not path.exists():
         tiffs = list(sentinel_dir.glob("*.tif"))
         if not tiffs:
@@ -60,6 +65,11 @@ def main() -> None:
             " Sentinel directory"
         ),
     )
+    p.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild even if the WorldCover tiles and reference grid are unchanged",
+    )
     args = p.parse_args()
 
     wc_dir = Path(args.worldcover)
@@ -68,12 +78,21 @@ def main() -> None:
 
     cfg = yaml.safe_load((s2_dir / "download.yaml").read_text())
 
-    meta, bbox = load_reference_meta(s2_dir, cfg)
-
     wc_files = sorted(wc_dir.glob("*.tif"))
     if not wc_files:
         raise FileNotFoundError(f"No WorldCover tiles found in {wc_dir}")
 
+    cache = StageCache(
+        out_path.with_name(f"{out_path.name}{SUFFIX}"),
+        "labels",
+        inputs=[*wc_files, s2_dir / "download.yaml", s2_dir / "BANDS.tif"],
+        outputs=[out_path],
+    )
+    if cache.skip(args.force):
+        return
+
+    meta, bbox = load_reference_meta(s2_dir, cfg)
+
     bbox_bounds = bbox
     srcs: list[rasterio.io.DatasetReader] = []
     for fp in wc_files:
@@ -117,6 +136,7 @@ def main() -> None:
     out_path.parent.mkdir(parents=True, exist_ok=True)
     with rasterio.open(out_path, "w", **meta) as dst:
         dst.write(dest)
+    cache.record()
     print(f"Saved label raster to {out_path}")
 
 
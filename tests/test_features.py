@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from src.preprocess.blockwise import process_blocks
+from src.preprocess.features import FOCAL_OPS, FeatureSet
+
+BAND_NAMES = ["B02", "B03", "B04", "B08", "B11"]
+
+
+def _bands(height=41, width=23, seed=0):
+    rng = np.random.default_rng(seed)
+    stack = rng.uniform(100, 5000, (len(BAND_NAMES), height, width)).astype(np.float32)
+    stack[:, rng.random((height, width)) < 0.05] = np.nan
+    return stack
+
+
+def _process(stack, feature_set, block_rows):
+    def read_block(window, out):
+        (r0, r1), (c0, c1) = window.toranges()
+        out[:] = stack[:, r0:r1, c0:c1]
+        return out
+
+    n_bands, height, width = stack.shape
+    target = np.empty((len(feature_set), height, width), dtype=np.float32)
+    return process_blocks(
+        read_block, n_bands, height, width, target, feature_set.compute,
+        block_rows=block_rows, halo=feature_set.halo,
+    )
+
+
+@pytest.mark.parametrize("op", FOCAL_OPS)
+@pytest.mark.parametrize("size", [3, 5, 7])
+def test_focal_features_do_not_depend_on_block_rows(op, size):
+    stack = _bands()
+    feature_set = FeatureSet([f"NDVI_{op}{size}", f"B08_{op}{size}"], BAND_NAMES)
+    expected = feature_set.compute(stack)
+    for block_rows in (1, 2, 7, 40):
+        result = _process(stack, feature_set, block_rows)
+        np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6, equal_nan=True)
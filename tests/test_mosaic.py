@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from src.utils.mosaic import STATE_DIR, composite_scenes, update_mosaic_incremental
+
+SCENES = ["2024-01-01", "2024-01-02", "2024-01-03", "2024-01-04"]
+
+
+def _write_scene(path, seed, height=37, width=29):
+    rng = np.random.default_rng(seed)
+    path.mkdir(parents=True)
+    profile = dict(
+        driver="GTiff", height=height, width=width, crs="EPSG:32652",
+        transform=from_origin(500000, 3700000, 10, 10),
+    )
+    bands = rng.integers(100, 10000, (4, height, width)).astype(np.uint16)
+    scl = rng.choice([4, 5, 6, 7, 8, 9], size=(height, width)).astype(np.uint8)
+    mask = (rng.random((height, width)) > 0.05).astype(np.uint8)
+    with rasterio.open(path / "BANDS.tif", "w", count=4, dtype="uint16", nodata=0, **profile) as dst:
+        dst.write(bands)
+    with rasterio.open(path / "SCL.tif", "w", count=1, dtype="uint8", **profile) as dst:
+        dst.write(scl, 1)
+    with rasterio.open(path / "MASK.tif", "w", count=1, dtype="uint8", **profile) as dst:
+        dst.write(mask, 1)
+
+
+def _read(out_dir):
+    layers = []
+    for name in ("BANDS", "SCL", "MASK"):
+        with rasterio.open(out_dir / f"{name}.tif") as src:
+            layers.append(src.read())
+    return layers
+
+
+@pytest.mark.parametrize("method", ["best", "median"])
+def test_incremental_matches_full_composite(tmp_path, method):
+    inc, full = tmp_path / "inc", tmp_path / "full"
+    for i, name in enumerate(SCENES):
+        _write_scene(full / name, i)
+    # two scenes first, the others in a later run
+    for name in SCENES[:2]:
+        _write_scene(inc / name, SCENES.index(name))
+    update_mosaic_incremental(inc, method, block_rows=5)
+    for name in SCENES[2:]:
+        _write_scene(inc / name, SCENES.index(name))
+    update_mosaic_incremental(inc, method, block_rows=5)
+
+    composite_scenes([full / name for name in SCENES], full, method)
+    for a, b in zip(_read(inc), _read(full)):
+        np.testing.assert_array_equal(a, b)
+    assert np.load(inc / STATE_DIR / "bands.npy", mmap_mode="r").dtype == np.uint16
+
+
+def test_median_reservoir_does_not_depend_on_block_rows(tmp_path):
+    results = []
+    for block_rows in (3, 64):
+        out = tmp_path / str(block_rows)
+        for i, name in enumerate(SCENES):
+            _write_scene(out / name, i)
+        update_mosaic_incremental(out, "median", max_samples=2, block_rows=block_rows)
+        results.append(_read(out))
+    for a, b in zip(*results):
+        np.testing.assert_array_equal(a, b)
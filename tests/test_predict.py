@@ -0,0 +1,52 @@
+import json
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from src.classification.metrics import classification_metrics
+from src.pipeline.predict import _evaluate_prediction
+
+
+def _write(path, array, nodata=None):
+    profile = dict(
+        driver="GTiff", height=array.shape[0], width=array.shape[1], count=1,
+        dtype="uint8", nodata=nodata, crs="EPSG:32652",
+        transform=from_origin(500000, 3700000, 10, 10),
+    )
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(array, 1)
+
+
+@pytest.fixture
+def rasters(tmp_path):
+    rng = np.random.default_rng(0)
+    labels = rng.choice([0, 10, 20, 30], size=(45, 38)).astype(np.uint8)
+    predictions = np.where(rng.random(labels.shape) < 0.8, labels, 20).astype(np.uint8)
+    predictions[rng.random(labels.shape) < 0.05] = 0
+    _write(tmp_path / "labels.tif", labels, nodata=0)
+    _write(tmp_path / "prediction.tif", predictions, nodata=0)
+    return tmp_path, predictions, labels
+
+
+@pytest.mark.parametrize("erode,dilate", [(0, 0), (0, 2), (1, 2), (2, 1)])
+def test_evaluation_does_not_depend_on_tile_size(rasters, erode, dilate):
+    root, predictions, labels = rasters
+    results = []
+    for tile_size in (1000, 7, 16):
+        path = root / f"difference_{tile_size}.tif"
+        metrics = _evaluate_prediction(
+            root / "prediction.tif", root / "labels.tif", path, tile_size, erode, dilate
+        )
+        with rasterio.open(path) as src:
+            results.append((json.dumps(metrics), src.read(), src.dataset_mask()))
+    for result in results[1:]:
+        assert result[0] == results[0][0]
+        np.testing.assert_array_equal(result[1], results[0][1])
+        np.testing.assert_array_equal(result[2], results[0][2])
+
+    expected = classification_metrics(predictions, labels)
+    metrics = json.loads(results[0][0])
+    metrics.pop("difference_summary")
+    assert metrics == json.loads(json.dumps(expected))
@@ -0,0 +1,142 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import Affine
+from sklearn.ensemble import RandomForestClassifier
+
+from src.classification.serving import PredictionBatcher
+from src.pipeline.serve import ModelServer
+from src.pipeline.serve_client import ServeClient, ServeError
+from src.preprocess.feature_store import create_feature_store
+
+N_FEATURES = 4
+
+
+def _features(height=30, width=25, seed=0):
+    rng = np.random.default_rng(seed)
+    features = rng.normal(size=(N_FEATURES, height, width)).astype(np.float32)
+    features[:, rng.random((height, width)) < 0.05] = np.nan
+    return features
+
+
+def _expected(clf, features):
+    X = features.reshape(len(features), -1).T
+    valid = ~np.isnan(X).any(axis=1)
+    expected = np.zeros(X.shape[0], dtype=np.uint8)
+    expected[valid] = clf.predict(X[valid])
+    return expected.reshape(features.shape[1:])
+
+
+@pytest.fixture(scope="module")
+def clf():
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(400, N_FEATURES))
+    y = 1 + (X[:, 0] > 0) + (X[:, 1] > 0.5)
+    return RandomForestClassifier(n_estimators=10, max_depth=6, random_state=0).fit(X, y)
+
+
+@pytest.fixture(scope="module")
+def client(clf):
+    server = ModelServer(("127.0.0.1", 0), {"rf": clf}, tile_size=16, max_wait_ms=2.0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield ServeClient(f"http://127.0.0.1:{server.server_address[1]}", timeout=60)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    features = _features()
+    path = tmp_path_factory.mktemp("serve") / "features.feat"
+    meta = {"crs": "EPSG:32654", "transform": Affine(10.0, 0.0, 500000.0, 0.0, -10.0, 4000000.0)}
+    data = create_feature_store(
+        path, features.shape, [f"f{i}" for i in range(N_FEATURES)], meta
+    )
+    data[:] = features
+    data.flush()
+    return path, features
+
+
+def test_predict(client, clf):
+    features = _features(seed=2)
+    np.testing.assert_array_equal(client.predict_array(features), _expected(clf, features))
+
+
+def test_predict_path(client, clf, store):
+    path, features = store
+    np.testing.assert_array_equal(client.predict_path(path), _expected(clf, features))
+    window = features[:, 5:25, 3:13]
+    np.testing.assert_array_equal(
+        client.predict_path(path, window=(3, 5, 10, 20)), _expected(clf, window)
+    )
+
+
+def test_predict_path_output(client, clf, store, tmp_path):
+    path, features = store
+    output = tmp_path / "pred.tif"
+    summary = client.predict_path(path, window=(3, 5, 10, 20), output=output)
+    expected = _expected(clf, features[:, 5:25, 3:13])
+    assert summary["window"] == [3, 5, 10, 20]
+    assert summary["classified_pixels"] == np.count_nonzero(expected)
+    with rasterio.open(output) as src:
+        np.testing.assert_array_equal(src.read(1), expected)
+
+
+def test_stats(client):
+    client.predict_array(_features(5, 5))
+    stats = client.stats()
+    assert stats["latency"]["predict"]["count"] >= 1
+    assert stats["batches"]["rf"]["rows"]["count"] >= 1
+
+
+@pytest.mark.parametrize(
+    "request_kwargs",
+    [{"window": (0, 0, 5)}, {"model": "missing"}, {"window": ("a", 0, 5, 5)}],
+)
+def test_malformed_predict_path(client, store, request_kwargs):
+    path, _ = store
+    request = {"path": str(path), **request_kwargs}
+    with pytest.raises(ServeError) as excinfo:
+        client._request("/predict_path", json.dumps(request).encode())
+    assert excinfo.value.status == 400
+
+
+def test_malformed_predict(client):
+    with pytest.raises(ServeError) as excinfo:
+        client.predict_array(np.zeros((N_FEATURES + 1, 4, 4), dtype=np.float32))
+    assert excinfo.value.status == 400
+    with pytest.raises(ServeError) as excinfo:
+        client.predict_array(np.zeros((N_FEATURES, 4), dtype=np.float32))
+    assert excinfo.value.status == 400
+
+
+def test_malformed_does_not_break_concurrent(client, clf):
+    good = [_features(8, 8, seed=s) for s in range(6)]
+    bad = np.zeros((N_FEATURES + 1, 8, 8), dtype=np.float32)
+
+    def send(features):
+        try:
+            return client.predict_array(features)
+        except ServeError as exc:
+            return exc.status
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(send, [f for g in good for f in (g, bad)]))
+    for features, pred in zip(good, results[0::2]):
+        np.testing.assert_array_equal(pred, _expected(clf, features))
+    assert results[1::2] == [400] * len(good)
+
+
+def test_batcher_isolates_failures(clf):
+    batcher = PredictionBatcher(clf, max_batch_rows=1000, max_wait_ms=200.0)
+    X = np.random.default_rng(3).normal(size=(10, N_FEATURES))
+    good = batcher.submit(X)
+    bad = batcher.submit(np.zeros((10, N_FEATURES + 1)))
+    np.testing.assert_array_equal(good.result(timeout=30), clf.predict(X))
+    with pytest.raises(ValueError):
+        bad.result(timeout=30)